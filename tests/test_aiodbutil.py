@@ -0,0 +1,99 @@
+
+
+import sqlite3
+import sys
+
+import pytest
+
+asyncio = pytest.importorskip('asyncio')
+import tfd.aiodbutil
+import tfd.dbutil
+
+
+def make_db(tmpdir, max_size=3):
+    path = str(tmpdir.join('people.db'))
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE people (id INTEGER PRIMARY KEY, name TEXT)')
+    conn.commit()
+    conn.close()
+    pool = tfd.dbutil.ConnectionPool(
+        lambda: sqlite3.connect(path, check_same_thread=False),
+        max_size=max_size, idle_check=None)
+    loop = asyncio.new_event_loop()
+    return tfd.aiodbutil.AsyncDB(pool, loop=loop), loop
+
+
+def test_async_db(tmpdir):
+    db, loop = make_db(tmpdir)
+    try:
+        run = loop.run_until_complete
+        sql = 'INSERT INTO people VALUES (?, ?)'
+        rows = [(i, 'person%s' % i) for i in range(10)]
+        run(db.executeManySQL(sql, rows))
+        # sqlite3 connections start transactions for inserts.
+        txn = db.transaction(start=False)
+        run(txn.__aenter__())
+        run(txn.updateSQL('UPDATE people SET name = ? WHERE id = 0', ['x']))
+        run(txn.__aexit__(None, None, None))
+        counts = run(asyncio.gather(*[
+            db.selectSQL('SELECT COUNT(*) FROM people WHERE id >= ?', [i])
+            for i in range(10)]))
+        assert [c[0][0] for c in counts] == list(range(10, 0, -1))
+        assert run(db.selectSQL('SELECT name FROM people WHERE id = 0', [])) == [('x',)]
+
+        # a failed transaction is rolled back and its connection returned.
+        txn = db.transaction(start=False)
+        run(txn.__aenter__())
+        run(txn.updateSQL('UPDATE people SET name = ?', ['y']))
+        with pytest.raises(sqlite3.OperationalError):
+            run(txn.selectSQL('SELECT * FROM pets'))
+        run(txn.__aexit__(sqlite3.OperationalError, None, None))
+        assert run(db.selectSQL('SELECT name FROM people WHERE id = 0', [])) == [('x',)]
+        assert db.pool.stats()['in_use'] == 0
+
+        # a cancelled transaction still returns its connection.
+        txn = db.transaction(start=False)
+        entered = txn.__aenter__()
+        entered.cancel()
+        run(db.selectSQL('SELECT 1', []))
+        run(asyncio.sleep(0.05))
+        assert db.pool.stats()['in_use'] == 0
+    finally:
+        db.close()
+        loop.close()
+
+
+# async syntax does not compile under python 2, so this test is exec'd.
+ASYNC_WITH_TEST = '''
+async def transactions(db):
+    async def transfer(i):
+        async with db.transaction(start=False) as txn:
+            await txn.executeSQL('INSERT INTO people VALUES (?, ?)', [i, 'p'])
+            # a statement outside the transaction while every
+            # transaction worker is busy.
+            return await db.selectSQL('SELECT 1', [])
+    results = await asyncio.wait_for(
+        asyncio.gather(*[transfer(i) for i in range(4)]), 5)
+    try:
+        async with db.transaction(start=False) as txn:
+            await txn.executeSQL('INSERT INTO people VALUES (?, ?)', [9, 'x'])
+            raise KeyError()
+    except KeyError:
+        pass
+    return results, await db.selectSQL('SELECT COUNT(*) FROM people', [])
+'''
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason='requires async/await')
+def test_async_with(tmpdir):
+    db, loop = make_db(tmpdir, max_size=4)
+    try:
+        namespace = {'asyncio': asyncio}
+        exec(ASYNC_WITH_TEST, namespace)
+        results, count = loop.run_until_complete(namespace['transactions'](db))
+        assert results == [[(1,)]] * 4
+        assert count == [(4,)]
+        assert db.pool.stats()['in_use'] == 0
+    finally:
+        db.close()
+        loop.close()
@@ -0,0 +1,463 @@
+
+
+import ast
+import gzip
+import math
+import sqlite3
+import struct
+import threading
+import time
+
+import pytest
+
+import tfd.dbutil
+
+
+def open_conn(path):
+    '''
+    Return a function that opens a sqlite connection to path, usable from
+    any thread.
+    '''
+    return lambda: sqlite3.connect(str(path), check_same_thread=False)
+
+
+def make_people(path, num_people=10):
+    conn = sqlite3.connect(str(path))
+    conn.execute('CREATE TABLE people (id INTEGER PRIMARY KEY, name TEXT)')
+    conn.executemany('INSERT INTO people VALUES (?, ?)',
+                     [(i, 'person%s' % i) for i in range(1, num_people + 1)])
+    conn.commit()
+    conn.close()
+
+
+def test_connection_pool(tmpdir):
+    path = tmpdir.join('people.db')
+    make_people(path)
+    pool = tfd.dbutil.ConnectionPool(open_conn(path), min_size=1, max_size=2,
+                                     idle_check=None)
+    assert pool.stats()['size'] == 1
+    with pool.connection() as conn:
+        assert tfd.dbutil.selectSQL(conn, 'SELECT COUNT(*) FROM people', []) == [(10,)]
+        with pool.connection() as conn2:
+            assert conn2 is not conn
+            assert pool.stats()['in_use'] == 2
+            # the pool is exhausted.
+            with pytest.raises(tfd.dbutil.PoolTimeout):
+                pool.checkout(timeout=0.01)
+    stats = pool.stats()
+    assert (stats['size'], stats['idle'], stats['in_use']) == (2, 2, 0)
+
+    # a waiting thread gets the connection when it is returned.
+    conns = [pool.checkout(), pool.checkout()]
+    got = []
+    thread = threading.Thread(target=lambda: got.append(pool.checkout()))
+    thread.start()
+    time.sleep(0.05)
+    pool.checkin(conns[0])
+    thread.join()
+    assert got[0] is conns[0]
+    assert pool.stats()['waits'] == 1
+    pool.checkin(conns[1])
+    pool.checkin(got[0])
+
+    # a connection returned by an exception is rolled back and reused.
+    with pytest.raises(KeyError):
+        with pool.connection() as conn:
+            raise KeyError()
+    assert pool.stats()['idle'] == 2
+    pool.close()
+    assert pool.stats()['size'] == 0
+    with pytest.raises(tfd.dbutil.PoolClosed):
+        pool.checkout()
+
+
+def test_connection_pool_validation_and_recycling(tmpdir):
+    path = tmpdir.join('people.db')
+    make_people(path)
+    pool = tfd.dbutil.ConnectionPool(open_conn(path), min_size=1,
+                                     idle_check=0)
+    with pool.connection() as conn:
+        conn.close() # simulate the server dropping the connection.
+    with pool.connection() as conn2:
+        assert tfd.dbutil.selectSQL(conn2, 'SELECT 1', []) == [(1,)]
+    stats = pool.stats()
+    assert stats['validation_failures'] == 1
+    assert stats['created'] == 2
+    # the retry after the failed ping is part of the same checkout.
+    assert stats['checkouts'] == 2
+
+    pool = tfd.dbutil.ConnectionPool(open_conn(path), idle_check=None,
+                                     max_age=0)
+    with pool.connection() as conn:
+        pass
+    with pool.connection() as conn:
+        pass
+    # old connections are closed, not returned to the pool, and replaced to
+    # keep min_size open.
+    assert pool.stats()['recycled'] >= 2
+    assert pool.stats()['size'] == 1
+
+
+def test_connection_pool_refills_to_min_size(tmpdir):
+    path = tmpdir.join('people.db')
+    make_people(path)
+    pool = tfd.dbutil.ConnectionPool(open_conn(path), min_size=1,
+                                     idle_check=None)
+    conn = pool.checkout()
+    pool.checkin(conn, broken=True)
+    stats = pool.stats()
+    assert (stats['size'], stats['idle'], stats['discarded']) == (1, 1, 1)
+    with pool.connection() as conn2:
+        assert conn2 is not conn
+        assert tfd.dbutil.selectSQL(conn2, 'SELECT 1', []) == [(1,)]
+
+
+def test_iter_select_sql(tmpdir):
+    path = tmpdir.join('people.db')
+    make_people(path, num_people=5)
+    conn = sqlite3.connect(str(path))
+    sql = 'SELECT id, name FROM people ORDER BY id'
+    assert (list(tfd.dbutil.iterSelectSQL(conn, sql, [], batch_size=2)) ==
+            tfd.dbutil.selectSQL(conn, sql, []))
+    dicts = list(tfd.dbutil.iterSelectSQL(conn, sql, [], rowtype='dict'))
+    assert dicts == tfd.dbutil.selectSQL(conn, sql, [], asdict=True)
+    rows = list(tfd.dbutil.iterSelectSQL(conn, sql, [], rowtype='namedtuple'))
+    assert (rows[0].id, rows[0].name) == (1, 'person1')
+    batches = list(tfd.dbutil.iterSelectSQL(conn, sql, [], rowtype='columns',
+                                            batch_size=2))
+    assert [len(batch[0]) for batch in batches] == [2, 2, 1]
+    assert batches[2] == [[5], ['person5']]
+    with pytest.raises(ValueError):
+        list(tfd.dbutil.iterSelectSQL(conn, sql, [], rowtype='list'))
+
+
+def test_bulk_insert_sql(tmpdir):
+    conn = sqlite3.connect(str(tmpdir.join('people.db')))
+    tfd.dbutil.executeSQL(conn, 'CREATE TABLE people (id INTEGER PRIMARY KEY, name TEXT, age INTEGER)', [])
+    reports = []
+    rows = ((i, 'person%s' % i, i) for i in range(1, 1001))
+    stats = tfd.dbutil.bulkInsertSQL(conn, 'people', ['id', 'name', 'age'],
+                                     rows, batch_size=400, commit_every=2,
+                                     dialect='sqlite', start=False,
+                                     progress=reports.append)
+    assert (stats['rows'], stats['batches']) == (1000, 3)
+    assert [r['rows'] for r in reports] == [800, 1000]
+    assert tfd.dbutil.selectSQL(conn, 'SELECT COUNT(*), SUM(age) FROM people', []) == [(1000, 500500)]
+
+    with pytest.raises(sqlite3.IntegrityError):
+        tfd.dbutil.bulkInsertSQL(conn, 'people', ['id', 'name', 'age'],
+                                 [(1, 'x', 0)], dialect='sqlite', start=False)
+    tfd.dbutil.bulkInsertSQL(conn, 'people', ['id', 'name', 'age'],
+                             [(1, 'x', 0), (1001, 'y', 0)], upsert='ignore',
+                             dialect='sqlite', start=False)
+    tfd.dbutil.bulkInsertSQL(conn, 'people', ['id', 'name', 'age'],
+                             [(2, 'z', 0)], upsert='update', keys=['id'],
+                             dialect='sqlite', start=False, multirow=False)
+    sql = 'SELECT id, name FROM people WHERE id IN (1, 2, 1001) ORDER BY id'
+    assert tfd.dbutil.selectSQL(conn, sql, []) == [(1, 'person1'), (2, 'z'), (1001, 'y')]
+
+    # sqlite transactions start with BEGIN, not START TRANSACTION.
+    conn.commit()
+    tfd.dbutil.bulkInsertSQL(conn, 'people', ['id', 'name', 'age'],
+                             [(1002, 'w', 0)], dialect='sqlite')
+    assert tfd.dbutil.selectSQL(conn, 'SELECT name FROM people WHERE id = 1002', []) == [('w',)]
+    # an implicit transaction is already open after an insert.
+    tfd.dbutil.executeSQL(conn, "INSERT INTO people VALUES (1003, 'v', 0)", [])
+    tfd.dbutil.bulkInsertSQL(conn, 'people', ['id', 'name', 'age'],
+                             [(1004, 'u', 0)], dialect='sqlite')
+    assert tfd.dbutil.selectSQL(conn, 'SELECT COUNT(*) FROM people WHERE id > 1002', []) == [(2,)]
+
+
+def test_query_cache(tmpdir):
+    path = tmpdir.join('people.db')
+    make_people(path, num_people=3)
+    conn = sqlite3.connect(str(path))
+    now = [0]
+    cache = tfd.dbutil.QueryCache(max_size=2, ttl=10, clock=lambda: now[0])
+    assert tfd.dbutil.sqlTables('SELECT * FROM people p JOIN `pets` ON 1') == ['people', 'pets']
+
+    sql = 'SELECT name FROM people WHERE id=?'
+    assert cache.selectSQL(conn, sql, [1]) == [('person1',)]
+    tfd.dbutil.executeSQL(conn, 'UPDATE people SET name=? WHERE id=1', ['x'])
+    assert cache.selectSQL(conn, sql, [1]) == [('person1',)] # stale hit
+    cache.updateSQL(conn, 'UPDATE people SET name=? WHERE id=1', ['y'])
+    assert cache.selectSQL(conn, sql, [1]) == [('y',)]
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['invalidations']) == (1, 2, 1)
+
+    # least recently used results are evicted.
+    cache.selectSQL(conn, sql, [2])
+    cache.selectSQL(conn, sql, [1])
+    cache.selectSQL(conn, sql, [3])
+    assert cache.stats()['evictions'] == 1
+    cache.selectSQL(conn, sql, [1])
+    assert cache.stats()['hits'] == 3
+
+    # results expire.
+    now[0] = 11
+    cache.selectSQL(conn, sql, [1])
+    assert cache.stats()['expirations'] == 1
+    cache.invalidate()
+    assert cache.stats()['size'] == 0
+
+
+def test_query_hooks(tmpdir):
+    path = tmpdir.join('people.db')
+    make_people(path, num_people=3)
+    conn = sqlite3.connect(str(path))
+    assert (tfd.dbutil.normalizeSQL("SELECT * FROM t2 WHERE id IN (1, 2,3)\n AND acc = 'GO:1'") ==
+            'SELECT * FROM t2 WHERE id IN (...) AND acc = ?')
+    events = []
+    stats = tfd.dbutil.QueryStats()
+    slow = tfd.dbutil.SlowQueryLog(threshold=0)
+    tfd.dbutil.addHook(events.append)
+    tfd.dbutil.addHook(stats)
+    tfd.dbutil.addHook(slow)
+    try:
+        with tfd.dbutil.doTransaction(conn, start=False):
+            tfd.dbutil.selectSQL(conn, 'SELECT * FROM people WHERE id < 3', [])
+            tfd.dbutil.selectSQL(conn, 'SELECT * FROM people WHERE id < ?', [4])
+            tfd.dbutil.updateSQL(conn, 'UPDATE people SET name = ?', ['x'])
+        with pytest.raises(sqlite3.OperationalError):
+            tfd.dbutil.executeSQL(conn, 'SELECT * FROM pets', [])
+    finally:
+        tfd.dbutil.removeHook(events.append)
+        tfd.dbutil.removeHook(stats)
+        tfd.dbutil.removeHook(slow)
+    assert [e.function for e in events] == ['selectSQL', 'selectSQL', 'updateSQL',
+                                            'doTransaction', 'executeSQL']
+    assert [e.rows for e in events[:3]] == [2, 3, 3]
+    assert isinstance(events[-1].error, sqlite3.OperationalError)
+    statements = stats.statements()
+    select = statements['SELECT * FROM people WHERE id < ?']
+    assert (select['count'], select['rows'], sum(select['histogram'])) == (2, 5, 2)
+    assert len(stats.top(2)) == 2
+    assert statements['SELECT * FROM pets']['errors'] == 1
+
+
+def test_query_hooks_iter_select_excludes_consumer_time(tmpdir):
+    path = tmpdir.join('people.db')
+    make_people(path, num_people=3)
+    conn = sqlite3.connect(str(path))
+    events = []
+    tfd.dbutil.addHook(events.append)
+    try:
+        for row in tfd.dbutil.iterSelectSQL(conn, 'SELECT * FROM people', [],
+                                            batch_size=2):
+            time.sleep(0.1) # a slow consumer
+        rows = tfd.dbutil.iterSelectSQL(conn, 'SELECT * FROM people', [])
+        next(rows)
+        time.sleep(0.1)
+        rows.close()
+    finally:
+        tfd.dbutil.removeHook(events.append)
+    assert [(e.function, e.rows) for e in events] == [('iterSelectSQL', 3),
+                                                      ('iterSelectSQL', 3)]
+    assert all(e.seconds < 0.1 for e in events)
+
+
+def test_session(tmpdir):
+    conn = sqlite3.connect(str(tmpdir.join('people.db')))
+    prepared = []
+    def prepare(conn):
+        prepared.append(conn.cursor())
+        return prepared[-1]
+    for kws in [{}, {'prepare': prepare, 'max_statements': 2}]:
+        tfd.dbutil.executeSQL(conn, 'DROP TABLE IF EXISTS people', [])
+        with tfd.dbutil.Session(conn, batch_size=4, **kws) as session:
+            session.executeSQL('CREATE TABLE people (id INTEGER PRIMARY KEY, name TEXT)', [])
+            assert session.insertSQL('INSERT INTO people (name) VALUES (?)', ['a']) == 1
+            with session.doTransaction(start=False):
+                for i in range(10):
+                    session.deferSQL('INSERT INTO people (name) VALUES (?)', ['b'])
+                # deferred statements are flushed before a select.
+                sql = 'SELECT COUNT(*) FROM people WHERE name = ?'
+                assert session.selectSQL(sql, ['b']) == [(10,)]
+                session.deferSQL('UPDATE people SET name = ? WHERE id = ?', ['c', 1])
+            assert session.updateSQL('UPDATE people SET name = ? WHERE name = ?', ['d', 'b']) == 10
+            rows = session.selectSQL('SELECT id, name FROM people WHERE id = ?', [1], asdict=True)
+            assert rows == [{'id': 1, 'name': 'c'}]
+            with pytest.raises(sqlite3.OperationalError):
+                session.selectSQL('SELECT * FROM pets', [])
+            assert session.selectSQL(sql, ['d']) == [(10,)]
+    # one prepared cursor per statement, at most max_statements open.
+    assert len(prepared) > 2
+    assert tfd.dbutil.selectSQL(conn, 'SELECT COUNT(*) FROM people', []) == [(11,)]
+
+
+def test_keyset_scan_sql(tmpdir):
+    path = tmpdir.join('people.db')
+    make_people(path, num_people=25)
+    conn = sqlite3.connect(str(path))
+    events = []
+    tfd.dbutil.addHook(events.append)
+    try:
+        rows = list(tfd.dbutil.keysetScanSQL(conn, 'people', 'id', page_size=10,
+                                             placeholder='?'))
+    finally:
+        tfd.dbutil.removeHook(events.append)
+    assert rows == tfd.dbutil.selectSQL(conn, 'SELECT * FROM people ORDER BY id', [])
+    assert [e.rows for e in events] == [10, 10, 5]
+    assert 'LIMIT' in events[1].sql and 'OFFSET' not in events[1].sql
+    rows = list(tfd.dbutil.keysetScanSQL(conn, 'people', 'id', columns=['name', 'id'],
+                                         where='id % 2 = ?', args=[0], page_size=5,
+                                         lower=4, upper=20, placeholder='?'))
+    assert rows == [('person%s' % i, i) for i in range(6, 21, 2)]
+    with pytest.raises(ValueError):
+        list(tfd.dbutil.keysetScanSQL(conn, 'people', 'id', columns=['name']))
+
+
+def test_parallel_scan_sql(tmpdir):
+    path = tmpdir.join('people.db')
+    make_people(path, num_people=100)
+    pool = tfd.dbutil.ConnectionPool(open_conn(path), max_size=3, idle_check=None)
+    expected = [(i, 'person%s' % i) for i in range(1, 101)]
+    rows = list(tfd.dbutil.parallelScanSQL(pool, 'people', 'id', page_size=7,
+                                           workers=3, placeholder='?'))
+    assert sorted(rows) == expected
+    rows = list(tfd.dbutil.parallelScanSQL(pool, 'people', 'id', page_size=7,
+                                           splits=[10, 50, 70], workers=2,
+                                           ordered=True, placeholder='?'))
+    assert rows == expected
+    with pytest.raises(sqlite3.OperationalError):
+        list(tfd.dbutil.parallelScanSQL(pool, 'people', 'age', splits=[10],
+                                        placeholder='?'))
+    assert pool.stats()['in_use'] == 0
+
+
+def test_fan_out_sql(tmpdir):
+    path = tmpdir.join('people.db')
+    make_people(path, num_people=50)
+    pool = tfd.dbutil.ConnectionPool(open_conn(path), max_size=4, idle_check=None)
+    sql = 'SELECT id FROM people WHERE id % 5 = ? ORDER BY id'
+    queries = [(sql, [i]) for i in range(5)]
+    rows = list(tfd.dbutil.fanOutSQL(pool, queries, workers=4, ordered=True,
+                                     batch_size=3))
+    assert rows == [(i,) for r in range(5) for i in range(1, 51) if i % 5 == r]
+    rows = list(tfd.dbutil.fanOutSQL(pool, queries, workers=2, tagged=True,
+                                     asdict=True))
+    assert len(rows) == 50
+    assert all(row['id'] % 5 == i for i, row in rows)
+    # closing the generator early returns the connections.
+    rows = tfd.dbutil.fanOutSQL(pool, queries, batch_size=1)
+    next(rows)
+    rows.close()
+    assert pool.stats()['in_use'] == 0
+
+
+def read_npy(path):
+    '''
+    Return the descr and values of a 1-d .npy file of i8, f8 or S values.
+    '''
+    with open(str(path), 'rb') as fh:
+        data = fh.read()
+    assert data[:8] == b'\x93NUMPY\x01\x00'
+    size, = struct.unpack('<H', data[8:10])
+    header = ast.literal_eval(data[10:10 + size].decode('latin-1'))
+    assert (10 + size) % 64 == 0
+    body = data[10 + size:]
+    descr, length = header['descr'], header['shape'][0]
+    if descr.startswith('|S'):
+        width = int(descr[2:])
+        values = [body[i:i + width].rstrip(b'\0') for i in range(0, width * length, width)]
+    else:
+        code = {'<i8': 'q', '<f8': 'd'}[descr]
+        values = list(struct.unpack('<{:d}{}'.format(length, code), body))
+    assert len(values) == length
+    return descr, values
+
+
+def test_export_sql(tmpdir):
+    conn = sqlite3.connect(str(tmpdir.join('export.db')))
+    tfd.dbutil.executeSQL(conn, 'CREATE TABLE t (id INTEGER, score REAL, name TEXT)', [])
+    rows = [(i, None if i == 3 else i / 2.0, None if i == 4 else u'n\t%s\xe9' % i)
+            for i in range(10)]
+    tfd.dbutil.executeManySQL(conn, 'INSERT INTO t VALUES (?, ?, ?)', rows)
+    sql = 'SELECT * FROM t ORDER BY id'
+
+    path = str(tmpdir.join('t.tsv.gz'))
+    assert tfd.dbutil.exportSQL(conn, sql, path, [], batch_size=3) == 10
+    lines = gzip.open(path).read().decode('utf-8').splitlines()
+    assert lines[0] == 'id\tscore\tname'
+    assert lines[4] == u'3\t\\N\tn\\\t3\xe9'
+    assert len(lines) == 11
+
+    path = str(tmpdir.join('t.csv.gz'))
+    tfd.dbutil.exportSQL(conn, sql, path, [], format='csv', header=False)
+    lines = gzip.open(path).read().decode('utf-8').splitlines()
+    assert lines[3] == u'3,,n\t3\xe9'
+    assert len(lines) == 10
+
+    path = tmpdir.join('t')
+    tfd.dbutil.exportSQL(conn, sql, str(path), [], format='npy', batch_size=4)
+    assert read_npy(path.join('id.npy')) == ('<i8', list(range(10)))
+    descr, scores = read_npy(path.join('score.npy'))
+    assert descr == '<f8' and math.isnan(scores[3]) and scores[9] == 4.5
+    descr, names = read_npy(path.join('name.npy'))
+    assert descr == '|S5' and names[4] == b'' and names[9] == u'n\t9\xe9'.encode('utf-8')
+    with pytest.raises(ValueError) as excinfo:
+        tfd.dbutil.exportSQL(conn, sql, str(path), [], format='npy',
+                             dtypes={'score': 'i8'})
+    # the error keeps the traceback of the writer thread.
+    assert excinfo.traceback[-1].name != 'exportSQL'
+
+
+def test_session_rollback_discards_deferred(tmpdir):
+    conn = sqlite3.connect(str(tmpdir.join('people.db')))
+    tfd.dbutil.executeSQL(conn, 'CREATE TABLE people (id INTEGER PRIMARY KEY, name TEXT)', [])
+    session = tfd.dbutil.Session(conn)
+    with pytest.raises(KeyError):
+        with session.doTransaction(start=False):
+            session.deferSQL('INSERT INTO people (name) VALUES (?)', ['a'])
+            raise KeyError()
+    assert session.selectSQL('SELECT COUNT(*) FROM people', []) == [(0,)]
+    conn.commit()
+    assert tfd.dbutil.selectSQL(conn, 'SELECT COUNT(*) FROM people', []) == [(0,)]
+
+    # module functions can use a session as conn without closing its cursor.
+    session.deferSQL('INSERT INTO people (name) VALUES (?)', ['b'])
+    assert tfd.dbutil.selectSQL(session, 'SELECT name FROM people', []) == [('b',)]
+    cursor = session._statementCursor('SELECT 1')
+    tfd.dbutil.executeSQL(session, 'UPDATE people SET name = ?', ['c'])
+    assert session._statementCursor('SELECT 1') is cursor
+    assert session.selectSQL('SELECT name FROM people', []) == [('c',)]
+
+
+def test_export_sql_floats(tmpdir):
+    conn = sqlite3.connect(str(tmpdir.join('export.db')))
+    tfd.dbutil.executeSQL(conn, 'CREATE TABLE t (x REAL)', [])
+    values = [0.1 + 0.2, 1 / 3.0, 1e-300]
+    tfd.dbutil.executeManySQL(conn, 'INSERT INTO t VALUES (?)', [(v,) for v in values])
+    path = str(tmpdir.join('t.tsv.gz'))
+    tfd.dbutil.exportSQL(conn, 'SELECT x FROM t', path, [], header=False)
+    lines = gzip.open(path).read().decode('utf-8').splitlines()
+    assert [float(line) for line in lines] == values
+
+
+def test_export_sql_empty_npy(tmpdir):
+    conn = sqlite3.connect(str(tmpdir.join('export.db')))
+    tfd.dbutil.executeSQL(conn, 'CREATE TABLE t (id INTEGER, name TEXT)', [])
+    path = tmpdir.join('t')
+    assert tfd.dbutil.exportSQL(conn, 'SELECT * FROM t', str(path), [],
+                                format='npy', dtypes={'id': 'i8'}) == 0
+    assert read_npy(path.join('id.npy')) == ('<i8', [])
+    assert read_npy(path.join('name.npy')) == ('|S1', [])
+
+
+def test_query_cache_invalidated_during_select(tmpdir, monkeypatch):
+    path = tmpdir.join('people.db')
+    make_people(path, num_people=3)
+    conn = sqlite3.connect(str(path))
+    cache = tfd.dbutil.QueryCache()
+    select = tfd.dbutil.selectSQL
+    def selectThenWrite(conn, sql, args=None, asdict=False):
+        # another thread writes and invalidates after these rows are read.
+        rows = select(conn, sql, args, asdict)
+        cache.updateSQL(conn, 'UPDATE people SET name = ? WHERE id = 1', ['x'])
+        return rows
+    sql = 'SELECT name FROM people WHERE id = ?'
+    monkeypatch.setattr(tfd.dbutil, 'selectSQL', selectThenWrite)
+    assert cache.selectSQL(conn, sql, [1]) == [('person1',)]
+    monkeypatch.setattr(tfd.dbutil, 'selectSQL', select)
+    assert cache.stats()['stale'] == 1
+    assert cache.selectSQL(conn, sql, [1]) == [('x',)]
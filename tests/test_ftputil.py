@@ -0,0 +1,299 @@
+
+
+import SocketServer
+import socket
+import threading
+import time
+
+import pytest
+
+import tfd.ftputil
+
+
+#############################
+# A LOCAL STAND-IN FTP SERVER
+
+# directories are dicts, files are their sizes.
+TREE = {
+    'pub': {
+        'README.TXT': 7254,
+        'geo': {
+            'DATA': {
+                'datasets_gi.txt.gz': 100,
+                'SOFT': {'a.soft': 1, 'b soft.txt': 2},
+                'MINiML': {},
+            },
+        },
+        'empty': {},
+    },
+}
+
+
+class FTPStandIn(SocketServer.ThreadingTCPServer):
+    '''
+    A tiny ftp server serving TREE, with just enough commands for ftplib
+    logins and directory listings.  It counts logins and records commands.
+    '''
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, tree=TREE, mlsd=True):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), FTPHandler)
+        self.tree = tree
+        self.mlsd = mlsd
+        self.logins = []
+        self.commands = []
+        self.sockets = []
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return 'ftp://127.0.0.1:{}'.format(self.server_address[1])
+
+    def drop(self):
+        '''
+        Close every open control connection, like a server timing them out.
+        '''
+        with self.lock:
+            sockets, self.sockets = self.sockets, []
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def close(self):
+        self.shutdown()
+        self.drop()
+        self.server_close()
+
+
+class FTPHandler(SocketServer.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write(line + '\r\n')
+        self.wfile.flush()
+
+    def resolve(self, cwd, arg):
+        path = arg if arg.startswith('/') else cwd.rstrip('/') + '/' + arg
+        node = self.server.tree
+        parts = [part for part in path.split('/') if part and part != '.']
+        for part in parts:
+            if not isinstance(node, dict) or part not in node:
+                return path, None
+            node = node[part]
+        return '/' + '/'.join(parts), node
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.sockets.append(self.request)
+        cwd = '/'
+        user = None
+        passive = None
+        self.reply('220 stand-in ready')
+        for line in iter(self.rfile.readline, ''):
+            cmd, sep, arg = line.rstrip('\r\n').partition(' ')
+            cmd = cmd.upper()
+            with server.lock:
+                server.commands.append((cmd, arg))
+            if cmd == 'USER':
+                user = arg
+                self.reply('331 password please')
+            elif cmd == 'PASS':
+                with server.lock:
+                    server.logins.append((user, arg))
+                self.reply('230 logged in')
+            elif cmd in ('NOOP', 'TYPE'):
+                self.reply('200 ok')
+            elif cmd == 'PWD':
+                self.reply('257 "{}"'.format(cwd))
+            elif cmd == 'CWD':
+                path, node = self.resolve(cwd, arg)
+                if isinstance(node, dict):
+                    cwd = path
+                    self.reply('250 ok')
+                else:
+                    self.reply('550 {}: No such file or directory'.format(arg))
+            elif cmd == 'FEAT':
+                if server.mlsd:
+                    self.reply('211-Features:\r\n MLST type*;size*;modify*;\r\n211 End')
+                else:
+                    self.reply('211 No features')
+            elif cmd == 'PASV':
+                passive = socket.socket()
+                passive.bind(('127.0.0.1', 0))
+                passive.listen(1)
+                port = passive.getsockname()[1]
+                self.reply('227 Entering Passive Mode (127,0,0,1,{},{})'.format(
+                    port // 256, port % 256))
+            elif cmd in ('LIST', 'MLSD'):
+                if cmd == 'MLSD' and not server.mlsd:
+                    self.reply('500 MLSD not understood')
+                    continue
+                if arg.endswith('/busy'):
+                    passive.close()
+                    self.reply('450 {}: file unavailable'.format(arg))
+                    continue
+                path, node = self.resolve(cwd, arg)
+                if not isinstance(node, dict):
+                    self.reply('550 {}: No such file or directory'.format(arg))
+                    continue
+                self.reply('150 here it comes')
+                data, address = passive.accept()
+                for name in sorted(node):
+                    data.sendall(self.entry(cmd, name, node[name]) + '\r\n')
+                data.close()
+                passive.close()
+                self.reply('226 done')
+            elif cmd == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('502 {} not implemented'.format(cmd))
+
+    def entry(self, cmd, name, node):
+        isdir = isinstance(node, dict)
+        if cmd == 'LIST':
+            return '{} 1 ftp ftp {:>8} Jan 01  2012 {}'.format(
+                'drwxr-xr-x' if isdir else '-rw-r--r--',
+                0 if isdir else node, name)
+        if isdir:
+            return 'type=dir;modify=20120101000000; {}'.format(name)
+        return 'type=file;size={};modify=20120102030405; {}'.format(node, name)
+
+
+@pytest.fixture
+def server(request):
+    server = FTPStandIn()
+    request.addfinalizer(server.close)
+    return server
+
+
+@pytest.fixture
+def pool(request, monkeypatch):
+    pool = tfd.ftputil.FTPPool(noop_after=0)
+    monkeypatch.setattr(tfd.ftputil, 'POOL', pool)
+    request.addfinalizer(pool.close)
+    return pool
+
+
+def test_listdir_and_isdir(server, pool):
+    assert tfd.ftputil.listdir(server.url + '/pub/geo/DATA') == (
+        server.url + '/pub/geo/DATA', ['MINiML', 'SOFT'], ['datasets_gi.txt.gz'])
+    assert tfd.ftputil.isdir(server.url + '/pub/geo')
+    assert not tfd.ftputil.isdir(server.url + '/pub/README.TXT')
+    names = [name for name, facts in tfd.ftputil.mlsd(server.url + '/pub')]
+    assert names == ['README.TXT', 'empty', 'geo']
+    # one login, reused for every call.
+    assert len(server.logins) == 1
+
+
+def test_pool_reconnects(server, pool):
+    tfd.ftputil.listdir(server.url + '/pub')
+    server.drop()
+    assert tfd.ftputil.isdir(server.url + '/pub')
+    assert len(server.logins) == 2
+    assert pool.stats['reconnects'] == 1
+
+
+def test_pool_keeps_connection_after_error_reply(server, pool):
+    with pytest.raises(tfd.ftputil.ftplib.error_temp):
+        tfd.ftputil.listdir(server.url + '/pub/busy')
+    tfd.ftputil.listdir(server.url + '/pub')
+    # a 450 reply is not a lost connection, so it is neither retried nor
+    # discarded.
+    assert len(server.logins) == 1
+    assert pool.stats['reconnects'] == pool.stats['discarded'] == 0
+    assert [cmd for cmd, arg in server.commands].count('MLSD') == 2
+
+
+def test_pool_keepalive(server):
+    pool = tfd.ftputil.FTPPool(noop_after=None, keepalive=0.05, max_idle_time=0.5)
+    try:
+        pool.checkin(pool.checkout(server.url))
+        time.sleep(0.2)
+        # kept alive with NOOPs, which refresh when it was last known alive.
+        [(ftp, used, alive)] = pool._idle.values()[0]
+        assert ('NOOP', '') in server.commands
+        assert alive > used
+        time.sleep(0.6)
+        # but it is still closed once idle for max_idle_time.
+        assert pool._idle.values() == [[]]
+        assert ('QUIT', '') in server.commands
+    finally:
+        pool.close()
+
+
+def test_pool_credentials(server, pool):
+    url = server.url.replace('ftp://', 'ftp://jane:secret@')
+    tfd.ftputil.listdir(url + '/pub')
+    tfd.ftputil.listdir(server.url + '/pub', username='joe', password='pw')
+    tfd.ftputil.listdir(server.url + '/pub', username='joe', password='pw')
+    assert server.logins == [('jane', 'secret'), ('joe', 'pw')]
+
+
+def test_walk(server, pool):
+    url = server.url + '/pub'
+    results = list(tfd.ftputil.walk(url, username='joe', password='pw'))
+    assert [r[0] for r in results] == [
+        url, url + '/empty', url + '/geo', url + '/geo/DATA',
+        url + '/geo/DATA/MINiML', url + '/geo/DATA/SOFT']
+    assert results[-1][2] == ['a.soft', 'b soft.txt']
+    # credentials are used for the subdirectories too.
+    assert set(server.logins) == set([('joe', 'pw')])
+    assert len(list(tfd.ftputil.walk(url, depth=1))) == 3
+
+
+def test_parallel_walk(server, pool):
+    url = server.url + '/pub'
+    expected = list(tfd.ftputil.walk(url))
+    results = list(tfd.ftputil.parallel_walk(url, workers=3))
+    assert sorted(results) == sorted(expected)
+    assert list(tfd.ftputil.parallel_walk(url, workers=3, ordered=True)) == expected
+    assert (list(tfd.ftputil.parallel_walk(url, depth=1, ordered=True, rate=100)) ==
+            list(tfd.ftputil.walk(url, depth=1)))
+    assert len(server.logins) <= 4
+    with pytest.raises(tfd.ftputil.ftplib.error_perm):
+        list(tfd.ftputil.parallel_walk(url + '/README.TXT'))
+
+
+def test_list_entries(server, pool):
+    url = server.url + '/pub/geo/DATA'
+    entries = tfd.ftputil.list_entries(url)
+    assert [(e.name, e.type) for e in entries] == [
+        ('MINiML', 'dir'), ('SOFT', 'dir'), ('datasets_gi.txt.gz', 'file')]
+    assert entries[2].size == 100
+    assert entries[2].modify == tfd.ftputil.datetime.datetime(2012, 1, 2, 3, 4, 5)
+    tfd.ftputil.listdir(url + '/SOFT')
+    commands = [cmd for cmd, arg in server.commands]
+    # one FEAT per server and no CWD per listing.
+    assert commands.count('FEAT') == 1 and 'CWD' not in commands
+    assert ('MLSD', '/pub/geo/DATA/SOFT') in server.commands
+
+
+def test_list_time():
+    datetime = tfd.ftputil.datetime.datetime
+    now = datetime(2013, 3, 15, 12, 0)
+    assert tfd.ftputil._list_time('Jan', '01', '2012', now) == datetime(2012, 1, 1)
+    assert tfd.ftputil._list_time('Mar', '1', '09:30', now) == datetime(2013, 3, 1, 9, 30)
+    # recent dates after now are from last year.
+    assert tfd.ftputil._list_time('Dec', '31', '23:59', now) == datetime(2012, 12, 31, 23, 59)
+    assert tfd.ftputil._list_time('Foo', '1', '2012', now) is None
+
+
+def test_list_entries_without_mlsd(pool):
+    server = FTPStandIn(mlsd=False)
+    try:
+        entries = tfd.ftputil.list_entries(server.url + '/pub/geo/DATA/SOFT')
+        jan1 = tfd.ftputil.datetime.datetime(2012, 1, 1)
+        assert entries == [tfd.ftputil.Entry('a.soft', 'file', 1, jan1, {}),
+                           tfd.ftputil.Entry('b soft.txt', 'file', 2, jan1, {})]
+        assert tfd.ftputil.listdir(server.url + '/pub')[1:] == (['empty', 'geo'], ['README.TXT'])
+        commands = [cmd for cmd, arg in server.commands]
+        assert commands.count('FEAT') == 1 and 'MLSD' not in commands
+    finally:
+        server.close()
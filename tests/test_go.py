@@ -1,6 +1,12 @@
 
 
 import datetime
+import gzip
+import math
+import os
+import tarfile
+
+import pytest
 
 import tfd.go
 
@@ -10,3 +16,612 @@ def test_guess_latest_full_release():
     assert '2012-06-01' == tfd.go.guess_latest_release(datetime.date(2012, 07, 03))
 
 
+#########################
+# A TINY RELEASE FOR TESTS
+
+TERM_SQL = '''DROP TABLE IF EXISTS `term`;
+CREATE TABLE `term` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `name` varchar(255) NOT NULL DEFAULT '',
+  `term_type` varchar(55) NOT NULL,
+  `acc` varchar(255) NOT NULL,
+  `is_obsolete` int(11) NOT NULL DEFAULT '0',
+  `is_root` int(11) NOT NULL DEFAULT '0',
+  `is_relation` int(11) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `acc` (`acc`),
+  KEY `t1` (`name`)
+) ENGINE=MyISAM AUTO_INCREMENT=10 DEFAULT CHARSET=latin1;
+'''
+
+TERM2TERM_SQL = '''CREATE TABLE `term2term` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `relationship_type_id` int(11) NOT NULL,
+  `term1_id` int(11) NOT NULL,
+  `term2_id` int(11) NOT NULL,
+  `complete` int(11) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`id`)
+) ENGINE=MyISAM;
+'''
+
+GRAPH_PATH_SQL = '''CREATE TABLE `graph_path` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `term1_id` int(11) NOT NULL,
+  `term2_id` int(11) NOT NULL,
+  `relationship_type_id` int(11) DEFAULT NULL,
+  `distance` int(11) DEFAULT NULL,
+  `relation_distance` int(11) DEFAULT NULL,
+  PRIMARY KEY (`id`)
+) ENGINE=MyISAM;
+'''
+
+TERM_SYNONYM_SQL = '''CREATE TABLE `term_synonym` (
+  `term_id` int(11) NOT NULL,
+  `term_synonym` varchar(996) DEFAULT NULL,
+  `acc_synonym` varchar(255) DEFAULT NULL,
+  `synonym_type_id` int(11) NOT NULL,
+  `synonym_category_id` int(11) DEFAULT NULL,
+  UNIQUE KEY `term_id` (`term_id`,`term_synonym`)
+) ENGINE=MyISAM;
+'''
+
+GENE_PRODUCT_SQL = '''CREATE TABLE `gene_product` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `symbol` varchar(128) NOT NULL,
+  `dbxref_id` int(11) NOT NULL,
+  `species_id` int(11) DEFAULT NULL,
+  `type_id` int(11) DEFAULT NULL,
+  `full_name` text,
+  PRIMARY KEY (`id`)
+) ENGINE=MyISAM;
+'''
+
+ASSOCIATION_SQL = '''CREATE TABLE `association` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `term_id` int(11) NOT NULL,
+  `gene_product_id` int(11) NOT NULL,
+  `is_not` int(11) DEFAULT NULL,
+  `role_group` int(11) DEFAULT NULL,
+  `assocdate` int(11) DEFAULT NULL,
+  `source_db_id` int(11) DEFAULT NULL,
+  PRIMARY KEY (`id`)
+) ENGINE=MyISAM;
+'''
+
+# ids 1 and 2 are relations.  Under biological_process (3):
+#   4 is_a 3, 5 is_a 3, 6 is_a 4, 6 is_a 5, 7 part_of 6
+# 8 is a second root and 9 is obsolete.
+TERM_TXT = '''1\tis_a\texternal\tis_a\t0\t0\t1
+2\tpart_of\texternal\tpart_of\t0\t0\t1
+3\tbiological_process\tbiological_process\tGO:0008150\t0\t1\t0
+4\tcellular process\tbiological_process\tGO:0009987\t0\t0\t0
+5\tmetabolic process\tbiological_process\tGO:0008152\t0\t0\t0
+6\tcellular metabolic process\tbiological_process\tGO:0044237\t0\t0\t0
+7\ttranslation\tbiological_process\tGO:0006412\t0\t0\t0
+8\tmolecular_function\tmolecular_function\tGO:0003674\t0\t1\t0
+9\tobsolete thing\tbiological_process\tGO:0000001\t1\t0\t0
+'''
+
+TERM2TERM_TXT = '''1\t1\t3\t4\t0
+2\t1\t3\t5\t0
+3\t1\t4\t6\t0
+4\t1\t5\t6\t0
+5\t2\t6\t7\t0
+'''
+
+GRAPH_PATH_ROWS = [(3, 3, 1, 0), (4, 4, 1, 0), (5, 5, 1, 0), (6, 6, 1, 0),
+                   (7, 7, 1, 0), (8, 8, 1, 0), (9, 9, 1, 0),
+                   (3, 4, 1, 1), (3, 5, 1, 1), (4, 6, 1, 1), (5, 6, 1, 1),
+                   (3, 6, 1, 2), (6, 7, 2, 1), (4, 7, 2, 2), (5, 7, 2, 2),
+                   (3, 7, 2, 3)]
+GRAPH_PATH_TXT = ''.join('{}\t{}\t{}\t{}\t{}\t\\N\n'.format(i + 1, *row)
+                         for i, row in enumerate(GRAPH_PATH_ROWS))
+
+TERM_SYNONYM_TXT = '''7\tprotein biosynthesis\t\\N\t1\t\\N
+7\tprotein translation\t\\N\t1\t\\N
+5\tmetabolism\tGO:0044236\t1\t\\N
+'''
+
+GENE_PRODUCT_TXT = '''1\tgeneA\t1\t1\t1\tgene A
+2\tgeneB\t2\t1\t1\tgene B\\\twith tab
+3\tgeneC\t3\t1\t1\t\\N
+4\tgeneD\t4\t1\t1\tgene D\\\nsecond line\\\\
+'''
+
+# geneA: translation.  geneB: cellular process.  geneC: metabolic process
+# and NOT translation.  geneD: molecular_function.
+ASSOCIATION_TXT = '''1\t7\t1\t0\t\\N\t20120101\t1
+2\t4\t2\t0\t\\N\t20120101\t1
+3\t5\t3\t0\t\\N\t20120101\t1
+4\t7\t3\t1\t\\N\t20120101\t1
+5\t8\t4\t0\t\\N\t20120101\t1
+'''
+
+RELEASE_TABLES = {
+    'term': (TERM_SQL, TERM_TXT),
+    'term2term': (TERM2TERM_SQL, TERM2TERM_TXT),
+    'graph_path': (GRAPH_PATH_SQL, GRAPH_PATH_TXT),
+    'term_synonym': (TERM_SYNONYM_SQL, TERM_SYNONYM_TXT),
+    'gene_product': (GENE_PRODUCT_SQL, GENE_PRODUCT_TXT),
+    'association': (ASSOCIATION_SQL, ASSOCIATION_TXT),
+}
+
+
+def make_release(release_dir, tables=RELEASE_TABLES):
+    '''
+    Write the .sql and .txt files of tables into release_dir and return
+    release_dir.
+    '''
+    if not os.path.exists(release_dir):
+        os.makedirs(release_dir)
+    for table, (sql, txt) in tables.items():
+        with open(os.path.join(release_dir, table + '.sql'), 'w') as fh:
+            fh.write(sql)
+        with open(os.path.join(release_dir, table + '.txt'), 'w') as fh:
+            fh.write(txt)
+    return release_dir
+
+
+###############
+# TABLE READING
+
+def test_parse_table_schema():
+    assert tfd.go.parse_table_schema(TERM2TERM_SQL) == (
+        ('id', 'int'), ('relationship_type_id', 'int'), ('term1_id', 'int'),
+        ('term2_id', 'int'), ('complete', 'int'))
+    assert tfd.go.parse_table_schema(GENE_PRODUCT_SQL)[-1] == ('full_name', 'text')
+
+
+def test_table_tuples_and_records(tmpdir):
+    go = tfd.go.GeneOntology(make_release(str(tmpdir)))
+    assert go.term_table_fields() == ('id', 'name', 'term_type', 'acc',
+                                      'is_obsolete', 'is_root', 'is_relation')
+    terms = list(go.term_table_tuples())
+    assert terms[2] == (3, 'biological_process', 'biological_process',
+                        'GO:0008150', 0, 1, 0)
+    assert list(go.term_table_dicts())[6]['name'] == 'translation'
+    synonyms = list(go.table_records('term_synonym'))
+    assert synonyms[0].term_synonym == 'protein biosynthesis'
+    assert synonyms[0].acc_synonym is None
+    assert synonyms[2].acc_synonym == 'GO:0044236'
+    products = list(go.table_tuples('gene_product'))
+    assert products[1][-1] == 'gene B\twith tab'
+    assert products[2][-1] is None
+    assert products[3][-1] == 'gene D\nsecond line\\'
+
+
+def test_table_columns(tmpdir):
+    go = tfd.go.GeneOntology(make_release(str(tmpdir)))
+    columns = go.table_columns('graph_path')
+    assert columns.keys() == list(go.table_fields('graph_path'))
+    assert columns['term1_id'].typecode == 'l'
+    assert list(columns['term2_id'][-3:]) == [7, 7, 7]
+    assert columns['relation_distance'] == [None] * len(GRAPH_PATH_ROWS)
+
+
+def test_read_table_chunks_escapes(tmpdir):
+    path = str(tmpdir.join('escapes.txt'))
+    with open(path, 'w') as fh:
+        # mysqldump escapes a tab or newline as a backslash and the literal
+        # character.  The two-character forms are read too.
+        fh.write('1\ta\\\tb\tx\n'
+                 '2\tc\\\nd\\\\\ty\n'
+                 '3\te\\nf\t\\N\n')
+    expected = [[1, 2, 3], ['a\tb', 'c\nd\\', 'e\nf'], ['x', 'y', None]]
+    for chunk_size in (1, 1 << 20):
+        chunks = list(tfd.go.read_table_chunks(path, (int, str, str), chunk_size))
+        assert [sum(map(list, column), []) for column in zip(*chunks)] == expected
+
+
+def test_read_table_chunks_bad_row(tmpdir):
+    path = str(tmpdir.join('bad.txt'))
+    with open(path, 'w') as fh:
+        fh.write('1\ta\n2\n')
+    try:
+        list(tfd.go.read_table_chunks(path, (int, str)))
+    except ValueError:
+        pass
+    else:
+        assert False, 'Expected ValueError for short row.'
+
+
+###################
+# ONTOLOGY GRAPH
+
+def test_graph_ancestors_descendants(tmpdir):
+    go = tfd.go.GeneOntology(make_release(str(tmpdir)))
+    for source in ('graph_path', 'term2term'):
+        graph = go.graph(source=source)
+        assert graph.ancestors('GO:0006412') == [
+            'GO:0008150', 'GO:0008152', 'GO:0009987', 'GO:0044237']
+        assert graph.descendants('GO:0008152') == ['GO:0006412', 'GO:0044237']
+        assert graph.ancestors('GO:0008150') == []
+        assert graph.ancestors('GO:0000001') == []
+    assert go.graph().parents('GO:0006412') == [('GO:0044237', 'part_of')]
+    assert sorted(go.graph().children('GO:0008150')) == [
+        ('GO:0008152', 'is_a'), ('GO:0009987', 'is_a')]
+
+
+def test_graph_relations(tmpdir):
+    go = tfd.go.GeneOntology(make_release(str(tmpdir)))
+    assert go.ancestors('GO:0006412', relations=['is_a']) == []
+    assert go.descendants('GO:0008150', relations=['is_a']) == [
+        'GO:0008152', 'GO:0009987', 'GO:0044237']
+    assert 'GO:0006412' in go.descendants('GO:0008150')
+    with pytest.raises(ValueError):
+        go.graph(relations=['is_a'], source='graph_path')
+
+
+def test_graph_lowest_common_ancestors(tmpdir):
+    go = tfd.go.GeneOntology(make_release(str(tmpdir)))
+    assert go.lowest_common_ancestors('GO:0009987', 'GO:0008152') == [
+        'GO:0008150']
+    assert go.lowest_common_ancestors('GO:0006412', 'GO:0008152') == [
+        'GO:0008152']
+    assert go.lowest_common_ancestors('GO:0006412', 'GO:0003674') == []
+    graph = go.graph()
+    assert graph.propagate(['GO:0009987']) == set(['GO:0009987', 'GO:0008150'])
+
+
+def test_graph_cycle():
+    try:
+        tfd.go.build_term_graph(['a', 'b'], ['is_a'], [(0, 1, 0), (1, 0, 0)])
+    except ValueError:
+        pass
+    else:
+        assert False, 'Expected ValueError for cycle.'
+
+
+###########################
+# ANNOTATIONS AND ENRICHMENT
+
+def test_associations(tmpdir):
+    go = tfd.go.GeneOntology(make_release(str(tmpdir)))
+    index = go.associations()
+    assert index.terms(1) == ['GO:0006412', 'GO:0008150', 'GO:0008152',
+                              'GO:0009987', 'GO:0044237']
+    # the NOT annotation of geneC to translation is ignored.
+    assert index.terms(3) == ['GO:0008150', 'GO:0008152']
+    assert index.genes('GO:0008150') == [1, 2, 3]
+    assert index.genes('GO:0006412') == [1]
+
+
+def test_enrichment(tmpdir):
+    go = tfd.go.GeneOntology(make_release(str(tmpdir)))
+    results = go.enrichment([[1, 3], [4, 99]], min_count=1,
+                            correction='bonferroni')
+    by_acc = dict((e.acc, e) for e in results[0])
+    metabolic = by_acc['GO:0008152']
+    assert (metabolic.count, metabolic.list_size, metabolic.term_size,
+            metabolic.population_size) == (2, 2, 2, 4)
+    assert abs(metabolic.p_value - 1 / 6.0) < 1e-12
+    assert abs(by_acc['GO:0008150'].p_value - 0.5) < 1e-12
+    assert metabolic.q_value == min(1.0, metabolic.p_value * len(results[0]))
+    assert results[0][0].p_value <= results[0][-1].p_value
+    assert [e.acc for e in results[1]] == ['GO:0003674']
+    assert abs(results[1][0].p_value - 0.25) < 1e-12
+    # a smaller background changes the population counts.
+    results = go.enrichment([[1]], background=[1, 2], min_count=1)
+    by_acc = dict((e.acc, e) for e in results[0])
+    assert by_acc['GO:0008150'].population_size == 2
+    assert by_acc['GO:0008150'].p_value == 1.0
+
+
+def test_benjamini_hochberg():
+    q_values = tfd.go.benjamini_hochberg([0.01, 0.04, 0.03, 0.2])
+    expected = [0.04, 0.04 * 4 / 3, 0.04 * 4 / 3, 0.2]
+    assert all(abs(q - e) < 1e-12 for q, e in zip(q_values, expected))
+
+
+#####################
+# SEMANTIC SIMILARITY
+
+def test_semantic_similarity(tmpdir):
+    go = tfd.go.GeneOntology(make_release(str(tmpdir)))
+    sim = go.similarity()
+    assert sim is go.similarity()
+    ic_metabolic = math.log(3 / 2.0)
+    ic_translation = math.log(3)
+    assert abs(sim.resnik('GO:0006412', 'GO:0008152') - ic_metabolic) < 1e-12
+    assert sim.resnik('GO:0009987', 'GO:0008152') == 0.0
+    assert sim.lin('GO:0009987', 'GO:0008152') == 0.0
+    assert abs(sim.lin('GO:0006412', 'GO:0008152') -
+               2 * ic_metabolic / (ic_metabolic + ic_translation)) < 1e-12
+    assert abs(sim.jiang_conrath('GO:0006412', 'GO:0006412') - 1.0) < 1e-12
+    assert sim.resnik('GO:0006412', 'GO:0003674') == 0.0
+    assert abs(sim.gene_similarity(1, 3) - ic_metabolic) < 1e-12
+    # the term pair cache is bounded.
+    small = tfd.go.SemanticSimilarity(go.associations(), cache_size=2)
+    assert small.pairwise([1, 2, 3, 4]) == sim.pairwise([1, 2, 3, 4])
+    assert len(small._cache) == 2
+
+
+def test_pairwise_similarity(tmpdir):
+    go = tfd.go.GeneOntology(make_release(str(tmpdir)))
+    sim = go.similarity()
+    matrix = sim.pairwise([1, 2, 3, 4], method='lin')
+    assert matrix == sim.pairwise([1, 2, 3, 4], method='lin', processes=2)
+    assert matrix[0][2] == matrix[2][0] == sim.gene_similarity(1, 3, 'lin')
+    assert matrix[3][0] == 0.0
+
+
+#################
+# SQLITE DATABASE
+
+def test_load_sqlite(tmpdir):
+    release_dir = make_release(str(tmpdir))
+    path = tfd.go.load_sqlite(release_dir, batch_size=2)
+    assert path == tfd.go.sqlite_file(release_dir)
+    text = tfd.go.GeneOntology(release_dir)
+    db = tfd.go.GeneOntology(release_dir, db_path=path)
+    for table in tfd.go.release_tables(release_dir):
+        assert list(db.table_tuples(table)) == list(text.table_tuples(table))
+    assert db.ancestors('GO:0006412') == text.ancestors('GO:0006412')
+    rows = db.query('SELECT t.acc FROM term t JOIN term2term r '
+                    'ON t.id = r.term2_id WHERE r.term1_id = ? '
+                    'ORDER BY t.acc', [3])
+    assert rows == [('GO:0008152',), ('GO:0009987',)]
+    indexes = db.query("SELECT name FROM sqlite_master WHERE type = 'index'")
+    assert ('term_acc_idx',) in indexes
+    assert ('association_gene_product_id_idx',) in indexes
+
+    # a failed load leaves neither the database nor its temporary file.
+    failed = str(tmpdir.join('failed.db'))
+    with pytest.raises(Exception):
+        tfd.go.load_sqlite(release_dir, failed, tables=['term', 'no_such_table'])
+    assert not [name for name in os.listdir(str(tmpdir)) if name.startswith('failed.db')]
+
+
+#########
+# INSTALL
+
+def make_tarball(tmpdir, release='2012-06-01', dataset='termdb'):
+    '''
+    Write a release tarball like the ones in the GO archive and return a
+    file:// url for it.
+    '''
+    basename = tfd.go.tables_basename(release, dataset)
+    release_dir = make_release(str(tmpdir.join('src', basename[:-7])))
+    path = str(tmpdir.join(basename))
+    tar = tarfile.open(path, 'w:gz')
+    tar.add(release_dir, arcname=basename[:-7])
+    tar.close()
+    return 'file://' + path
+
+
+def test_install_in_dir(tmpdir):
+    url = make_tarball(tmpdir)
+    root = str(tmpdir.join('root'))
+    release_dir = tfd.go.install_in_dir(root, '2012-06-01', url=url,
+                                        tables=['term', 'term2term'],
+                                        convert=True)
+    assert release_dir == tfd.go.tables_dir(root, '2012-06-01')
+    assert sorted(os.listdir(release_dir)) == [
+        'term.columns', 'term.sql', 'term.txt', 'term2term.columns',
+        'term2term.sql', 'term2term.txt']
+    go = tfd.go.GeneOntology(release_dir)
+    assert go.table_columns('term')['acc'][3] == 'GO:0009987'
+    assert go.ancestors('GO:0044237') == ['GO:0008150', 'GO:0008152',
+                                          'GO:0009987']
+    # reinstalling replaces the release dir.
+    tfd.go.install_in_dir(root, '2012-06-01', url=url)
+    assert 'graph_path.txt' in os.listdir(release_dir)
+    assert 'term.columns' not in os.listdir(release_dir)
+    assert os.listdir(root) == [os.path.basename(release_dir)]
+    # reinstalling a subset of tables drops the others.
+    tfd.go.install_in_dir(root, '2012-06-01', url=url, tables=['term'])
+    assert sorted(os.listdir(release_dir)) == ['term.sql', 'term.txt']
+
+
+def test_unpack_tables_duplicate_names(tmpdir):
+    src = tmpdir.join('src')
+    src.join('a', 'term.txt').write('1\n', ensure=True)
+    src.join('b', 'term.txt').write('2\n', ensure=True)
+    path = str(tmpdir.join('dup.tar.gz'))
+    tar = tarfile.open(path, 'w:gz')
+    tar.add(str(src), arcname='release')
+    tar.close()
+    with pytest.raises(Exception):
+        tfd.go.unpack_tables('file://' + path, str(tmpdir.mkdir('dest')))
+
+
+def test_release_cache(tmpdir, monkeypatch):
+    monkeypatch.delenv(tfd.go.CACHE_ENV_VAR, raising=False)
+    url = make_tarball(tmpdir)
+    cache = tfd.go.ReleaseCache(str(tmpdir.join('cache')))
+    assert cache.lookup('2012-06-01') is None
+    release_dir = tfd.go.install_in_dir(str(tmpdir.join('root')),
+                                        '2012-06-01', url=url, cache=cache)
+    assert os.path.dirname(release_dir) == cache.root
+    assert not os.path.exists(str(tmpdir.join('root')))
+    assert cache.releases() == ['2012-06-01']
+    # cache hits do not download.
+    os.remove(url[len('file://'):])
+    assert tfd.go.install_in_dir(release='2012-06-01', url=url,
+                                 cache=cache) == release_dir
+    monkeypatch.setenv(tfd.go.CACHE_ENV_VAR, cache.root)
+    assert tfd.go.tables_dir('/elsewhere', '2012-06-01') == release_dir
+    assert tfd.go.guess_latest_release(datetime.date(2012, 06, 15)) == '2012-06-01'
+    assert tfd.go.guess_latest_release(datetime.date(2012, 8, 15)) == '2012-07-01'
+    # a modified release is not a hit.
+    with open(os.path.join(release_dir, 'term.txt'), 'a') as fh:
+        fh.write('10\tnew\tbiological_process\tGO:0000010\t0\t0\t0\n')
+    assert cache.lookup('2012-06-01') is None
+    assert tfd.go.tables_dir('/elsewhere', '2012-06-01', cache=False) == (
+        '/elsewhere/go_201206-termdb-tables')
+
+
+def test_download(tmpdir, monkeypatch):
+    monkeypatch.setattr(tfd.go, 'MIN_SEGMENT_SIZE', 1000)
+    src = str(tmpdir.join('src.bin'))
+    data = ''.join(chr(i % 251) for i in xrange(100000))
+    with open(src, 'wb') as fh:
+        fh.write(data)
+    url = 'file://' + src
+    dest = str(tmpdir.join('dest.bin'))
+    # a part left by an interrupted download is resumed.
+    with open('{}.part-100000-1of4'.format(dest), 'wb') as fh:
+        fh.write(data[25000:30000])
+    reports = []
+    tfd.go.download(url, dest, segments=4,
+                    progress=lambda *args: reports.append(args))
+    with open(dest, 'rb') as fh:
+        assert fh.read() == data
+    assert reports[-1][:2] == (100000, 100000)
+    assert sorted(os.listdir(str(tmpdir))) == ['dest.bin', 'src.bin']
+
+
+def test_download_empty_file_and_errors(tmpdir, monkeypatch):
+    src = tmpdir.join('empty.bin')
+    src.write('')
+    dest = str(tmpdir.join('dest.bin'))
+    tfd.go.download('file://' + str(src), dest, segments=4)
+    assert os.path.getsize(dest) == 0
+    assert sorted(os.listdir(str(tmpdir))) == ['dest.bin', 'empty.bin']
+
+    # the error of a failed segment is raised with its own traceback.
+    def fail_to_fetch(*args):
+        raise KeyError('boom')
+    monkeypatch.setattr(tfd.go, '_fetch_range', fail_to_fetch)
+    with pytest.raises(KeyError) as excinfo:
+        tfd.go.download('file://' + str(src), dest, retries=0)
+    assert excinfo.traceback[-1].name == 'fail_to_fetch'
+
+
+def test_install_in_dir_segments(tmpdir):
+    url = make_tarball(tmpdir)
+    root = str(tmpdir.join('root'))
+    release_dir = tfd.go.install_in_dir(root, '2012-06-01', url=url,
+                                        segments=2)
+    assert os.listdir(root) == [os.path.basename(release_dir)]
+    go = tfd.go.GeneOntology(release_dir)
+    assert len(list(go.term_table_tuples())) == 9
+
+
+###############
+# RELEASE DIFFS
+
+def test_diff_releases(tmpdir):
+    old_dir = make_release(str(tmpdir.join('old')))
+    tables = dict(RELEASE_TABLES)
+    term_txt = (TERM_TXT.replace('cellular process', 'cellular proc')
+                .replace('\tGO:0044237\t0', '\tGO:0044237\t1') +
+                '10\tnew thing\tbiological_process\tGO:0000010\t0\t0\t0\n')
+    tables['term'] = (TERM_SQL, term_txt.replace('\tGO:0003674', '\tGO:0005554'))
+    # translation becomes part_of metabolic process, and the obsoleted
+    # cellular metabolic process loses its is_a parents.
+    term2term_txt = (TERM2TERM_TXT.replace('5\t2\t6\t7', '5\t2\t5\t7')
+                     .replace('3\t1\t4\t6\t0\n', '')
+                     .replace('4\t1\t5\t6\t0\n', ''))
+    tables['term2term'] = (TERM2TERM_SQL, term2term_txt)
+    # geneB is also annotated to metabolic process.
+    tables['association'] = (ASSOCIATION_SQL, ASSOCIATION_TXT +
+                             '6\t5\t2\t0\t\\N\t20120101\t1\n')
+    new_dir = make_release(str(tmpdir.join('new')), tables)
+    tfd.go.write_table_cache(new_dir, 'association')
+    diff = tfd.go.diff_releases(old_dir, new_dir)
+    assert diff.new == ['GO:0000010', 'GO:0005554']
+    assert diff.removed == ['GO:0003674']
+    assert diff.obsoleted == ['GO:0044237']
+    assert diff.renamed == ['GO:0009987']
+    assert diff.reparented == ['GO:0006412', 'GO:0044237']
+    assert diff.associations == ['GO:0003674', 'GO:0005554', 'GO:0008152']
+    assert tfd.go.diff_releases(old_dir, old_dir) == tfd.go.ReleaseDiff(
+        [], [], [], [], [], [])
+
+
+#################
+# SHARED RELEASES
+
+def test_shared_release(tmpdir):
+    release_dir = make_release(str(tmpdir))
+    go = tfd.go.GeneOntology(release_dir)
+    path = go.export_shared()
+    assert path == tfd.go.shared_file(release_dir)
+    worker = tfd.go.GeneOntology(release_dir).attach_shared()
+    graph = worker.graph()
+    assert isinstance(graph.ancestor_idx, tfd.go.MappedArray)
+    assert list(graph.accs) == list(go.graph().accs)
+    assert 'GO:0006412' in graph and 'GO:9999999' not in graph
+    for acc in graph.accs:
+        assert worker.ancestors(acc) == go.ancestors(acc)
+        assert worker.descendants(acc) == go.descendants(acc)
+        assert graph.parents(acc) == go.graph().parents(acc)
+    assert worker.lowest_common_ancestors('GO:0006412', 'GO:0009987') == [
+        'GO:0009987']
+    assert worker.associations().terms(3) == go.associations().terms(3)
+    assert worker.associations().symbols[1] == 'geneB'
+    assert (worker.enrichment([[1, 3]], min_count=1) ==
+            go.enrichment([[1, 3]], min_count=1))
+    assert (worker.similarity().pairwise([1, 2, 3, 4]) ==
+            go.similarity().pairwise([1, 2, 3, 4]))
+    # similarity reads the shared arrays instead of copying them.
+    assert worker.similarity().graph is graph
+    assert worker.similarity().ic == go.similarity().ic
+    # bitsets are computed in this process for a shared graph too.
+    assert worker.graph(bitsets=True)._ancestor_bits
+
+
+def test_shared_release_null_symbols(tmpdir):
+    go = tfd.go.GeneOntology(make_release(str(tmpdir)))
+    associations = go.associations()
+    associations.symbols = [None, 'geneB', None, '']
+    path = tfd.go.write_shared(str(tmpdir.join('go.shared')), go.graph(),
+                               associations)
+    graph, shared = tfd.go.attach_shared(path)
+    assert list(shared.symbols) == [None, 'geneB', None, '']
+
+
+#############
+# TERM SEARCH
+
+def test_search(tmpdir):
+    release_dir = make_release(str(tmpdir))
+    go = tfd.go.GeneOntology(release_dir)
+    results = go.search('metabolic')
+    assert [r.acc for r in results] == ['GO:0008152', 'GO:0044237']
+    assert [r.match for r in results] == ['prefix', 'token']
+    assert go.search('Metabolic  Process')[0] == tfd.go.SearchResult(
+        'GO:0008152', 'metabolic process', 'exact', 'metabolic process')
+    # synonyms, partial last tokens and accs.
+    assert go.search('protein trans')[0].acc == 'GO:0006412'
+    assert go.search('protein trans')[0].match == 'synonym_prefix'
+    assert [r.acc for r in go.search('cellular metab')] == ['GO:0044237']
+    assert go.search('GO:0008150')[0].match == 'exact'
+    assert [r.acc for r in go.search('go:000815')] == ['GO:0008152', 'GO:0008150']
+    assert go.search('metabolism')[0].match == 'exact_synonym'
+    assert go.search('nothing like it') == []
+    # the index is persisted and reloaded.
+    assert os.path.exists(tfd.go.search_index_file(release_dir))
+    again = tfd.go.GeneOntology(release_dir)
+    assert again.search('metabolic') == results
+
+
+##########
+# GO SLIMS
+
+def test_map_to_slim(tmpdir):
+    go = tfd.go.GeneOntology(make_release(str(tmpdir)))
+    gaf = str(tmpdir.join('test.gaf.gz'))
+    fh = gzip.open(gaf, 'wb')
+    fh.write('!gaf-version: 2.0\n')
+    for db_id, qualifier, acc in [('P1', '', 'GO:0006412'),
+                                  ('P1', '', 'GO:0009987'),
+                                  ('P2', 'NOT', 'GO:0006412'),
+                                  ('P2', '', 'GO:0008152'),
+                                  ('P3', '', 'GO:0003674'),
+                                  ('P3', '', 'GO:1234567')]:
+        fh.write('\t'.join(['UniProtKB', db_id, db_id, qualifier, acc,
+                            'PMID:1', 'IDA', '', 'P']) + '\n')
+    fh.close()
+    slim = ['GO:0008152', 'GO:0009987', 'GO:0008150']
+    expected = {
+        'UniProtKB:P1': {'GO:0008152': 1, 'GO:0009987': 2, 'GO:0008150': 2},
+        'UniProtKB:P2': {'GO:0008152': 1, 'GO:0008150': 1},
+    }
+    assert go.map_to_slim(slim, tfd.go.read_gaf(gaf)) == expected
+    graph = go.graph()
+    assert tfd.go.map_to_slim(graph, slim, tfd.go.read_gaf(gaf),
+                              processes=2, chunk_size=2) == expected
+    # no whole-ontology bitsets are cached on the graph.
+    assert graph._ancestor_bits == {}
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+
+'''
+asyncio counterparts of the dbutil functions, for code running in an event
+loop.  The blocking dbutil calls run on a fixed number of worker threads,
+each of which checks out connections from a dbutil.ConnectionPool, so
+concurrent queries overlap their database latency without blocking the
+event loop:
+
+    db = AsyncDB(dbutil.ConnectionPool(open_conn, max_size=8))
+    people, pets = loop.run_until_complete(asyncio.gather(
+        db.selectSQL('SELECT * FROM people'),
+        db.selectSQL('SELECT * FROM pets')))
+    db.close()
+
+Every method returns an asyncio future, so coroutines can await them too.
+db.transaction() returns an asynchronous context manager, for use with
+async with in python 3.5+ code.
+
+Requires python 3.4 or later (asyncio), unlike the rest of tfd, which is
+python 2.7.  Importing it under python 2 raises ImportError.  The module
+does not use async/await syntax itself, so it still compiles under python
+2.
+'''
+
+import sys
+
+if sys.version_info < (3, 4):
+    raise ImportError('tfd.aiodbutil requires python 3.4 or later (asyncio).')
+
+import asyncio
+import logging
+import queue
+import threading
+
+from tfd import dbutil
+
+
+_BEGIN = object()
+_END = object()
+
+
+class AsyncDB(object):
+    '''
+    Runs dbutil functions on worker threads and returns asyncio futures for
+    their results.  There is one worker per connection the pool can open,
+    so a worker never waits for a connection.  A transaction keeps its
+    worker and connection until it ends.
+
+    Statements issued outside a transaction are run by workers that
+    transactions can not take, so a transaction that awaits them can not
+    deadlock by holding every worker.  Transactions opened while
+    max_transactions are open wait for one of them to end, so a transaction
+    must not await a transaction it opens.
+    '''
+    def __init__(self, pool, workers=None, max_transactions=None, loop=None):
+        '''
+        pool: a dbutil.ConnectionPool
+        workers: number of worker threads, at least 2.  Defaults to
+        pool.max_size.  More workers than pool.max_size can leave workers
+        waiting for connections.
+        max_transactions: number of workers that run transactions.  The
+        rest run statements issued outside transactions.  Defaults to half
+        of workers.
+        loop: the event loop the futures belong to.  Defaults to the running
+        (or current) loop of the first call.
+        '''
+        workers = pool.max_size if workers is None else workers
+        if max_transactions is None:
+            max_transactions = workers // 2
+        if not 0 < max_transactions < workers:
+            raise ValueError('Need at least one transaction worker and one '
+                             'statement worker.', workers, max_transactions)
+        self.pool = pool
+        self.loop = loop
+        self._jobs = queue.Queue()
+        self._txnJobs = queue.Queue()
+        self._threads = []
+        for i in range(workers):
+            jobs = self._txnJobs if i < max_transactions else self._jobs
+            thread = threading.Thread(target=self._work, args=(jobs,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append((thread, jobs))
+
+    def _future(self):
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        return self.loop.create_future()
+
+    def _submit(self, jobs, func, args):
+        future = self._future()
+        jobs.put((future, func, args))
+        return future
+
+    def _resolve(self, future, result=None, error=None):
+        '''
+        Set the result of future from a worker thread.
+        '''
+        def resolve():
+            if future.cancelled():
+                return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        try:
+            self.loop.call_soon_threadsafe(resolve)
+        except RuntimeError: # the loop is closed.
+            logging.debug('Event loop closed before a result was delivered.')
+
+    def _work(self, jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            future, func, args = job
+            if func is _BEGIN:
+                self._serveTransaction(future, *args)
+            elif not future.cancelled():
+                try:
+                    with self.pool.connection() as conn:
+                        result = func(conn, *args)
+                except Exception as e:
+                    self._resolve(future, error=e)
+                else:
+                    self._resolve(future, result)
+
+    def _serveTransaction(self, future, start, startSQL, txnJobs):
+        '''
+        Run the statements of one transaction on one connection until the
+        transaction ends.  The connection is returned to the pool however
+        the transaction ends, even if the task awaiting it is cancelled.
+        '''
+        try:
+            conn = self.pool.checkout()
+        except Exception as e:
+            self._resolve(future, error=e)
+            # drain the transaction's statements, failing them.
+            while True:
+                txnFuture, func, args = txnJobs.get()
+                self._resolve(txnFuture, error=e)
+                if func is _END:
+                    return
+        broken = False
+        endFuture = endError = None
+        try:
+            try:
+                if start:
+                    dbutil.executeSQL(conn, startSQL)
+            except Exception as e:
+                self._resolve(future, error=e)
+            else:
+                self._resolve(future)
+            while True:
+                txnFuture, func, args = txnJobs.get()
+                if func is _END:
+                    endFuture = txnFuture
+                    commit, = args
+                    try:
+                        if commit:
+                            conn.commit()
+                        else:
+                            conn.rollback()
+                    except Exception as e:
+                        broken = True
+                        endError = e
+                    return
+                try:
+                    result = func(conn, *args)
+                except Exception as e:
+                    self._resolve(txnFuture, error=e)
+                else:
+                    self._resolve(txnFuture, result)
+        finally:
+            self.pool.checkin(conn, broken)
+            # end the transaction after the connection is back in the pool.
+            if endFuture is not None:
+                self._resolve(endFuture, error=endError)
+
+    def selectSQL(self, sql, args=None, asdict=False):
+        '''
+        returns: a future for dbutil.selectSQL(conn, sql, args, asdict)
+        '''
+        return self._submit(self._jobs, dbutil.selectSQL, (sql, args, asdict))
+
+    def insertSQL(self, sql, args=None):
+        '''
+        returns: a future for dbutil.insertSQL(conn, sql, args)
+        '''
+        return self._submit(self._jobs, dbutil.insertSQL, (sql, args))
+
+    def updateSQL(self, sql, args=None):
+        '''
+        returns: a future for dbutil.updateSQL(conn, sql, args)
+        '''
+        return self._submit(self._jobs, dbutil.updateSQL, (sql, args))
+
+    def executeSQL(self, sql, args=None):
+        '''
+        returns: a future for dbutil.executeSQL(conn, sql, args)
+        '''
+        return self._submit(self._jobs, dbutil.executeSQL, (sql, args))
+
+    def executeManySQL(self, sql, args=None):
+        '''
+        returns: a future for dbutil.executeManySQL(conn, sql, args)
+        '''
+        return self._submit(self._jobs, dbutil.executeManySQL, (sql, args))
+
+    def transaction(self, start=True, startSQL='START TRANSACTION'):
+        '''
+        The async counterpart of dbutil.doTransaction.  Returns an
+        asynchronous context manager whose statements all run on one
+        connection, committed if the block succeeds and rolled back
+        otherwise.  In python 3.5+ code:
+
+            async with db.transaction() as txn:
+                await txn.insertSQL(...)
+        '''
+        return AsyncTransaction(self, start, startSQL)
+
+    def close(self):
+        '''
+        Stop the workers after the statements already submitted and close
+        the pool.  Blocks until the workers are done.
+        '''
+        for thread, jobs in self._threads:
+            jobs.put(None)
+        for thread, jobs in self._threads:
+            thread.join()
+        self.pool.close()
+
+
+class AsyncTransaction(object):
+    '''
+    A transaction on one connection of an AsyncDB.  See AsyncDB.transaction.
+    Statements should be awaited one after the other, since they run in
+    order on the same connection.
+    '''
+    def __init__(self, db, start=True, startSQL='START TRANSACTION'):
+        self.db = db
+        self.start = start
+        self.startSQL = startSQL
+        self._jobs = None
+        self._ended = None
+
+    def __aenter__(self):
+        if self._jobs is not None:
+            raise Exception('Transaction already started.')
+        self._jobs = queue.Queue()
+        begun = self.db._submit(self.db._txnJobs, _BEGIN,
+                                (self.start, self.startSQL, self._jobs))
+        entered = self.db._future()
+        def began(future):
+            if future.cancelled() or entered.cancelled():
+                # the task was cancelled.  End the transaction anyway, so
+                # its connection goes back to the pool.
+                self._end(False)
+            elif future.exception() is not None:
+                self._end(False)
+                entered.set_exception(future.exception())
+            else:
+                entered.set_result(self)
+        begun.add_done_callback(began)
+        entered.add_done_callback(lambda f: f.cancelled() and begun.cancel())
+        return entered
+
+    def __aexit__(self, type, value, traceback):
+        ended = self._end(type is None)
+        # the worker ends the transaction even if the awaiting task is
+        # cancelled again, so shield the future from cancellation.
+        return asyncio.shield(ended)
+
+    def _end(self, commit):
+        '''
+        End the transaction, once.  Returns a future for the commit or
+        rollback.
+        '''
+        if self._jobs is None:
+            raise Exception('Transaction not started.')
+        if self._ended is None:
+            self._ended = self.db._submit(self._jobs, _END, (commit,))
+        return self._ended
+
+    def _statement(self, func, args):
+        if self._jobs is None or self._ended is not None:
+            raise Exception('Transaction not active.')
+        return self.db._submit(self._jobs, func, args)
+
+    def selectSQL(self, sql, args=None, asdict=False):
+        return self._statement(dbutil.selectSQL, (sql, args, asdict))
+
+    def insertSQL(self, sql, args=None):
+        return self._statement(dbutil.insertSQL, (sql, args))
+
+    def updateSQL(self, sql, args=None):
+        return self._statement(dbutil.updateSQL, (sql, args))
+
+    def executeSQL(self, sql, args=None):
+        return self._statement(dbutil.executeSQL, (sql, args))
+
+    def executeManySQL(self, sql, args=None):
+        return self._statement(dbutil.executeManySQL, (sql, args))
+
+
+# last line
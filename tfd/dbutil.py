@@ -11,8 +11,38 @@ Things this module does not do:
   Generate SQL, since that can be database-specific too. (some exceptions might apply.)
 '''
 
+import bisect
+import collections
 import contextlib
+import csv
+import decimal
+import gzip
+import io
+import itertools
 import logging
+import os
+import re
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError: # python 3
+    import queue
+
+if sys.version_info[0] < 3:
+    # the three argument raise is a syntax error in python 3.
+    exec('def _reraise(excInfo):\n'
+         '    raise excInfo[0], excInfo[1], excInfo[2]\n')
+else:
+    def _reraise(excInfo):
+        '''
+        Raise the exception of a sys.exc_info() tuple with its traceback.
+        '''
+        raise excInfo[1].with_traceback(excInfo[2])
 
 
 class Reuser(object):
@@ -63,6 +93,255 @@ class Reuser(object):
             return False
 
 
+class ConnectionPool(object):
+    '''
+    A thread-safe pool of open connections made by a DB API 2.0 connection
+    factory.  Check out a connection with the connection() context manager:
+
+        pool = ConnectionPool(lambda: MySQLdb.connect(...), max_size=8)
+        with pool.connection() as conn:
+            rows = selectSQL(conn, 'SELECT id FROM people')
+
+    The pool opens min_size connections up front and up to max_size in all,
+    and opens new ones when returned connections are discarded so it does not
+    fall below min_size.
+    When every connection is checked out, callers wait for one to be
+    returned.  Unlike Reuser, a connection is only pinged when it is checked
+    out after sitting idle for idle_check seconds, not on every checkout, and
+    connections older than max_age seconds are closed and replaced.
+    A connection returned because of an exception is rolled back, and
+    discarded if that fails.
+    '''
+    def __init__(self, open_conn, min_size=1, max_size=10, idle_check=30,
+                 max_age=None, timeout=None, ping_sql='SELECT 1'):
+        '''
+        open_conn: function that returns an open connection
+        min_size: number of connections to keep open, starting when the pool
+        is made.
+        max_size: maximum number of connections open at once.
+        idle_check: ping a connection before checking it out if it has been
+        idle this many seconds.  0 pings on every checkout.  None never pings.
+        max_age: close and replace connections opened more than this many
+        seconds ago when they are checked out or returned.  None keeps them
+        forever.
+        timeout: default number of seconds to wait for a connection before
+        raising PoolTimeout.  None waits forever.
+        ping_sql: the statement used to ping a connection.
+        '''
+        if max_size < 1 or min_size > max_size:
+            raise ValueError('Bad pool sizes.', min_size, max_size)
+        self.open_conn = open_conn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_check = idle_check
+        self.max_age = max_age
+        self.timeout = timeout
+        self.ping_sql = ping_sql
+        self._cond = threading.Condition()
+        self._idle = [] # (conn, opened, last used) tuples
+        self._opened = {} # id(conn) -> time opened, for checked out conns.
+        self._size = 0
+        self._closed = False
+        self._stats = dict.fromkeys(['checkouts', 'waits', 'created',
+                                     'recycled', 'validations',
+                                     'validation_failures', 'discarded'], 0)
+        self._stats['wait_time'] = 0.0
+        for i in range(min_size):
+            self._size += 1
+            self._idle.append(self._open())
+
+    def _open(self):
+        '''
+        Open a new connection.  The caller must have counted it in self._size.
+        '''
+        conn = self.open_conn()
+        now = time.time()
+        with self._cond:
+            self._stats['created'] += 1
+        return (conn, now, now)
+
+    def _discard(self, conn, stat=None):
+        '''
+        Close conn and free its slot, counting it in the stat named stat.
+        '''
+        with self._cond:
+            self._size -= 1
+            if stat is not None:
+                self._stats[stat] += 1
+            self._cond.notify()
+        try:
+            conn.close()
+        except Exception:
+            logging.exception('Exception encountered closing a pooled connection.')
+
+    def _refill(self):
+        '''
+        Open connections until the pool has min_size again, e.g. after
+        broken or old connections are discarded.
+        '''
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                entry = self._open()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                logging.exception('Exception encountered refilling a connection pool.')
+                return
+            with self._cond:
+                self._idle.append(entry)
+                self._cond.notify()
+
+    def _ping(self, conn):
+        try:
+            with doCursor(conn) as cursor:
+                cursor.execute(self.ping_sql)
+                cursor.fetchall()
+            return True
+        except Exception:
+            return False
+
+    def checkout(self, timeout=None):
+        '''
+        Return an open connection from the pool, waiting up to timeout
+        seconds (default self.timeout) if all connections are in use.  Every
+        connection checked out must be returned with checkin().
+        '''
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None if timeout is None else time.time() + timeout
+        waited = None # seconds waited, if any.
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolClosed('Connection pool is closed.')
+                    if self._idle:
+                        conn, opened, used = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        conn = None
+                        self._size += 1 # reserve a slot while connecting.
+                        break
+                    now = time.time()
+                    remaining = None if deadline is None else deadline - now
+                    if remaining is not None and remaining <= 0:
+                        raise PoolTimeout('Timed out waiting for a connection.')
+                    self._cond.wait(remaining)
+                    waited = (waited or 0.0) + time.time() - now
+
+            if conn is None:
+                try:
+                    conn, opened, used = self._open()
+                except:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                break
+            # replace old or dead idle connections and try again.
+            now = time.time()
+            if self.max_age is not None and now - opened > self.max_age:
+                self._discard(conn, 'recycled')
+                continue
+            if self.idle_check is not None and now - used >= self.idle_check:
+                with self._cond:
+                    self._stats['validations'] += 1
+                if not self._ping(conn):
+                    self._discard(conn, 'validation_failures')
+                    continue
+            break
+        with self._cond:
+            self._opened[id(conn)] = opened
+            self._stats['checkouts'] += 1
+            if waited is not None:
+                self._stats['waits'] += 1
+                self._stats['wait_time'] += waited
+        return conn
+
+    def checkin(self, conn, broken=False):
+        '''
+        Return a connection to the pool.  If broken is True, the connection
+        is closed instead of being reused.
+        '''
+        with self._cond:
+            opened = self._opened.pop(id(conn))
+        now = time.time()
+        if broken:
+            self._discard(conn, 'discarded')
+            self._refill()
+        elif self._closed:
+            self._discard(conn)
+        elif self.max_age is not None and now - opened > self.max_age:
+            self._discard(conn, 'recycled')
+            self._refill()
+        else:
+            with self._cond:
+                self._idle.append((conn, opened, now))
+                self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        '''
+        Check out a connection, yield it, and return it to the pool.  If an
+        exception is raised, the connection is rolled back, or discarded if
+        the rollback fails.
+        '''
+        conn = self.checkout(timeout)
+        try:
+            yield conn
+        except:
+            broken = False
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+            self.checkin(conn, broken)
+            raise
+        else:
+            self.checkin(conn)
+
+    def stats(self):
+        '''
+        Return a dict of pool statistics:
+        size: open connections.  in_use: checked out connections.
+        idle: connections waiting in the pool.  checkouts: total checkouts.
+        waits: checkouts that had to wait.  wait_time: total seconds waited.
+        created: connections opened.  recycled: connections replaced for
+        age.  validations: idle connections pinged.  validation_failures:
+        pings that failed.  discarded: connections returned broken.
+        '''
+        with self._cond:
+            stats = dict(self._stats)
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = len(self._opened)
+        return stats
+
+    def close(self):
+        '''
+        Close the idle connections and close checked out connections when
+        they are returned.  Checkouts from a closed pool raise PoolClosed.
+        '''
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for conn, opened, used in idle:
+            self._discard(conn)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PoolClosed(Exception):
+    pass
+
+
 @contextlib.contextmanager
 def doTransaction(conn, start=True, startSQL='START TRANSACTION'):
     '''
@@ -70,24 +349,27 @@ def doTransaction(conn, start=True, startSQL='START TRANSACTION'):
     start: if True, executes 'START TRANSACTION' sql before yielding conn.  Useful for connections that are autocommit by default.
     startSQL: override if 'START TRANSACTION' does not work for your db server.
     '''
-    try:
-        if start:
-            executeSQL(conn, startSQL)
-        yield conn
-    except:
-        if conn is not None:
-            conn.rollback()
-        raise
-    else:
-        conn.commit()
+    with _Call('doTransaction', startSQL if start else None):
+        try:
+            if start:
+                executeSQL(conn, startSQL)
+            yield conn
+        except:
+            if conn is not None:
+                conn.rollback()
+            raise
+        else:
+            conn.commit()
 
 
 @contextlib.contextmanager
-def doCursor(conn):
+def doCursor(conn, cursorclass=None):
     '''
     create and yield a cursor, closing it when done.
+    cursorclass: if not None, passed to conn.cursor(), e.g. MySQLdb's
+    SSCursor for a server-side cursor.  Not part of DB API 2.0.
     '''
-    cursor = conn.cursor()
+    cursor = conn.cursor() if cursorclass is None else conn.cursor(cursorclass)
     try:
         yield cursor
     finally:
@@ -162,9 +444,10 @@ def selectSQL(conn, sql, args=None, asdict=False):
             varies between databases and makes writing portable code
             impossible.
     '''
-    with doCursor(conn) as cursor:
+    with _Call('selectSQL', sql) as call, doCursor(conn) as cursor:
         cursor.execute(sql, args)
         tuples = cursor.fetchall()
+        call.rows = len(tuples)
         if asdict:
             names = [column[0] for column in cursor.description]
             numcols = len(names)
@@ -174,14 +457,67 @@ def selectSQL(conn, sql, args=None, asdict=False):
             return tuples
 
 
+ROW_TYPES = ('tuple', 'dict', 'namedtuple', 'columns')
+
+
+def iterSelectSQL(conn, sql, args=None, rowtype='tuple', batch_size=1000,
+                  cursorclass=None):
+    '''
+    Like selectSQL, but a generator that fetches rows batch_size at a time
+    with cursor.fetchmany(), so large result sets can be processed in
+    constant memory.  The cursor is closed when the generator is exhausted
+    or closed.
+
+    sql: a select statement, e.g. 'SELECT id, name FROM people'
+    args: parameter values for sql, as in selectSQL.
+    rowtype: 'tuple' yields each row as a tuple.  'dict' yields each row as a
+    dict mapping field name to value (see the caveats in selectSQL).
+    'namedtuple' yields each row as a namedtuple whose fields are the field
+    names from cursor.description (invalid names are renamed to _0, _1,
+    ...).  'columns' yields one list of column lists per batch, e.g.
+    [[1, 2], ['Jane', 'Joe']].
+    batch_size: number of rows per fetchmany() call.
+    cursorclass: passed to doCursor.  Use a server-side/unbuffered cursor
+    class (e.g. MySQLdb.cursors.SSCursor) to keep the driver from buffering
+    the whole result set client-side.
+    '''
+    if rowtype not in ROW_TYPES:
+        raise ValueError('Unrecognized rowtype.', rowtype)
+    with _Call('iterSelectSQL', sql) as call, doCursor(conn, cursorclass) as cursor:
+        cursor.execute(sql, args)
+        names = [column[0] for column in cursor.description]
+        if rowtype == 'namedtuple':
+            Row = collections.namedtuple('Row', names, rename=True)
+        call.rows = 0
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            call.rows += len(rows)
+            if rowtype == 'tuple':
+                items = rows
+            elif rowtype == 'dict':
+                items = (dict(zip(names, row)) for row in rows)
+            elif rowtype == 'namedtuple':
+                items = (Row._make(row) for row in rows)
+            else:
+                items = [[list(column) for column in zip(*rows)]]
+            # time the consumer spends between yields is not query time.
+            call.pause()
+            for item in items:
+                yield item
+            call.resume()
+
+
 def insertSQL(conn, sql, args=None):
     '''
     args: if sql has parameters defined with either %s or %(key)s then args should be a either list or dict of parameter
     values respectively.
     returns the insert id
     '''
-    with doCursor(conn) as cursor:
+    with _Call('insertSQL', sql) as call, doCursor(conn) as cursor:
         cursor.execute(sql, args)
+        call.rows = cursor.rowcount
         id = conn.insert_id()
         return id
 
@@ -192,8 +528,9 @@ def updateSQL(conn, sql, args=None):
     values respectively.
     returns the number of rows affected by the sql statement
     '''
-    with doCursor(conn) as cursor:
+    with _Call('updateSQL', sql) as call, doCursor(conn) as cursor:
         numRowsAffected = cursor.execute(sql, args)
+        call.rows = cursor.rowcount
         return numRowsAffected
 
 
@@ -205,8 +542,9 @@ def executeSQL(conn, sql, args=None):
     which do not have an result like insert id or a rowset.
     returns: the number of rows affected by the sql statement if any.
     '''
-    with doCursor(conn) as cursor:
+    with _Call('executeSQL', sql) as call, doCursor(conn) as cursor:
         numRowsAffected = cursor.execute(sql, args)
+        call.rows = cursor.rowcount
         return numRowsAffected
     
 
@@ -216,10 +554,1254 @@ def executeManySQL(conn, sql, args=None):
     values respectively.
     returns: not sure.  perhaps number of rows affected.
     '''
-    with doCursor(conn) as cursor:
+    with _Call('executeManySQL', sql) as call, doCursor(conn) as cursor:
         retval = cursor.executemany(sql, args)
+        call.rows = cursor.rowcount
         return retval
 
 
+##################
+# INSTRUMENTATION
+
+_hooks = []
+
+
+def addHook(hook):
+    '''
+    Call hook(event) with a QueryEvent after every call to selectSQL,
+    iterSelectSQL, insertSQL, updateSQL, executeSQL, executeManySQL,
+    bulkInsertSQL and doTransaction, e.g. a QueryStats or SlowQueryLog.
+    Exceptions raised by hooks are logged, not raised.
+    '''
+    _hooks.append(hook)
+
+
+def removeHook(hook):
+    _hooks.remove(hook)
+
+
+class QueryEvent(collections.namedtuple('QueryEvent', ['function', 'sql', 'seconds', 'rows', 'error'])):
+    '''
+    function: name of the dbutil function called, e.g. 'selectSQL'.
+    sql: the statement executed.  For doTransaction, the startSQL or None.
+    seconds: wall time of the call.  For doTransaction, the time from
+    starting the transaction to committing or rolling it back.  For
+    iterSelectSQL, the time spent executing and fetching, not the time the
+    caller spends between rows.
+    rows: number of rows returned or affected, or None if unknown.
+    error: the exception raised by the call, or None.
+    '''
+    __slots__ = ()
+
+    @property
+    def normalized(self):
+        '''
+        the statement with literal values removed.  See normalizeSQL.
+        '''
+        return None if self.sql is None else normalizeSQL(self.sql)
+
+
+class _Call(object):
+    '''
+    Context manager that times a call and passes a QueryEvent to the hooks.
+    Set rows on it to record the rows returned or affected.  Time between
+    pause() and resume() is not counted.
+    '''
+    __slots__ = ('function', 'sql', 'rows', 'start', 'paused', 'idle')
+
+    def __init__(self, function, sql):
+        self.function = function
+        self.sql = sql
+        self.rows = None
+        self.start = time.time() if _hooks else None
+        self.paused = None
+        self.idle = 0.0
+
+    def pause(self):
+        if self.start is not None:
+            self.paused = time.time()
+
+    def resume(self):
+        if self.paused is not None:
+            self.idle += time.time() - self.paused
+            self.paused = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.start is None or not _hooks:
+            return False
+        if isinstance(value, GeneratorExit): # iterSelectSQL closed early
+            value = None
+        self.resume()
+        event = QueryEvent(self.function, self.sql,
+                           time.time() - self.start - self.idle,
+                           self.rows, value)
+        for hook in list(_hooks):
+            try:
+                hook(event)
+            except Exception:
+                logging.exception('Exception encountered in dbutil hook.')
+        return False
+
+
+_LITERAL_RE = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\"|\b\d+(?:\.\d+)?\b|%\(\w+\)s|%s|\?")
+_LIST_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*')
+_SPACE_RE = re.compile(r'\s+')
+
+
+def normalizeSQL(sql):
+    '''
+    Return sql with literal values and parameters replaced by ?, lists of
+    them (e.g. IN lists and multi-row VALUES) replaced by (...), and runs of
+    whitespace collapsed, so that statements which differ only in their
+    values can be grouped together.  e.g.
+    "SELECT * FROM term WHERE id IN (1, 2, 3) AND acc = 'GO:0008150'" ->
+    'SELECT * FROM term WHERE id IN (...) AND acc = ?'
+    '''
+    sql = _LITERAL_RE.sub('?', sql)
+    sql = _LIST_RE.sub('(...)', sql)
+    return _SPACE_RE.sub(' ', sql).strip()
+
+
+class QueryStats(object):
+    '''
+    A hook that aggregates QueryEvents by normalized statement: the number
+    of calls, total and maximum seconds, total rows, errors, and a
+    histogram of latencies.
+
+        stats = QueryStats()
+        addHook(stats)
+        ...
+        for sql, stat in stats.top(10):
+            print stat['seconds'], stat['count'], sql
+    '''
+    BUCKETS = (0.001, 0.01, 0.1, 1.0, 10.0)
+
+    def __init__(self, buckets=BUCKETS):
+        '''
+        buckets: increasing upper bounds, in seconds, of the histogram
+        buckets.  A last bucket counts latencies above the last bound.
+        '''
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def __call__(self, event):
+        sql = event.normalized
+        if sql is None:
+            sql = event.function
+        with self._lock:
+            stat = self._stats.get(sql)
+            if stat is None:
+                stat = self._stats[sql] = {
+                    'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'rows': 0,
+                    'errors': 0, 'histogram': [0] * (len(self.buckets) + 1)}
+            stat['count'] += 1
+            stat['seconds'] += event.seconds
+            stat['max_seconds'] = max(stat['max_seconds'], event.seconds)
+            stat['rows'] += event.rows if event.rows and event.rows > 0 else 0
+            stat['errors'] += event.error is not None
+            stat['histogram'][bisect.bisect_left(self.buckets, event.seconds)] += 1
+
+    def statements(self):
+        '''
+        returns: a dict mapping each normalized statement to a dict of its
+        count, seconds, max_seconds, rows, errors and histogram, a list of
+        counts per bucket.
+        '''
+        with self._lock:
+            return dict((sql, dict(stat, histogram=list(stat['histogram'])))
+                        for sql, stat in self._stats.items())
+
+    def top(self, n=10, key='seconds'):
+        '''
+        returns: a list of the n (statement, stat dict) pairs with the
+        greatest key, e.g. 'seconds' for total time, 'count' or
+        'max_seconds'.
+        '''
+        stats = self.statements()
+        return sorted(stats.items(), key=lambda item: item[1][key], reverse=True)[:n]
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+
+class SlowQueryLog(object):
+    '''
+    A hook that logs a warning for every call that takes longer than
+    threshold seconds.
+    '''
+    def __init__(self, threshold=1.0, logger=None):
+        self.threshold = threshold
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+
+    def __call__(self, event):
+        if event.seconds >= self.threshold:
+            self.logger.warning('Slow query: %s took %.3fs (rows=%s): %s',
+                                event.function, event.seconds, event.rows,
+                                event.normalized)
+
+
+################
+# QUERY CACHING
+
+TABLE_NAME_RE = re.compile(r'\b(?:FROM|JOIN|INTO|UPDATE|TABLE)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?`?([\w.]+)`?', re.IGNORECASE)
+
+
+def sqlTables(sql):
+    '''
+    Guess the names of the tables a statement reads or writes, e.g.
+    ['people', 'pets'] for 'SELECT * FROM people JOIN pets ON ...'.  Names
+    are lowercased.  This is a heuristic that ignores subtleties like
+    subqueries in a FROM clause.
+    '''
+    return sorted(set(name.lower() for name in TABLE_NAME_RE.findall(sql)))
+
+
+class QueryCache(object):
+    '''
+    A size-bounded, least-recently-used cache of selectSQL results, with
+    optional per-entry expiration.  Use its selectSQL in place of the module
+    function to cache results, and its insertSQL, updateSQL, executeSQL and
+    executeManySQL in place of the module functions to drop cached results
+    that read from tables those statements write to:
+
+        cache = QueryCache(max_size=1000, ttl=300)
+        terms = cache.selectSQL(conn, 'SELECT acc, name FROM term')
+        cache.updateSQL(conn, 'UPDATE term SET name=%s WHERE acc=%s', [...])
+
+    Cached results are tagged with the tables their sql reads, guessed by
+    sqlTables() unless given explicitly.  Writes made without going
+    through the cache are not seen, so call invalidate() after them, or
+    rely on ttl.  The cache is thread-safe.  Callers share cached rows, so
+    they should not modify them.
+    '''
+    def __init__(self, max_size=1000, ttl=None, clock=time.time):
+        '''
+        max_size: maximum number of cached results.
+        ttl: default number of seconds a result stays cached.  None for no
+        expiration.
+        clock: function returning the current time in seconds.
+        '''
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict() # key -> (rows, expires, tables)
+        self._tagged = collections.defaultdict(set) # table -> keys
+        # invalidate() bumps these, so a select that was running when its
+        # tables were invalidated knows not to cache its (stale) rows.
+        self._generation = 0
+        self._tableGenerations = {} # table -> generation
+        self._stats = dict.fromkeys(['hits', 'misses', 'evictions',
+                                     'expirations', 'invalidations',
+                                     'uncacheable', 'stale'], 0)
+
+    def selectSQL(self, conn, sql, args=None, asdict=False, tables=None,
+                  ttl=None):
+        '''
+        Return selectSQL(conn, sql, args, asdict), from the cache if
+        possible.
+        tables: the tables sql reads, used to invalidate the result.  Defaults
+        to sqlTables(sql).
+        ttl: overrides the default ttl for this result.
+        '''
+        key = _cacheKey(sql, args, asdict)
+        if key is None:
+            with self._lock:
+                self._stats['uncacheable'] += 1
+            return selectSQL(conn, sql, args, asdict)
+        tables = sqlTables(sql) if tables is None else [t.lower() for t in tables]
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                if entry[1] is None or entry[1] > self.clock():
+                    self._entries[key] = entry # most recently used.
+                    self._stats['hits'] += 1
+                    return list(entry[0])
+                self._stats['expirations'] += 1
+                self._untag(key, entry[2])
+            self._stats['misses'] += 1
+            generations = self._generations(tables)
+
+        rows = selectSQL(conn, sql, args, asdict)
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else self.clock() + ttl
+        with self._lock:
+            if self._generations(tables) != generations:
+                # invalidated during the select.  the rows may be stale.
+                self._stats['stale'] += 1
+                return list(rows)
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._untag(key, old[2])
+            self._entries[key] = (rows, expires, tables)
+            for table in tables:
+                self._tagged[table].add(key)
+            while len(self._entries) > self.max_size:
+                oldKey, oldEntry = self._entries.popitem(last=False)
+                self._untag(oldKey, oldEntry[2])
+                self._stats['evictions'] += 1
+        return list(rows)
+
+    def _generations(self, tables):
+        return (self._generation,
+                [self._tableGenerations.get(table, 0) for table in tables])
+
+    def _untag(self, key, tables):
+        for table in tables:
+            keys = self._tagged.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tagged[table]
+
+    def invalidate(self, tables=None):
+        '''
+        Drop cached results that read any of tables, or all results if tables
+        is None.
+        '''
+        with self._lock:
+            if tables is None:
+                self._generation += 1
+                self._stats['invalidations'] += len(self._entries)
+                self._entries.clear()
+                self._tagged.clear()
+                return
+            for table in tables:
+                table = table.lower()
+                self._tableGenerations[table] = self._tableGenerations.get(table, 0) + 1
+                for key in list(self._tagged.get(table, ())):
+                    entry = self._entries.pop(key)
+                    self._untag(key, entry[2])
+                    self._stats['invalidations'] += 1
+
+    def insertSQL(self, conn, sql, args=None, tables=None):
+        '''
+        Return insertSQL(conn, sql, args) and invalidate tables, which
+        defaults to sqlTables(sql).
+        '''
+        try:
+            return insertSQL(conn, sql, args)
+        finally:
+            self.invalidate(sqlTables(sql) if tables is None else tables)
+
+    def updateSQL(self, conn, sql, args=None, tables=None):
+        '''
+        Return updateSQL(conn, sql, args) and invalidate tables, which
+        defaults to sqlTables(sql).
+        '''
+        try:
+            return updateSQL(conn, sql, args)
+        finally:
+            self.invalidate(sqlTables(sql) if tables is None else tables)
+
+    def executeSQL(self, conn, sql, args=None, tables=None):
+        '''
+        Return executeSQL(conn, sql, args) and invalidate tables, which
+        defaults to sqlTables(sql).
+        '''
+        try:
+            return executeSQL(conn, sql, args)
+        finally:
+            self.invalidate(sqlTables(sql) if tables is None else tables)
+
+    def executeManySQL(self, conn, sql, args=None, tables=None):
+        '''
+        Return executeManySQL(conn, sql, args) and invalidate tables, which
+        defaults to sqlTables(sql).
+        '''
+        try:
+            return executeManySQL(conn, sql, args)
+        finally:
+            self.invalidate(sqlTables(sql) if tables is None else tables)
+
+    def stats(self):
+        '''
+        Return a dict of cache statistics: size, hits, misses, evictions (of
+        least recently used results), expirations, invalidations,
+        uncacheable (selects whose args could not be hashed) and stale
+        (results not cached because their tables were invalidated while
+        they were being selected.)
+        '''
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        return stats
+
+
+def _cacheKey(sql, args, asdict):
+    '''
+    Return a hashable key for a query, or None if args are not hashable.
+    '''
+    if isinstance(args, dict):
+        args = tuple(sorted(args.items()))
+    elif args is not None:
+        args = tuple(args)
+    key = (sql, args, bool(asdict))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+###############
+# BULK LOADING
+
+UPSERT_MODES = (None, 'ignore', 'replace', 'update')
+
+# dialect -> (placeholder, max params per statement, upsert verbs, startSQL)
+BULK_DIALECTS = {
+    'mysql': ('%s', None, {None: 'INSERT INTO', 'ignore': 'INSERT IGNORE INTO',
+                           'replace': 'REPLACE INTO', 'update': 'INSERT INTO'},
+              'START TRANSACTION'),
+    'sqlite': ('?', 999, {None: 'INSERT INTO', 'ignore': 'INSERT OR IGNORE INTO',
+                          'replace': 'INSERT OR REPLACE INTO',
+                          'update': 'INSERT INTO'},
+               'BEGIN'),
+}
+
+
+def bulkInsertSQL(conn, table, columns, rows, batch_size=1000,
+                  commit_every=10, upsert=None, keys=None, dialect='mysql',
+                  multirow=True, start=True, startSQL=None, progress=None):
+    '''
+    Insert an iterable of rows into table, batch_size rows at a time, using
+    multi-row INSERT ... VALUES (...),(...) statements, which avoids the
+    per-statement overhead of one insertSQL or execute() per row.  A
+    transaction (see doTransaction) is committed every commit_every batches.
+    Rows are consumed lazily, so rows can be a generator over a file too big
+    to fit in memory.
+
+    This generates SQL, so it is specific to a database server, chosen
+    with dialect.
+
+    table: name of the table to insert into.
+    columns: sequence of column names.  Every row is a sequence of values
+    in the same order.
+    rows: iterable of rows.
+    batch_size: number of rows per batch.  A batch is inserted with one
+    statement unless the dialect limits the number of parameters per
+    statement (sqlite), in which case it is split up.
+    commit_every: number of batches per transaction.
+    upsert: what to do with rows whose unique keys conflict with existing
+    rows.  None: raise an error.  'ignore': skip them.  'replace': delete the
+    existing row and insert the new one.  'update': update the existing row
+    with the non-key columns of the new row.
+    keys: columns of the unique key used by upsert='update'.  Required for
+    sqlite.  For mysql, they are excluded from the updated columns.
+    dialect: 'mysql' or 'sqlite'.
+    multirow: if False, insert each batch with cursor.executemany() instead,
+    for drivers with their own fast path (e.g. MySQLdb rewrites
+    executemany() of an INSERT into multi-row statements.)
+    start, startSQL: whether and how to start each transaction, as for
+    doTransaction.  startSQL defaults to the dialect's statement for
+    starting a transaction.  It is skipped when conn.in_transaction is true,
+    so the first batch joins a transaction the caller already has open.
+    progress: if not None, a function called with the stats dict (see
+    below) after every commit.
+    returns: a dict of stats: rows inserted, batches, seconds elapsed, and
+    rows_per_sec.
+    '''
+    if upsert not in UPSERT_MODES:
+        raise ValueError('Unrecognized upsert mode.', upsert)
+    if dialect not in BULK_DIALECTS:
+        raise ValueError('Unrecognized dialect.', dialect)
+    placeholder, max_params, verbs, dialectStartSQL = BULK_DIALECTS[dialect]
+    if startSQL is None:
+        startSQL = dialectStartSQL
+    columns = list(columns)
+    head = '{} {} ({}) VALUES '.format(verbs[upsert], table, ', '.join(columns))
+    values = '(' + ', '.join([placeholder] * len(columns)) + ')'
+    tail = ''
+    if upsert == 'update':
+        updates = [c for c in columns if not keys or c not in keys]
+        if not updates:
+            raise ValueError('No non-key columns to update.', columns, keys)
+        if dialect == 'mysql':
+            tail = ' ON DUPLICATE KEY UPDATE ' + ', '.join(
+                '{0}=VALUES({0})'.format(c) for c in updates)
+        else:
+            if not keys:
+                raise ValueError('sqlite upserts require keys.')
+            tail = ' ON CONFLICT ({}) DO UPDATE SET {}'.format(
+                ', '.join(keys),
+                ', '.join('{0}=excluded.{0}'.format(c) for c in updates))
+
+    per_statement = batch_size
+    if max_params is not None:
+        per_statement = max(1, min(batch_size, max_params // len(columns)))
+    statements = {} # number of rows -> sql
+    def statement(num_rows):
+        if num_rows not in statements:
+            statements[num_rows] = head + ', '.join([values] * num_rows) + tail
+        return statements[num_rows]
+
+    stats = {'rows': 0, 'batches': 0, 'seconds': 0.0, 'rows_per_sec': 0.0}
+    begin = time.time()
+    rows = iter(rows)
+    done = False
+    with _Call('bulkInsertSQL', head) as call, doCursor(conn) as cursor:
+        while not done:
+            with doTransaction(conn, start=False):
+                # a connection that tracks its own transaction (sqlite3)
+                # may already be in one, which BEGIN would refuse to nest.
+                if start and not getattr(conn, 'in_transaction', False):
+                    cursor.execute(startSQL)
+                for i in range(commit_every):
+                    batch = list(itertools.islice(rows, batch_size))
+                    if not batch:
+                        done = True
+                        break
+                    if multirow:
+                        for j in range(0, len(batch), per_statement):
+                            chunk = batch[j:j + per_statement]
+                            args = [value for row in chunk for value in row]
+                            cursor.execute(statement(len(chunk)), args)
+                    else:
+                        cursor.executemany(statement(1) if tail else
+                                           head + values, batch)
+                    stats['rows'] += len(batch)
+                    stats['batches'] += 1
+            stats['seconds'] = time.time() - begin
+            if stats['seconds'] > 0:
+                stats['rows_per_sec'] = stats['rows'] / stats['seconds']
+            if progress is not None:
+                progress(dict(stats))
+        call.rows = stats['rows']
+    return stats
+
+
+###################
+# KEYSET SCANNING
+
+def keysetScanSQL(conn, table, key, columns=None, where=None, args=None,
+                  page_size=1000, lower=None, upper=None, placeholder='%s'):
+    '''
+    Generate every row of a table (or query), ordered by key, one page of
+    page_size rows at a time, using queries like:
+
+        SELECT columns FROM table WHERE key > %s ORDER BY key LIMIT 1000
+
+    Each page is a short query that starts where the last one ended, using
+    the index on key, so a scan keeps no cursor open between pages and takes
+    time linear in the size of the table, unlike LIMIT ... OFFSET pages,
+    which get slower the deeper they go.  Rows inserted or deleted during a
+    scan may or may not be seen.
+
+    table: a table name, or a subquery with an alias, e.g.
+    '(SELECT ...) AS t'.
+    key: a unique, indexed column to order by, e.g. 'id'.
+    columns: a list of column names to select, which must include key.
+    Defaults to all columns.
+    where: optional condition to filter rows, e.g. 'taxon_id = %s'.
+    args: list of parameter values for where.
+    page_size: number of rows per page.
+    lower: if not None, only rows with key > lower are scanned.
+    upper: if not None, only rows with key <= upper are scanned.
+    placeholder: the parameter marker of the driver, e.g. '?' for sqlite3.
+    '''
+    for page in _keysetPages(conn, table, key, columns, where, args,
+                             page_size, lower, upper, placeholder):
+        for row in page:
+            yield row
+
+
+def _keysetPages(conn, table, key, columns, where, args, page_size, lower,
+                 upper, placeholder):
+    '''
+    Generate the pages of keysetScanSQL as lists of rows.
+    '''
+    if columns is not None and key not in columns:
+        raise ValueError('columns must include key.', key, columns)
+    select = 'SELECT {} FROM {} WHERE '.format(
+        '*' if columns is None else ', '.join(columns), table)
+    conditions = [] if where is None else ['(' + where + ')']
+    args = [] if args is None else list(args)
+    if upper is not None:
+        conditions.append('{} <= {}'.format(key, placeholder))
+        args.append(upper)
+    order = ' ORDER BY {} LIMIT {:d}'.format(key, page_size)
+    keyIndex = None if columns is None else list(columns).index(key)
+    last = lower
+    while True:
+        if last is None:
+            sql = select + (' AND '.join(conditions) or '1=1') + order
+            params = args
+        else:
+            sql = select + ' AND '.join(
+                conditions + ['{} > {}'.format(key, placeholder)]) + order
+            params = args + [last]
+        with _Call('keysetScanSQL', sql) as call, doCursor(conn) as cursor:
+            cursor.execute(sql, params)
+            page = cursor.fetchall()
+            call.rows = len(page)
+            if keyIndex is None:
+                keyIndex = [c[0].lower() for c in cursor.description].index(key.lower())
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        last = page[-1][keyIndex]
+
+
+def parallelScanSQL(pool, table, key, columns=None, where=None, args=None,
+                    page_size=1000, splits=None, workers=4, ordered=False,
+                    placeholder='%s'):
+    '''
+    Like keysetScanSQL, but the key range is split into disjoint ranges
+    which are scanned at the same time by worker threads, each using a
+    connection from pool, a ConnectionPool.  Generates rows as pages
+    arrive.
+
+    splits: sorted key values that split the key range into ranges
+    (-inf, splits[0]], (splits[0], splits[1]], ..., (splits[-1], inf).  By
+    default, an integer key range, from SELECT MIN(key), MAX(key), is split
+    into workers equal ranges.
+    workers: number of ranges scanned at a time.  Keep it at or below
+    pool.max_size.
+    ordered: if True, rows are generated in key order, which can leave
+    workers waiting for the consumer.  Otherwise rows from different ranges
+    are interleaved.
+    See keysetScanSQL for the other parameters.
+    '''
+    if splits is None:
+        with pool.connection() as conn:
+            sql = 'SELECT MIN({0}), MAX({0}) FROM {1}'.format(key, table)
+            if where is not None:
+                sql += ' WHERE ' + where
+            low, high = selectSQL(conn, sql, [] if args is None else args)[0]
+        if low is None:
+            return
+        step = (high - low) // workers + 1
+        splits = [low - 1 + step * i for i in range(1, workers)]
+    bounds = [None] + list(splits) + [None]
+
+    def task(lower, upper):
+        return lambda conn: _keysetPages(conn, table, key, columns, where,
+                                         args, page_size, lower, upper,
+                                         placeholder)
+    tasks = [task(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+    for page in _fanOut(pool, tasks, workers, ordered):
+        for row in page:
+            yield row
+
+
+def fanOutSQL(pool, queries, workers=4, ordered=False, asdict=False,
+              tagged=False, batch_size=1000):
+    '''
+    Run many independent selects at the same time and generate their rows
+    as they arrive, so the total time is closer to that of the slowest query
+    than to the sum of them all, e.g.:
+
+        queries = [('SELECT * FROM gene WHERE chrom = %s', [c]) for c in chroms]
+        for row in fanOutSQL(pool, queries, workers=8):
+            ...
+
+    pool: a ConnectionPool.  Each query runs on a connection from it.
+    queries: a sequence of (sql, args) pairs.
+    workers: the maximum number of queries running at once.  Keep it at or
+    below pool.max_size.
+    ordered: if True, rows are generated in query order: all the rows of
+    the first query, then the second, and so on.  Otherwise the rows of
+    different queries are interleaved.
+    asdict: if True, rows are dicts, as in selectSQL.
+    tagged: if True, generate (i, row) pairs, where i is the index of the
+    query that returned row.
+    batch_size: rows are fetched and handed from the workers in batches of
+    this many rows.  A few batches per worker are buffered.
+    '''
+    rowtype = 'dict' if asdict else 'tuple'
+
+    def task(i, sql, args):
+        def run(conn):
+            rows = iterSelectSQL(conn, sql, args, rowtype, batch_size)
+            while True:
+                batch = list(itertools.islice(rows, batch_size))
+                if not batch:
+                    return
+                yield [(i, row) for row in batch] if tagged else batch
+        return run
+    tasks = [task(i, sql, args) for i, (sql, args) in enumerate(queries)]
+    for batch in _fanOut(pool, tasks, workers, ordered):
+        for row in batch:
+            yield row
+
+
+_DONE = object()
+
+
+def _fanOut(pool, tasks, workers, ordered=False, buffer=4):
+    '''
+    Run tasks on worker threads and generate their results.  Each task is a
+    function that takes a connection, checked out from pool for the task,
+    and returns an iterable of results.  If ordered, all the results of the
+    first task are generated, then the second, and so on.  Otherwise results
+    are generated as they arrive.  Each task buffers at most buffer results
+    (ordered) or all tasks together buffer at most buffer * workers results,
+    so results are made no faster than they are consumed.  The first
+    exception raised by a task is raised by the generator, and closing the
+    generator stops the workers.
+    '''
+    if not tasks:
+        return
+    todo = queue.Queue()
+    for i in range(len(tasks)):
+        todo.put(i)
+    if ordered:
+        outs = [queue.Queue(buffer) for task in tasks]
+    else:
+        outs = [queue.Queue(buffer * workers)] * len(tasks)
+    stop = threading.Event()
+
+    def put(out, item):
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def work():
+        while not stop.is_set():
+            try:
+                i = todo.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                with pool.connection() as conn:
+                    for result in tasks[i](conn):
+                        if not put(outs[i], (i, result)):
+                            return
+            except Exception as e:
+                put(outs[i], (i, _DONE, e))
+                return
+            put(outs[i], (i, _DONE, None))
+
+    threads = [threading.Thread(target=work)
+               for i in range(min(workers, len(tasks)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        done = 0
+        current = 0 # the task whose results are being generated if ordered
+        while done < len(tasks):
+            item = outs[current].get()
+            if item[1] is _DONE:
+                if item[2] is not None:
+                    raise item[2]
+                done += 1
+                if ordered:
+                    current += 1
+            else:
+                yield item[1]
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+############
+# EXPORTING
+
+EXPORT_FORMATS = ('tsv', 'csv', 'npy')
+
+
+def exportSQL(conn, sql, path, args=None, format='tsv', batch_size=10000,
+              cursorclass=None, header=True, dtypes=None, compresslevel=6,
+              queue_size=4):
+    '''
+    Write the results of a select to disk in constant memory.  Rows are
+    fetched batch_size at a time and handed to a writer thread, so fetching
+    from the database and encoding and compressing overlap.
+
+    conn: an open connection.
+    sql, args: a select statement and its parameters, as in selectSQL.
+    path: for 'tsv' or 'csv', the gzipped file to write, e.g.
+    'term.tsv.gz'.  For 'npy', a directory, which is made if necessary, to
+    write one <column>.npy file per column to.
+    format: 'tsv' writes MySQL dump style tab-delimited text: NULL is \\N
+    and backslashes, tabs and newlines are escaped with a backslash, as
+    mysqldump --tab does, so the GO table reader (tfd.go.read_table_chunks)
+    can read it.  'csv' writes comma
+    separated values with the csv module.  NULL is an empty field.  'npy'
+    writes each column as a 1-d NumPy array file (format version 1.0), which
+    numpy.load() can read (with mmap_mode='r' to avoid reading them into
+    memory.)  Writing them does not require numpy.
+    batch_size: number of rows per fetchmany().
+    cursorclass: passed to doCursor, e.g. a server-side cursor class, to
+    keep the driver from buffering the whole result set.
+    header: if True, the first line of a 'tsv' or 'csv' file holds the
+    column names.
+    dtypes: for 'npy', an optional dict mapping column names to 'i8'
+    (64-bit integers), 'f8' (64-bit floats, with NULL as NaN) or 'S'
+    (utf-8 bytes, padded to the longest value, with NULL as empty).
+    Columns not in dtypes are typed by the first non-NULL value in the first
+    batch: ints (and bools) are 'i8', floats and decimals are 'f8', and
+    everything else is 'S'.  NULLs in an 'i8' column are an error.
+    compresslevel: gzip compression level.  Lower is faster.
+    queue_size: number of batches buffered between the fetching and writing
+    threads.
+    returns: the number of rows written.
+    '''
+    if format not in EXPORT_FORMATS:
+        raise ValueError('Unrecognized export format.', format)
+    with _Call('exportSQL', sql) as call, doCursor(conn, cursorclass) as cursor:
+        cursor.execute(sql, args)
+        names = [column[0] for column in cursor.description]
+        if format == 'npy':
+            writer = _NpyWriter(path, names, dtypes)
+        else:
+            writer = _DelimitedWriter(path, names, format, header, compresslevel)
+        batches = queue.Queue(queue_size)
+        errors = []
+
+        def write():
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    return
+                if not errors:
+                    try:
+                        writer.write(batch)
+                    except Exception:
+                        # keep the traceback of the writer thread.
+                        errors.append(sys.exc_info())
+
+        thread = threading.Thread(target=write)
+        thread.daemon = True
+        thread.start()
+        numRows = 0
+        try:
+            while not errors:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                numRows += len(rows)
+                batches.put(rows)
+        finally:
+            batches.put(None)
+            thread.join()
+            try:
+                writer.close()
+            except Exception:
+                errors.append(sys.exc_info())
+        if errors:
+            _reraise(errors[0])
+        call.rows = numRows
+        return numRows
+
+
+def _toBytes(value):
+    '''
+    Return value as utf-8 encoded bytes.
+    '''
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, float):
+        # repr, unlike str in python 2, round-trips every float.
+        value = repr(value)
+    elif not isinstance(value, type(u'')):
+        value = u'{}'.format(value)
+    return value.encode('utf-8')
+
+
+# as SELECT ... INTO OUTFILE escapes them: a backslash before the literal
+# tab, newline or backslash, and \0 for NUL.
+_TSV_ESCAPES = {b'\\': b'\\\\', b'\t': b'\\\t', b'\n': b'\\\n', b'\0': b'\\0'}
+_TSV_ESCAPE_RE = re.compile(br'[\\\t\n\0]')
+
+
+class _DelimitedWriter(object):
+    '''
+    Writes batches of rows to a gzipped TSV or CSV file.
+    '''
+    def __init__(self, path, names, format, header, compresslevel):
+        self.format = format
+        self.fh = gzip.open(path, 'wb', compresslevel)
+        if format == 'csv':
+            if sys.version_info[0] < 3:
+                self.csv = csv.writer(self.fh)
+            else:
+                self.text = io.TextIOWrapper(self.fh, encoding='utf-8', newline='')
+                self.csv = csv.writer(self.text)
+        if header:
+            self.write([names])
+
+    def write(self, rows):
+        if self.format == 'csv':
+            if sys.version_info[0] < 3:
+                rows = [[v.encode('utf-8') if isinstance(v, unicode) else v
+                         for v in row] for row in rows]
+            self.csv.writerows(rows)
+            return
+        lines = []
+        for row in rows:
+            lines.append(b'\t'.join(
+                b'\\N' if value is None else
+                _TSV_ESCAPE_RE.sub(lambda m: _TSV_ESCAPES[m.group()], _toBytes(value))
+                for value in row))
+            lines.append(b'\n')
+        self.fh.write(b''.join(lines))
+
+    def close(self):
+        if self.format == 'csv' and sys.version_info[0] >= 3:
+            self.text.close()
+        else:
+            self.fh.close()
+
+
+try:
+    _INTEGER_TYPES = (int, long)
+except NameError: # python 3
+    _INTEGER_TYPES = (int,)
+_NPY_HEADER_SIZE = 128 # a multiple of 64, room for any 1-d header.
+_NPY_TYPECODES = {'i8': 'q', 'f8': 'd'}
+
+
+def _npyHeader(descr, length):
+    '''
+    Return the magic string, version and header of a version 1.0 .npy file
+    of a 1-d array.
+    '''
+    header = "{{'descr': '{}', 'fortran_order': False, 'shape': ({:d},), }}".format(descr, length)
+    header = header.ljust(_NPY_HEADER_SIZE - 11) + '\n'
+    return (b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) +
+            header.encode('latin-1'))
+
+
+class _NpyWriter(object):
+    '''
+    Writes batches of rows to one .npy file per column.  Numeric columns are
+    written as they arrive, with the array length filled in at the end.
+    String columns are spooled to a temporary file, because the width of
+    the array is not known until the end.
+    '''
+    def __init__(self, dirpath, names, dtypes):
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        self.dirpath = dirpath
+        self.names = names
+        self.dtypes = dict(dtypes or {})
+        self.files = None
+        self.length = 0
+
+    def _path(self, i):
+        return os.path.join(self.dirpath, self.names[i] + '.npy')
+
+    def _guess(self, values):
+        for value in values:
+            if value is None:
+                continue
+            if isinstance(value, _INTEGER_TYPES):
+                return 'i8'
+            if isinstance(value, (float, decimal.Decimal)):
+                return 'f8'
+            return 'S'
+        return 'S'
+
+    def _open(self, kinds):
+        '''
+        Open the file of each column, given its kind of dtype.
+        '''
+        self.kinds = kinds
+        self.files = []
+        self.widths = [0] * len(self.names)
+        for i, kind in enumerate(self.kinds):
+            if kind in _NPY_TYPECODES:
+                fh = open(self._path(i), 'wb')
+                fh.write(_npyHeader('<' + kind, 0))
+            elif kind == 'S':
+                fh = tempfile.TemporaryFile(dir=self.dirpath)
+            else:
+                raise ValueError('Unrecognized dtype.', self.names[i], kind)
+            self.files.append(fh)
+
+    def write(self, rows):
+        columns = list(zip(*rows))
+        if self.files is None:
+            self._open([self.dtypes.get(name) or self._guess(column)
+                        for name, column in zip(self.names, columns)])
+        self.length += len(rows)
+        for i, column in enumerate(columns):
+            kind = self.kinds[i]
+            if kind == 'S':
+                values = [b'' if v is None else _toBytes(v) for v in column]
+                self.widths[i] = max(self.widths[i], max(len(v) for v in values))
+                self.files[i].write(b''.join(struct.pack('<i', len(v)) + v
+                                             for v in values))
+                continue
+            if kind == 'f8':
+                column = [float('nan') if v is None else float(v) for v in column]
+            elif None in column:
+                raise ValueError('NULL in an integer column.  Use f8.', self.names[i])
+            else:
+                column = [int(v) for v in column]
+            self.files[i].write(struct.pack(
+                '<{:d}{}'.format(len(column), _NPY_TYPECODES[kind]), *column))
+
+    def close(self):
+        if self.files is None: # no rows, so write empty arrays.
+            self._open([self.dtypes.get(name, 'S') for name in self.names])
+        for i, (kind, fh) in enumerate(zip(self.kinds, self.files)):
+            if kind != 'S':
+                fh.seek(0)
+                fh.write(_npyHeader('<' + kind, self.length))
+                fh.close()
+                continue
+            width = max(1, self.widths[i])
+            fh.seek(0)
+            with open(self._path(i), 'wb') as out:
+                out.write(_npyHeader('|S{:d}'.format(width), self.length))
+                for j in range(self.length):
+                    size, = struct.unpack('<i', fh.read(4))
+                    out.write(fh.read(size).ljust(width, b'\0'))
+            fh.close()
+
+
+###########
+# SESSIONS
+
+class Session(object):
+    '''
+    A connection and a reused cursor, with methods that take the same
+    arguments as the module functions, minus conn.  In a tight loop of many
+    small statements, this saves creating and closing a cursor per
+    statement, can keep a prepared cursor per statement, and can send
+    small writes in batches:
+
+        with Session(conn, batch_size=500) as session:
+            for gene, term in pairs:
+                session.deferSQL('INSERT INTO gene_term VALUES (%s, %s)', [gene, term])
+            rows = session.selectSQL('SELECT COUNT(*) FROM gene_term')
+
+    Statements deferred with deferSQL are sent with executemany() when
+    batch_size of them are waiting, when a different statement is deferred,
+    or before any other statement is run, so reads see earlier writes.
+    Leaving a with block flushes deferred statements (unless an exception
+    was raised) and closes the cursors, but not the connection.
+
+    A session can also be passed as conn to the module functions.  They
+    flush deferred statements and run on a cursor of their own, leaving the
+    session's cursors open.
+    '''
+    def __init__(self, conn, prepare=None, max_statements=100,
+                 batch_size=100, cursorclass=None):
+        '''
+        conn: an open connection
+        prepare: None to run every statement on one reused cursor.
+        Otherwise a function that takes conn and returns a cursor that
+        prepares the statements it executes and reuses the prepared
+        statement when executing the same sql again, e.g.
+        lambda conn: conn.cursor(prepared=True) for mysql.connector.  The
+        session keeps one such cursor per distinct sql.  Drivers like
+        sqlite3 cache prepared statements themselves and need no prepare.
+        max_statements: number of prepared cursors to keep.  The least
+        recently used ones are closed.
+        batch_size: maximum number of deferred statements sent at once.
+        cursorclass: passed to conn.cursor() when making the reused cursor.
+        '''
+        self.conn = conn
+        self.prepare = prepare
+        self.max_statements = max_statements
+        self.batch_size = batch_size
+        self.cursorclass = cursorclass
+        self._cursor = None
+        self._prepared = collections.OrderedDict() # sql -> cursor
+        self._deferredSQL = None
+        self._deferred = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        try:
+            if type is None:
+                self.flush()
+        finally:
+            self.close()
+        return False
+
+    def cursor(self, *args):
+        '''
+        Flush deferred statements and return a new cursor of the connection,
+        like conn.cursor(), for module functions passed the session as conn.
+        '''
+        self.flush()
+        return self.conn.cursor(*args)
+
+    def commit(self):
+        '''
+        Flush deferred statements and commit the connection.
+        '''
+        self.flush()
+        self.conn.commit()
+
+    def rollback(self):
+        '''
+        Discard deferred statements and roll back the connection.
+        '''
+        self._deferredSQL, self._deferred = None, []
+        self.conn.rollback()
+
+    def insert_id(self):
+        return self.conn.insert_id()
+
+    def _statementCursor(self, sql):
+        '''
+        returns: the session cursor to execute sql on, making it if necessary.
+        '''
+        if self.prepare is not None:
+            cursor = self._prepared.pop(sql, None)
+            if cursor is None:
+                cursor = self.prepare(self.conn)
+                while len(self._prepared) >= self.max_statements:
+                    self._prepared.popitem(last=False)[1].close()
+            self._prepared[sql] = cursor # most recently used
+            return cursor
+        if self._cursor is None:
+            self._cursor = (self.conn.cursor() if self.cursorclass is None
+                            else self.conn.cursor(self.cursorclass))
+        return self._cursor
+
+    def _execute(self, sql, args):
+        '''
+        Flush deferred statements and execute sql.  Returns the cursor.
+        '''
+        self.flush()
+        cursor = self._statementCursor(sql)
+        try:
+            cursor.execute(sql, args)
+        except Exception:
+            self._discard(sql, cursor)
+            raise
+        return cursor
+
+    def _discard(self, sql, cursor):
+        '''
+        Close a cursor after an error, in case it is no longer usable.
+        '''
+        if self._prepared.get(sql) is cursor:
+            del self._prepared[sql]
+        elif self._cursor is cursor:
+            self._cursor = None
+        try:
+            cursor.close()
+        except Exception:
+            pass
+
+    def selectSQL(self, sql, args=None, asdict=False):
+        '''
+        See selectSQL.
+        '''
+        with _Call('selectSQL', sql) as call:
+            cursor = self._execute(sql, args)
+            tuples = cursor.fetchall()
+            call.rows = len(tuples)
+            if asdict:
+                names = [column[0] for column in cursor.description]
+                return [dict(zip(names, row)) for row in tuples]
+            return tuples
+
+    def insertSQL(self, sql, args=None):
+        '''
+        See insertSQL.  returns: the insert id, from cursor.lastrowid.
+        '''
+        with _Call('insertSQL', sql) as call:
+            cursor = self._execute(sql, args)
+            call.rows = cursor.rowcount
+            return cursor.lastrowid
+
+    def updateSQL(self, sql, args=None):
+        '''
+        See updateSQL.  returns: the number of rows affected.
+        '''
+        with _Call('updateSQL', sql) as call:
+            call.rows = self._execute(sql, args).rowcount
+            return call.rows
+
+    def executeSQL(self, sql, args=None):
+        '''
+        See executeSQL.  returns: the number of rows affected, if any.
+        '''
+        with _Call('executeSQL', sql) as call:
+            call.rows = self._execute(sql, args).rowcount
+            return call.rows
+
+    def executeManySQL(self, sql, args=None):
+        '''
+        See executeManySQL.  returns: the number of rows affected, if known.
+        '''
+        self.flush()
+        with _Call('executeManySQL', sql) as call:
+            cursor = self._statementCursor(sql)
+            try:
+                cursor.executemany(sql, args)
+            except Exception:
+                self._discard(sql, cursor)
+                raise
+            call.rows = cursor.rowcount
+            return call.rows
+
+    def deferSQL(self, sql, args=None):
+        '''
+        Queue a statement with no result, like an INSERT or UPDATE, to be
+        sent later with other deferred statements.  Errors are raised by the
+        call that sends the batch.
+        '''
+        if self._deferred and sql != self._deferredSQL:
+            self.flush()
+        self._deferredSQL = sql
+        self._deferred.append(args)
+        if len(self._deferred) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Send deferred statements.
+        '''
+        if not self._deferred:
+            return
+        sql, args = self._deferredSQL, self._deferred
+        self._deferredSQL, self._deferred = None, []
+        self.executeManySQL(sql, args)
+
+    @contextlib.contextmanager
+    def doTransaction(self, start=True, startSQL='START TRANSACTION'):
+        '''
+        See doTransaction.  Deferred statements are flushed before the
+        commit.  Yields the session.
+        '''
+        with doTransaction(self.conn, start=False):
+            try:
+                if start:
+                    self.executeSQL(startSQL)
+                yield self
+                self.flush()
+            except:
+                # deferred statements belong to the rolled back transaction.
+                self._deferredSQL, self._deferred = None, []
+                raise
+
+    def close(self):
+        '''
+        Close the cursors, discarding any deferred statements.  The
+        connection is left open.
+        '''
+        self._deferredSQL, self._deferred = None, []
+        cursors = list(self._prepared.values())
+        if self._cursor is not None:
+            cursors.append(self._cursor)
+        self._cursor = None
+        self._prepared.clear()
+        for cursor in cursors:
+            cursor.close()
+
 
 # last line
@@ -15,9 +15,37 @@ print pandas.DataFrame(list(go.term_table_dicts()))[:5]
 
 '''
 
+import array
+import bisect
+import collections
+import contextlib
 import datetime
+import fcntl
+import ftplib
+import gzip
+import hashlib
+import itertools
+import json
+import logging
+import math
+import mmap
+import multiprocessing
 import os
-import subprocess
+import re
+import shutil
+import sqlite3
+import struct
+import sys
+import tarfile
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+
+from tfd import dbutil
+from tfd import ftputil
+from tfd import util
 
 
 DIR_MODE = 0775 # directories in this dataset are world readable and group writable.
@@ -27,17 +55,19 @@ DIR_MODE = 0775 # directories in this dataset are world readable and group writa
 # DOWNLOAD / INSTALL GENE ONTOLOGY
 
 
-def guess_latest_release(today=None):
+def guess_latest_release(today=None, cache=None, dataset='termdb'):
     '''
     Full releases seem to be published sometime in the first or second week
     of the month and named using the first day of the month, so a conservative
     guess which will get the lastest or penultimate release would be the first
-    day of the previous month.  
+    day of the previous month.  If the release cache has a release of dataset
+    at least that recent, the latest cached release is returned instead.
     
     Return the release as an iso format string, YYYY-MM-DD.  E.g. '2012-06-01'.
 
     today: Used for testing that the return value really is the first of the
     previous month, even when "today" is in January.
+    cache: a ReleaseCache or cache dir.  See release_cache().
     '''
     if today is None:
         today = datetime.date.today()
@@ -45,13 +75,24 @@ def guess_latest_release(today=None):
         release = datetime.date(today.year - 1, 12, 1)
     else:
         release = datetime.date(today.year, today.month - 1, 1)
-    return release.isoformat()
+    release = release.isoformat()
+    cache = release_cache(cache)
+    if cache is not None:
+        cached = cache.releases(dataset)
+        if cached and cached[-1] >= release:
+            return cached[-1]
+    return release
 
 
-def install_in_dir(root=None, release=None, dataset='termdb'):
+def install_in_dir(root=None, release=None, dataset='termdb', tables=None,
+                   url=None, convert=False, cache=None, segments=None):
     '''
     Download and unpack a Gene Ontology termdb release under a local dir.
 
+    The tarball is unpacked as it downloads, so it is never written to disk.
+    Files are unpacked into a temporary dir which is renamed to the release
+    dir when complete, replacing any existing release dir.
+
     root: a directory in which to install the termdb tables release.  Defaults
     to the current directory.
     release: the specific release to download and install, as a iso formatted
@@ -61,54 +102,362 @@ def install_in_dir(root=None, release=None, dataset='termdb'):
     the go terms.  assocdb contains termdb and defines term-gene product
     associations.  seqdb contains assocdb and defines the sequences associated
     with the gene products.
+    tables: if not None, only unpack the files of these tables, e.g.
+    ['term', 'term2term', 'graph_path'].  The release dir is replaced, not
+    merged into, so tables installed before and not in tables are removed.
+    url: download the tarball from here instead of tables_url(release,
+    dataset).  Any url urllib2 can open works, e.g. a file:// url.
+    convert: if True, write the table cache (see write_table_cache) of each
+    table before the release dir is moved into place.
+    cache: a ReleaseCache or cache dir.  See release_cache().  If there is a
+    cache, the release is installed in (or found in) the cache and root is
+    ignored.
+    segments: if not None, download the tarball to disk in this many parallel
+    segments (see download()) before unpacking it, instead of unpacking it as
+    it downloads.  The download can be resumed if it is interrupted, which is
+    useful for the large assocdb and seqdb datasets.
 
     return: the directory in which the release was installed.  This should be
     a dir under root named after the release, e.g.
     '/path/to/root/go_201206-termdb-tables'
     This dir is useful for creating a GeneOntology object.
     '''
+    cache = release_cache(cache)
+    release = release or guess_latest_release(cache=cache, dataset=dataset)
+    if cache is not None:
+        return cache.install(release, dataset, tables, url, convert,
+                             segments)
     root = os.path.abspath(root) if root is not None else os.getcwd()
-    release = release or guess_latest_release()
-    url = tables_url(release, dataset)
-    destbase = tables_basename(release, dataset)
-    dest = os.path.join(root, destbase) # download to here
+    url = url or tables_url(release, dataset)
+    dest = tables_dir(root, release, dataset, cache=False)
+    tmp = '{}.tmp{}'.format(dest, os.getpid())
 
-    # download to /path/to/root/go_201206-termdb-tables.tar.gz
     if not os.path.exists(root):
         os.makedirs(root, DIR_MODE)
-    print 'downloading {} to {}...'.format(url, dest)
-    cmd = ['curl', '--remote-time', '--output', dest, url]
-    subprocess.check_call(cmd)
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.mkdir(tmp, DIR_MODE)
+    try:
+        if segments:
+            tarball = tables_file(root, release, dataset)
+            print 'downloading {} to {}...'.format(url, tarball)
+            download(url, tarball, segments, progress=print_progress)
+            print 'unpacking {} to {}...'.format(tarball, dest)
+            unpack_tables('file://' + urllib.pathname2url(tarball), tmp,
+                          tables)
+            os.remove(tarball)
+        else:
+            print 'downloading and unpacking {} to {}...'.format(url, dest)
+            unpack_tables(url, tmp, tables)
+        if convert:
+            for table in release_tables(tmp):
+                print '...caching table', table
+                write_table_cache(tmp, table)
+        if os.path.exists(dest):
+            old = tmp + '.old'
+            os.rename(dest, old)
+            shutil.rmtree(old)
+        os.rename(tmp, dest)
+    except:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+    # return /path/to/root/go_201206-termdb-tables
+    return dest
 
-    # untar to /path/to/root/go_201206-termdb-tables
-    print 'processing tarball', dest
-    print '...tar xzf file'
-    subprocess.check_call(['tar', '-xzf', destbase],
-                            cwd=root)
 
-    print 'removing tarball', dest
-    os.remove(dest)
+def unpack_tables(url, dest, tables=None, bufsize=1 << 20):
+    '''
+    Stream the gzipped tables tarball at url, writing the regular files in it
+    to the directory dest.  The directories of the tarball are flattened, so
+    e.g. 'go_201206-termdb-tables/term.txt' is written to dest/term.txt.
+    Raise an exception if two files would be written to the same path.
+    Return a list of the paths written.
 
-    # return /path/to/root/go_201206-termdb-tables
-    return tables_dir(root, release, dataset)
+    tables: if not None, only write files whose name without extension is in
+    tables, e.g. 'term' for 'term.sql' and 'term.txt'.
+    '''
+    paths = []
+    written = set()
+    response = urllib2.urlopen(url)
+    try:
+        tar = tarfile.open(fileobj=response, mode='r|gz')
+        for member in tar:
+            name = os.path.basename(member.name)
+            if not member.isfile() or not name:
+                continue
+            if tables is not None and name.split('.')[0] not in tables:
+                continue
+            path = os.path.join(dest, name)
+            if path in written:
+                raise Exception('Duplicate file name in tarball.', name,
+                                member.name)
+            written.add(path)
+            with open(path, 'wb') as fh:
+                shutil.copyfileobj(tar.extractfile(member), fh, bufsize)
+            os.utime(path, (member.mtime, member.mtime))
+            paths.append(path)
+        tar.close()
+    finally:
+        response.close()
+    return paths
+
+
+###########
+# DOWNLOADS
+
+# Files smaller than this are not split into segments.
+MIN_SEGMENT_SIZE = 1 << 20
+
+
+def download(url, dest, segments=1, progress=None, retries=3,
+             bufsize=1 << 16):
+    '''
+    Download url (an ftp, http(s) or file url) to the file dest.
+
+    The file is downloaded in segments, each fetched over its own connection
+    in its own thread, using FTP REST or HTTP Range requests, and written to
+    its own part file next to dest.  The parts are concatenated into dest
+    when all are complete.  A segment that fails is resumed from the end of
+    its part file, up to retries times.  Part files left behind by an
+    interrupted download are resumed by the next download of the same url to
+    the same dest, as long as the remote size and number of segments are the
+    same.
+
+    segments: the number of segments to download in parallel.  Servers which
+    do not report the file size get one segment.
+    progress: a function called about once a second, and at the end, with the
+    bytes downloaded so far, the total bytes (or None if unknown), and the
+    throughput of this download in bytes per second.  See print_progress.
+    retries: how many times to resume a segment after an error.
+    '''
+    size = _remote_size(url)
+    if size is None or size < MIN_SEGMENT_SIZE * 2:
+        segments = 1
+    if size is None:
+        ranges = [(0, None)]
+    elif size == 0:
+        ranges = [(0, 0)]
+    else:
+        step = -(-size // segments) # ceiling division
+        ranges = [(start, min(start + step, size))
+                  for start in xrange(0, size, step)]
+    parts = ['{}.part-{}-{}of{}'.format(dest, size, i, len(ranges))
+             for i in xrange(len(ranges))]
+
+    counter = _ByteCounter([_part_size(part) for part in parts])
+    errors = []
+    def fetch(segment, part, start, end):
+        try:
+            util.retryErrorExecute(_fetch_range, [url, part, segment, start,
+                                                  end, counter, bufsize],
+                                   numTries=retries + 1, delay=1, backoff=2)
+        except Exception:
+            logging.exception('Error downloading %s to %s', url, part)
+            # keep the traceback of the failing thread.
+            errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=fetch, args=(i, part, start, end))
+               for i, (part, (start, end)) in enumerate(zip(parts, ranges))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1.0)
+            if progress and thread.is_alive():
+                progress(counter.total(), size, counter.rate())
+    if progress:
+        progress(counter.total(), size, counter.rate())
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+    tmp = '{}.tmp{}'.format(dest, os.getpid())
+    with open(tmp, 'wb') as out:
+        for part in parts:
+            with open(part, 'rb') as fh:
+                shutil.copyfileobj(fh, out, 1 << 20)
+    if size is not None and os.path.getsize(tmp) != size:
+        os.remove(tmp)
+        raise Exception('Downloaded size does not match remote size.', url,
+                        size)
+    os.rename(tmp, dest)
+    for part in parts:
+        os.remove(part)
+    return dest
+
+
+def print_progress(done, total, rate):
+    '''
+    A download() progress function which prints e.g.
+    '...12.5MB of 100.0MB (12.5%) at 2.1MB/s'
+    '''
+    if total:
+        print '...{} of {} ({:.1f}%) at {}/s'.format(
+            util.humanBytes(done), util.humanBytes(total),
+            100.0 * done / total, util.humanBytes(rate))
+    else:
+        print '...{} at {}/s'.format(util.humanBytes(done),
+                                     util.humanBytes(rate))
+
+
+class _ByteCounter(object):
+    '''
+    Thread-safe counts of bytes downloaded, per segment, and the throughput
+    of bytes downloaded since the counter was made.
+    '''
+    def __init__(self, initial):
+        self.counts = list(initial)
+        self.initial = sum(initial)
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, segment, num):
+        with self.lock:
+            self.counts[segment] += num
+
+    def reset(self, segment, num):
+        with self.lock:
+            self.counts[segment] = num
+
+    def total(self):
+        with self.lock:
+            return sum(self.counts)
+
+    def rate(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        return (self.total() - self.initial) / elapsed
+
+
+def _part_size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def _fetch_range(url, part, segment, start, end, counter, bufsize):
+    '''
+    Download bytes [start, end) of url to the file part, resuming from the
+    end of part if it already has some bytes.  end is None to read to the end
+    of the file.  Progress is counted under segment in counter.
+    '''
+    have = _part_size(part)
+    if end is not None and have > end - start: # corrupt part.  start over.
+        have = 0
+        open(part, 'wb').close()
+    counter.reset(segment, have)
+    if end is not None and have == end - start:
+        open(part, 'ab').close() # an empty segment still needs its part.
+        return
+    offset = start + have
+    remaining = None if end is None else end - offset
+    fh, close = _open_range(url, offset, end)
+    try:
+        with open(part, 'ab' if have else 'wb') as out:
+            while remaining is None or remaining > 0:
+                size = bufsize if remaining is None else min(bufsize,
+                                                             remaining)
+                data = fh.read(size)
+                if not data:
+                    break
+                out.write(data)
+                counter.add(segment, len(data))
+                if remaining is not None:
+                    remaining -= len(data)
+    finally:
+        close()
+    if remaining:
+        raise Exception('Connection closed before the end of the segment.',
+                        url, offset, end)
+
+
+def _remote_size(url):
+    '''
+    Return the size in bytes of the file at url, or None if the server does
+    not say or does not support ranged requests.
+    '''
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    if scheme == 'file':
+        return os.path.getsize(urllib.url2pathname(path))
+    elif scheme == 'ftp':
+        with ftputil.connect_and_login(url) as ftp:
+            try:
+                ftp.voidcmd('TYPE I')
+                size = ftp.size(path)
+            except ftplib.error_perm:
+                size = None
+        ftp.close()
+        return size
+    else:
+        request = urllib2.Request(url)
+        request.get_method = lambda: 'HEAD'
+        response = urllib2.urlopen(request)
+        try:
+            headers = response.info()
+            if headers.get('Accept-Ranges') != 'bytes':
+                return None
+            length = headers.get('Content-Length')
+            return int(length) if length is not None else None
+        finally:
+            response.close()
+
+
+def _open_range(url, start, end):
+    '''
+    Return a file-like object for reading url from byte start, and a
+    function to call when done with it.  Reading may go past end.
+    '''
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    if scheme == 'file':
+        fh = open(urllib.url2pathname(path), 'rb')
+        fh.seek(start)
+        return fh, fh.close
+    elif scheme == 'ftp':
+        with ftputil.connect_and_login(url) as ftp:
+            ftp.voidcmd('TYPE I')
+            conn = ftp.transfercmd('RETR ' + path, rest=start or None)
+            fh = conn.makefile('rb')
+            def close():
+                # closing the data connection aborts the transfer if it is
+                # incomplete, so do not wait for the transfer complete reply.
+                fh.close()
+                conn.close()
+                ftp.close()
+            return fh, close
+    else:
+        request = urllib2.Request(url)
+        if start or end is not None:
+            request.add_header('Range', 'bytes={}-{}'.format(
+                start, '' if end is None else end - 1))
+        response = urllib2.urlopen(request)
+        if start and response.getcode() != 206:
+            response.close()
+            raise Exception('Server does not support ranged requests.', url)
+        return response, response.close
 
 
 ##########################
 # GENERAL TABLES FUNCTIONS
 
-def tables_dir(root=None, release=None, dataset='termdb'):
+def tables_dir(root=None, release=None, dataset='termdb', cache=None):
     '''
     Return the directory in which the release should be installed under root.
     This is useful for getting the dir for creating a GeneOntology object.
     e.g. '/path/to/root/go_201206-termdb-tables'
+    If the release is in the release cache, the cached release dir is
+    returned instead.
 
     dataset: Can be 'termdb' (default), 'assocdb', or 'seqdb'.  termdb defines
     the go terms.  assocdb contains termdb and defines term-gene product
     associations.  seqdb contains assocdb and defines the sequences associated
     with the gene products.
+    cache: a ReleaseCache or cache dir.  See release_cache().
     '''
+    cache = release_cache(cache)
+    release = release or guess_latest_release(cache=cache, dataset=dataset)
+    if cache is not None:
+        cached = cache.lookup(release, dataset, tables=())
+        if cached:
+            return cached
     root = os.path.abspath(root) if root is not None else os.getcwd()
-    release = release or guess_latest_release()
     tarfile = tables_file(root, release, dataset)
     return tarfile[:-7] # remove '.tar.gz'
 
@@ -155,68 +504,2221 @@ def tables_file(root, release, dataset='termdb'):
     return os.path.join(root, basename)
 
 
-########################
-# GENE ONTOLOGY DATABASE
+###############
+# RELEASE CACHE
 
-class GeneOntology(object):
+# If set, the directory of the release cache used by default.
+CACHE_ENV_VAR = 'TFD_GO_CACHE'
+
+
+class ReleaseCache(object):
     '''
-    An abstraction layer around a filesystem installation of a Gene
-    Ontology release.  This object provides access to the tables in 
-    Gene Ontology.  Well, currently only the term table.
+    A directory of installed releases shared by many processes, e.g. every
+    job of an array job or every node mounting a shared filesystem.  Each
+    release is installed at most once: installers take a lock on the release,
+    so concurrent installers of the same release wait for the one download
+    instead of all downloading it.
 
-    From the CREATE TABLE statement in the term.sql file we can see that
-    the fields are:
-        `id` int(11) NOT NULL AUTO_INCREMENT,
-        `name` varchar(255) NOT NULL DEFAULT '',
-        `term_type` varchar(55) NOT NULL,
-        `acc` varchar(255) NOT NULL,
-        `is_obsolete` int(11) NOT NULL DEFAULT '0',
-        `is_root` int(11) NOT NULL DEFAULT '0',
-        `is_relation` int(11) NOT NULL DEFAULT '0',
+    Next to each installed release dir is a metadata file recording the size
+    and mtime of every file in it.  A release is a cache hit only if its files
+    still match the metadata, so a partially deleted or modified release is
+    reinstalled.
     '''
-    def __init__(self, release_dir):
+    def __init__(self, root):
         '''
-        release_dir:  The directory the release is installed in, e.g.
-        '/path/to/root/go_201206-termdb-tables'
+        root: the cache directory.  Created if it does not exist.
         '''
-        self.release_dir = release_dir
+        self.root = os.path.abspath(root)
+        if not os.path.exists(self.root):
+            try:
+                os.makedirs(self.root, DIR_MODE)
+            except OSError:
+                if not os.path.isdir(self.root): # lost a race to make it?
+                    raise
 
-    def _term_table_file(self):
+    def release_dir(self, release, dataset='termdb'):
+        return tables_dir(self.root, release, dataset, cache=False)
+
+    def _metadata_file(self, release, dataset):
+        return self.release_dir(release, dataset) + '.json'
+
+    def _lock_file(self, release, dataset):
+        return self.release_dir(release, dataset) + '.lock'
+
+    def _metadata(self, release, dataset):
+        try:
+            with open(self._metadata_file(release, dataset)) as fh:
+                return json.load(fh)
+        except (IOError, ValueError):
+            return None
+
+    def lookup(self, release, dataset='termdb', tables=None):
         '''
-        Return the path to the term.txt file of the release.
-        e.g. '/path/to/root/go_201206-termdb-tables/term.txt'
+        Return the release dir if release is in the cache, contains tables
+        (or all tables if tables is None), and its installed files match the
+        cache metadata.  Otherwise return None.
         '''
-        return os.path.join(self.release_dir, 'term.txt')
+        meta = self._metadata(release, dataset)
+        if meta is None:
+            return None
+        if meta['tables'] is not None and (
+            tables is None or not set(tables) <= set(meta['tables'])):
+            return None
+        release_dir = self.release_dir(release, dataset)
+        stats = _file_stats(release_dir)
+        if stats is None or any(stats.get(name) != value for name, value in
+                                meta['files'].iteritems()):
+            return None
+        return release_dir
 
-    def term_table_fields(self):
+    def releases(self, dataset='termdb'):
         '''
-        Return a tuple containing all the field names.
+        Return a sorted list of the releases of dataset in the cache,
+        including releases with only some tables installed.
         '''
-        return ('id', 'name', 'term_type', 'acc', 'is_obsolete', 'is_root',
-                'is_relation')
+        suffix = '-{}-tables.json'.format(dataset)
+        releases = []
+        for name in os.listdir(self.root):
+            if name.startswith('go_') and name.endswith(suffix):
+                yyyymm = name[3:-len(suffix)]
+                release = '{}-{}-01'.format(yyyymm[:4], yyyymm[4:])
+                if self.lookup(release, dataset, tables=()):
+                    releases.append(release)
+        return sorted(releases)
 
-    def term_table_tuples(self):
+    def install(self, release, dataset='termdb', tables=None, url=None,
+                convert=False, segments=None):
         '''
-        Iterate over the rows of the term table, yielding a tuple of the
-        row values converted to int or str as appropriate.
+        Return the release dir of release, installing it first unless it is
+        already in the cache.  See install_in_dir for the parameters.
         '''
-        field_types = (int, str, str, str, int, int, int)
-        num = len(field_types)
-        with open(self._term_table_file()) as fh:
-            for line in fh:
-                fields = line.strip().split('\t')
-                yield tuple(field_types[i](fields[i]) for i in range(num))
+        release_dir = self.lookup(release, dataset, tables)
+        if release_dir:
+            return release_dir
+        with _locked(self._lock_file(release, dataset)):
+            # another process may have installed it while we waited.
+            release_dir = self.lookup(release, dataset, tables)
+            if release_dir:
+                return release_dir
+            meta = self._metadata(release, dataset)
+            if meta is not None and tables is not None and meta['tables']:
+                tables = sorted(set(tables) | set(meta['tables']))
+            release_dir = install_in_dir(self.root, release, dataset, tables,
+                                         url, convert, False, segments)
+            meta = {'release': release, 'dataset': dataset,
+                    'tables': None if tables is None else sorted(tables),
+                    'files': _file_stats(release_dir)}
+            path = self._metadata_file(release, dataset)
+            tmp = '{}.tmp{}'.format(path, os.getpid())
+            with open(tmp, 'w') as fh:
+                json.dump(meta, fh)
+            os.rename(tmp, path)
+            return release_dir
 
-    def term_table_dicts(self):
+
+def release_cache(cache=None):
+    '''
+    Return a ReleaseCache or None.
+
+    cache: a ReleaseCache, which is returned, or a cache directory.  If None,
+    the directory in the TFD_GO_CACHE environment variable is used, if set.
+    If False, return None.
+    '''
+    if cache is None:
+        cache = os.environ.get(CACHE_ENV_VAR) or False
+    if cache is False or isinstance(cache, ReleaseCache):
+        return cache or None
+    return ReleaseCache(cache)
+
+
+@contextlib.contextmanager
+def _locked(path):
+    '''
+    Hold an exclusive lock on the file at path, creating it if needed.
+    '''
+    with open(path, 'a') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def _file_stats(dirname):
+    '''
+    Return a dict mapping the name of each file in dirname to a list of its
+    size and mtime, or None if dirname does not exist.
+    '''
+    if not os.path.isdir(dirname):
+        return None
+    stats = {}
+    for name in os.listdir(dirname):
+        st = os.stat(os.path.join(dirname, name))
+        stats[name] = [st.st_size, int(st.st_mtime)]
+    return stats
+
+
+####################
+# TABLE SCHEMA FILES
+
+# MySQL dumps write NULL values as \N in the tab-delimited table files.
+NULL = '\\N'
+
+SQL_INT_TYPES = ('tinyint', 'smallint', 'mediumint', 'int', 'integer',
+                 'bigint')
+SQL_FLOAT_TYPES = ('float', 'double', 'real', 'decimal', 'numeric')
+
+# Used when a release is missing term.sql.  Taken from the CREATE TABLE
+# statement in the term.sql file of the 2012-06-01 release.
+TERM_SCHEMA = (('id', 'int'), ('name', 'varchar'), ('term_type', 'varchar'),
+               ('acc', 'varchar'), ('is_obsolete', 'int'),
+               ('is_root', 'int'), ('is_relation', 'int'))
+
+# Table cache files hold the pickled columns of a table.
+TABLE_CACHE_EXT = '.columns'
+
+# Escape sequences written by mysqldump --tab in text fields.
+_UNESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', '0': '\0', '\\': '\\',
+              'Z': '\x1a', 'b': '\b'}
+_ESCAPE_RE = re.compile(r'\\(.)', re.DOTALL)
+# a backslash escape or an unescaped field separator.
+_FIELD_SEP_RE = re.compile(r'\\.|\t', re.DOTALL)
+_COLUMN_RE = re.compile(r'^\s*`(\w+)`\s+(\w+)', re.MULTILINE)
+
+
+def parse_table_schema(sql):
+    '''
+    Parse the CREATE TABLE statement in sql, the contents of a table .sql file
+    from a release, and return a tuple of (column_name, sql_type) pairs in
+    table order.  sql_type is lowercased and stripped of any size, e.g.
+    'int', 'varchar', 'double'.  Index definitions are ignored.
+
+    Example:
+
+        parse_table_schema(open('term2term.sql').read())
+        (('id', 'int'), ('relationship_type_id', 'int'), ('term1_id', 'int'),
+         ('term2_id', 'int'), ('complete', 'int'))
+    '''
+    start = sql.find('CREATE TABLE')
+    if start == -1:
+        raise ValueError('No CREATE TABLE statement found.')
+    columns = tuple((name, sql_type.lower()) for name, sql_type in
+                    _COLUMN_RE.findall(sql, start))
+    if not columns:
+        raise ValueError('No columns found in CREATE TABLE statement.')
+    return columns
+
+
+def sql_type_converter(sql_type):
+    '''
+    Return the python type (int, float or str) used to convert a field of the
+    given (lowercased) MySQL column type.
+    '''
+    if sql_type in SQL_INT_TYPES:
+        return int
+    elif sql_type in SQL_FLOAT_TYPES:
+        return float
+    else:
+        return str
+
+
+def read_table_chunks(path, converters, chunk_size=1 << 22):
+    '''
+    Read a tab-delimited table file in chunks of roughly chunk_size bytes,
+    yielding each chunk as a list of columns, one per converter.  Each column
+    is a sequence of the field values in the chunk, converted using the
+    corresponding converter (int, float or str).  \\N fields are converted to
+    None and mysqldump escape sequences in str fields are unescaped.  As
+    written by mysqldump --tab and SELECT ... INTO OUTFILE, a tab or newline
+    in a field is escaped as a backslash followed by the literal character,
+    so fields are split only on unescaped tabs and rows only on unescaped
+    newlines.
+
+    Fields are split a chunk at a time and converted a column at a time,
+    which avoids the cost of calling python code for every field of every row.
+
+    path: a table file, e.g. '/path/to/go_201206-assocdb-tables/association.txt'
+    converters: a sequence of int, float, or str.
+    '''
+    num = len(converters)
+    with open(path) as fh:
+        while True:
+            lines = fh.readlines(chunk_size)
+            if not lines:
+                break
+            if '\\' in ''.join(lines):
+                # finish a row continued past the chunk by an escaped newline.
+                line = lines[-1]
+                while line.endswith('\n') and _is_continued(line[:-1]):
+                    line = fh.readline()
+                    lines.append(line)
+                rows = _split_escaped_rows(lines)
+            else:
+                rows = [line.rstrip('\n').split('\t') for line in lines]
+            if set(map(len, rows)) != set([num]):
+                bad = [row for row in rows if len(row) != num][0]
+                raise ValueError('Expected {} fields in {}.'.format(num, path),
+                                 bad)
+            yield [_convert_column(col, conv) for col, conv in
+                   zip(zip(*rows), converters)]
+
+
+def _is_continued(line):
+    '''
+    Return True if line ends with an escaped newline, i.e. an odd number of
+    backslashes (the newline itself stripped.)
+    '''
+    return (len(line) - len(line.rstrip('\\'))) % 2 == 1
+
+
+def _split_escaped_rows(lines):
+    '''
+    Return the rows of lines, which may contain escapes, as lists of fields.
+    Lines ending in an escaped newline are joined to the next line, and
+    fields are split on unescaped tabs.  Fields are not unescaped.
+    '''
+    rows = []
+    pending = ''
+    for line in lines:
+        line = pending + line
+        if line.endswith('\n'):
+            line = line[:-1]
+            if _is_continued(line):
+                pending = line + '\n'
+                continue
+        pending = ''
+        fields = []
+        start = 0
+        for match in _FIELD_SEP_RE.finditer(line):
+            if match.group() == '\t':
+                fields.append(line[start:match.start()])
+                start = match.end()
+        fields.append(line[start:])
+        rows.append(fields)
+    if pending:
+        rows.append(_split_escaped_rows([pending[:-1]])[0])
+    return rows
+
+
+def _convert_column(col, conv):
+    '''
+    Convert a tuple of field strings using conv, mapping \\N to None.
+    '''
+    if conv is str:
+        if '\\' not in '\t'.join(col):
+            return col
+        return tuple(None if value == NULL else _unescape(value)
+                     for value in col)
+    elif NULL in col:
+        return [None if value == NULL else conv(value) for value in col]
+    else:
+        return map(conv, col)
+
+
+def _unescape(value):
+    return _ESCAPE_RE.sub(lambda m: _UNESCAPES.get(m.group(1), m.group(1)),
+                          value)
+
+
+def _is_fresh(path, source):
+    '''
+    Return True if path exists and source is missing or not newer than path.
+    '''
+    if not os.path.exists(path):
+        return False
+    return (not os.path.exists(source) or
+            os.path.getmtime(source) <= os.path.getmtime(path))
+
+
+def table_cache_file(release_dir, table):
+    '''
+    Return the path of the table cache file of table.
+    e.g. '/path/to/root/go_201206-termdb-tables/term.columns'
+    '''
+    return os.path.join(release_dir, table + TABLE_CACHE_EXT)
+
+
+def write_table_cache(release_dir, table):
+    '''
+    Read table from its text file and pickle its columns (see
+    GeneOntology.table_columns) to the table cache file, which is much faster
+    to load than the text file.  Return the path of the cache file.
+    '''
+    columns = GeneOntology(release_dir).table_columns(table)
+    path = table_cache_file(release_dir, table)
+    tmp = '{}.tmp{}'.format(path, os.getpid())
+    util.dumpObject(columns, tmp)
+    os.rename(tmp, path)
+    return path
+
+
+################
+# ONTOLOGY GRAPH
+
+# Names of the CSR arrays of a TermGraph.  For term index i, the parents of i
+# are parent_idx[parent_ptr[i]:parent_ptr[i+1]], related to i by the relations
+# in the same slice of parent_rel, and likewise for the other arrays.
+GRAPH_ARRAYS = ('parent_ptr', 'parent_idx', 'parent_rel',
+                'child_ptr', 'child_idx', 'child_rel',
+                'ancestor_ptr', 'ancestor_idx',
+                'descendant_ptr', 'descendant_idx')
+
+
+class TermGraph(object):
+    '''
+    The Gene Ontology DAG, with terms numbered 0..n-1 in acc order and the
+    edges and the transitive closure of the edges stored as compressed sparse
+    row (CSR) arrays.  Ancestor and descendant queries are array slices, not
+    graph traversals.  Ancestors and descendants are strict, i.e. a term is
+    not its own ancestor.
+
+    Use build_term_graph() or GeneOntology.graph() to make one.
+    '''
+    def __init__(self, accs, relations, arrays, index=None):
         '''
-        Iterate over the rows of the term table, yielding a dict mapping 
-        each field name to the field value for the row, converted to int or
-        str as appropriate.
+        accs: a sequence of term accs, sorted.  The position of an acc is its
+        term index.
+        relations: a sequence of relation names, e.g. ('is_a', 'part_of').
+        The position of a name is the relation index used in parent_rel and
+        child_rel.
+        arrays: a dict containing the arrays named in GRAPH_ARRAYS.
+        index: a mapping from acc to term index.  Built from accs if None.
+        '''
+        self.accs = accs
+        self.relations = relations
+        for name in GRAPH_ARRAYS:
+            setattr(self, name, arrays[name])
+        self.index = index if index is not None else {
+            acc: i for i, acc in enumerate(accs)}
+        self._ancestor_bits = {}
+
+    def __len__(self):
+        return len(self.accs)
+
+    def __contains__(self, acc):
+        return acc in self.index
+
+    def _slice(self, ptr, idx, i):
+        return idx[ptr[i]:ptr[i + 1]]
+
+    def parent_indices(self, i):
+        return self._slice(self.parent_ptr, self.parent_idx, i)
+
+    def child_indices(self, i):
+        return self._slice(self.child_ptr, self.child_idx, i)
+
+    def ancestor_indices(self, i):
+        return self._slice(self.ancestor_ptr, self.ancestor_idx, i)
+
+    def descendant_indices(self, i):
+        return self._slice(self.descendant_ptr, self.descendant_idx, i)
+
+    def ancestor_bits(self, i):
+        '''
+        Return an int with the bits of the ancestors of term index i set.
+        Bitsets are computed on first use and cached.
+        '''
+        bits = self._ancestor_bits.get(i)
+        if bits is None:
+            bits = 0
+            for j in self.ancestor_indices(i):
+                bits |= 1 << j
+            self._ancestor_bits[i] = bits
+        return bits
+
+    def compute_bitsets(self):
+        '''
+        Compute and cache the ancestor bitset of every term.
+        '''
+        for i in xrange(len(self)):
+            self.ancestor_bits(i)
+
+    def parents(self, acc):
+        '''
+        Return a list of (parent_acc, relation_name) tuples for acc.
+        '''
+        i = self.index[acc]
+        start, end = self.parent_ptr[i], self.parent_ptr[i + 1]
+        return [(self.accs[j], self.relations[r]) for j, r in
+                zip(self.parent_idx[start:end], self.parent_rel[start:end])]
+
+    def children(self, acc):
+        '''
+        Return a list of (child_acc, relation_name) tuples for acc.
+        '''
+        i = self.index[acc]
+        start, end = self.child_ptr[i], self.child_ptr[i + 1]
+        return [(self.accs[j], self.relations[r]) for j, r in
+                zip(self.child_idx[start:end], self.child_rel[start:end])]
+
+    def ancestors(self, acc):
+        '''
+        Return a list of the accs of the ancestors of acc.
+        '''
+        accs = self.accs
+        return [accs[j] for j in self.ancestor_indices(self.index[acc])]
+
+    def descendants(self, acc):
+        '''
+        Return a list of the accs of the descendants of acc.
+        '''
+        accs = self.accs
+        return [accs[j] for j in self.descendant_indices(self.index[acc])]
+
+    def propagate_indices(self, indices):
+        '''
+        Return a set of term indices and all of their ancestors.  This is the
+        true path rule: an annotation to a term implies annotations to all
+        of its ancestors.
+        '''
+        terms = set(indices)
+        for i in indices:
+            terms.update(self.ancestor_indices(i))
+        return terms
+
+    def propagate(self, accs):
+        '''
+        Return a set of accs and the accs of all of their ancestors.
+        '''
+        index = self.index
+        return set(self.accs[j] for j in
+                   self.propagate_indices([index[acc] for acc in accs]))
+
+    def lowest_common_ancestor_indices(self, i, j):
+        '''
+        Return a list of the indices of the lowest common ancestors of term
+        indices i and j.  A term counts as its own ancestor here, so the lowest
+        common ancestor of a term and its descendant is the term.
+        '''
+        common = ((self.ancestor_bits(i) | (1 << i)) &
+                  (self.ancestor_bits(j) | (1 << j)))
+        members = _bit_indices(common)
+        redundant = 0
+        for k in members:
+            redundant |= self.ancestor_bits(k)
+        return [k for k in members if not (redundant >> k) & 1]
+
+    def lowest_common_ancestors(self, acc1, acc2):
+        '''
+        Return a list of the accs of the lowest common ancestors of acc1 and
+        acc2.
+        '''
+        index = self.index
+        return [self.accs[k] for k in
+                self.lowest_common_ancestor_indices(index[acc1], index[acc2])]
+
+
+def build_term_graph(accs, relations, edges, closure=None, bitsets=False):
+    '''
+    Build a TermGraph.
+
+    accs: a sorted sequence of term accs.
+    relations: a sequence of relation names.
+    edges: an iterable of (child, parent, relation) index triples, where
+    child and parent are term indices and relation is a relation index.
+    closure: an iterable of (descendant, ancestor) term index pairs, the
+    transitive closure of edges, e.g. from the graph_path table.  Pairs of a
+    term with itself are ignored.  If None, the closure is computed from edges.
+    bitsets: if True, precompute the ancestor bitset of every term.
+    '''
+    n = len(accs)
+    edges = sorted(set(edges))
+    arrays = {}
+    arrays['parent_ptr'], arrays['parent_idx'] = _csr(n, edges)
+    arrays['parent_rel'] = array.array('l', (e[2] for e in edges))
+    redges = sorted((p, c, r) for c, p, r in edges)
+    arrays['child_ptr'], arrays['child_idx'] = _csr(n, redges)
+    arrays['child_rel'] = array.array('l', (e[2] for e in redges))
+    if closure is None:
+        ancestors = _transitive_closure(n, arrays['parent_ptr'],
+                                        arrays['parent_idx'],
+                                        arrays['child_ptr'],
+                                        arrays['child_idx'])
+    else:
+        ancestors = [set() for i in xrange(n)]
+        for d, a in closure:
+            if d != a:
+                ancestors[d].add(a)
+    ancestors = [sorted(anc) for anc in ancestors]
+    descendants = [[] for i in xrange(n)]
+    for i, anc in enumerate(ancestors):
+        for a in anc:
+            descendants[a].append(i)
+    arrays['ancestor_ptr'], arrays['ancestor_idx'] = _csr_from_lists(ancestors)
+    arrays['descendant_ptr'], arrays['descendant_idx'] = _csr_from_lists(
+        descendants)
+    graph = TermGraph(accs, tuple(relations), arrays)
+    if bitsets:
+        graph.compute_bitsets()
+    return graph
+
+
+def _csr(n, pairs):
+    '''
+    Return the (ptr, idx) CSR arrays of the sorted (row, col, ...) tuples in
+    pairs, for rows 0..n-1.
+    '''
+    ptr = array.array('l', [0]) * (n + 1)
+    for pair in pairs:
+        ptr[pair[0] + 1] += 1
+    for i in xrange(n):
+        ptr[i + 1] += ptr[i]
+    idx = array.array('l', (pair[1] for pair in pairs))
+    return ptr, idx
+
+
+def _csr_from_lists(lists):
+    '''
+    Return the (ptr, idx) CSR arrays of a list of rows, each a list of column
+    indices.
+    '''
+    ptr = array.array('l', [0])
+    idx = array.array('l')
+    for row in lists:
+        idx.extend(row)
+        ptr.append(len(idx))
+    return ptr, idx
+
+
+def _transitive_closure(n, parent_ptr, parent_idx, child_ptr, child_idx):
+    '''
+    Return a list of the set of ancestors of each term, visiting terms in
+    topological order so each term's ancestors are the union of its parents
+    and their already computed ancestors.
+    '''
+    pending = [parent_ptr[i + 1] - parent_ptr[i] for i in xrange(n)]
+    order = [i for i in xrange(n) if not pending[i]]
+    ancestors = [None] * n
+    for i in order: # order grows as terms become ready.
+        anc = set()
+        for p in parent_idx[parent_ptr[i]:parent_ptr[i + 1]]:
+            anc.add(p)
+            anc.update(ancestors[p])
+        ancestors[i] = anc
+        for c in child_idx[child_ptr[i]:child_ptr[i + 1]]:
+            pending[c] -= 1
+            if not pending[c]:
+                order.append(c)
+    if len(order) != n:
+        raise ValueError('Cycle found in ontology graph.')
+    return ancestors
+
+
+def _bit_indices(bits):
+    '''
+    Return a list of the positions of the set bits of int bits, in order.
+    '''
+    indices = []
+    while bits:
+        low = bits & -bits
+        indices.append(low.bit_length() - 1)
+        bits ^= low
+    return indices
+
+
+##########################
+# ANNOTATIONS AND ENRICHMENT
+
+# Names of the arrays of an AssociationIndex.  gene_ptr/gene_idx is the
+# gene x term matrix of propagated annotations and term_ptr/term_idx is its
+# transpose.  direct_ptr/direct_idx holds only the direct annotations.
+# term_counts is the number of genes annotated to each term and annotated is
+# the indices of the genes with any annotations.
+ASSOCIATION_ARRAYS = ('direct_ptr', 'direct_idx', 'gene_ptr', 'gene_idx',
+                      'term_ptr', 'term_idx', 'term_counts', 'annotated')
+
+Enrichment = collections.namedtuple(
+    'Enrichment', ['acc', 'count', 'list_size', 'term_size',
+                   'population_size', 'p_value', 'q_value'])
+
+
+class AssociationIndex(object):
+    '''
+    The gene product to term annotations of an assocdb release as a sparse
+    gene x term incidence matrix, stored as CSR arrays in both directions.
+    Annotations are propagated up the graph (the true path rule), so a gene
+    annotated to a term is annotated to all of its ancestors.
+
+    Genes are numbered 0..m-1 in gene_product table order and terms use the
+    term indices of graph.
+
+    Use GeneOntology.associations() or build_association_index() to make one.
+    '''
+    def __init__(self, graph, gene_ids, symbols, arrays, gene_index=None):
+        '''
+        graph: the TermGraph used to propagate annotations.
+        gene_ids: a sequence of the gene_product ids, one per gene index.
+        symbols: a sequence of the gene_product symbols, one per gene index.
+        arrays: a dict containing the arrays named in ASSOCIATION_ARRAYS.
+        gene_index: a mapping from gene_product id to gene index.  Built from
+        gene_ids if None.
+        '''
+        self.graph = graph
+        self.gene_ids = gene_ids
+        self.symbols = symbols
+        for name in ASSOCIATION_ARRAYS:
+            setattr(self, name, arrays[name])
+        self.gene_index = gene_index if gene_index is not None else {
+            gene_id: i for i, gene_id in enumerate(gene_ids)}
+
+    def gene_term_indices(self, g):
+        '''
+        Return the indices of the terms gene index g is annotated to, including
+        propagated annotations.
+        '''
+        return self.gene_idx[self.gene_ptr[g]:self.gene_ptr[g + 1]]
+
+    def term_gene_indices(self, t):
+        '''
+        Return the indices of the genes annotated to term index t, including
+        propagated annotations.
+        '''
+        return self.term_idx[self.term_ptr[t]:self.term_ptr[t + 1]]
+
+    def terms(self, gene_id):
+        '''
+        Return a list of the accs of the terms gene_id is annotated to,
+        including propagated annotations.
+        '''
+        accs = self.graph.accs
+        return [accs[t] for t in
+                self.gene_term_indices(self.gene_index[gene_id])]
+
+    def genes(self, acc):
+        '''
+        Return a list of the ids of the gene products annotated to acc,
+        including propagated annotations.
+        '''
+        gene_ids = self.gene_ids
+        return [gene_ids[g] for g in
+                self.term_gene_indices(self.graph.index[acc])]
+
+    def enrichment(self, gene_lists, background=None, min_count=2,
+                   correction='fdr_bh'):
+        '''
+        Test each gene list for terms annotated to more of its genes than
+        expected by chance, using the one-sided Fisher exact test (i.e. the
+        upper tail of the hypergeometric distribution).
+
+        The population counts, log factorials and p-values are computed once
+        and shared by all the lists, so testing thousands of lists in one
+        call is much faster than testing them one at a time.
+
+        gene_lists: an iterable of sequences of gene_product ids.
+        background: a sequence of gene_product ids, the population the lists
+        were drawn from.  Defaults to all annotated genes.  Genes not in the
+        background are ignored.
+        min_count: only terms annotated to at least this many genes of a list
+        are tested and corrected for.
+        correction: 'fdr_bh' (Benjamini-Hochberg), 'bonferroni' or None.
+
+        Return a list of results, one per gene list, each a list of
+        Enrichment tuples sorted by p-value.
+        '''
+        adjust = {'fdr_bh': benjamini_hochberg, 'bonferroni': bonferroni,
+                  None: lambda p_values: p_values}[correction]
+        if background is None:
+            population = set(self.annotated)
+            term_counts = self.term_counts
+        else:
+            population = set(self.gene_index[gene_id] for gene_id in
+                             background if gene_id in self.gene_index)
+            term_counts = array.array('l', [0]) * len(self.graph)
+            for g in population:
+                for t in self.gene_term_indices(g):
+                    term_counts[t] += 1
+        hypergeom = _HypergeometricTail(len(population))
+
+        results = []
+        accs = self.graph.accs
+        gene_index = self.gene_index
+        for gene_list in gene_lists:
+            genes = set(gene_index[gene_id] for gene_id in gene_list
+                        if gene_id in gene_index)
+            genes.intersection_update(population)
+            n = len(genes)
+            counts = {}
+            for g in genes:
+                for t in self.gene_term_indices(g):
+                    counts[t] = counts.get(t, 0) + 1
+            tested = [(t, k) for t, k in counts.iteritems() if k >= min_count]
+            p_values = [hypergeom(k, term_counts[t], n) for t, k in tested]
+            q_values = adjust(p_values)
+            result = [Enrichment(accs[t], k, n, term_counts[t],
+                                 hypergeom.population, p, q)
+                      for (t, k), p, q in zip(tested, p_values, q_values)]
+            result.sort(key=lambda e: (e.p_value, e.acc))
+            results.append(result)
+        return results
+
+
+def build_association_index(graph, gene_ids, symbols, direct):
+    '''
+    Build an AssociationIndex.
+
+    graph: the TermGraph used to propagate annotations.
+    gene_ids: a sequence of the gene_product ids, one per gene index.
+    symbols: a sequence of the gene_product symbols, one per gene index.
+    direct: a list containing, for each gene index, an iterable of the
+    term indices the gene is directly annotated to.
+    '''
+    arrays = {}
+    arrays['direct_ptr'], arrays['direct_idx'] = _csr_from_lists(
+        [sorted(set(terms)) for terms in direct])
+    gene_terms = [sorted(graph.propagate_indices(terms)) for terms in direct]
+    arrays['gene_ptr'], arrays['gene_idx'] = _csr_from_lists(gene_terms)
+    term_genes = [[] for i in xrange(len(graph))]
+    for g, terms in enumerate(gene_terms):
+        for t in terms:
+            term_genes[t].append(g)
+    arrays['term_ptr'], arrays['term_idx'] = _csr_from_lists(term_genes)
+    arrays['term_counts'] = array.array('l', map(len, term_genes))
+    arrays['annotated'] = array.array('l', (g for g, terms in
+                                            enumerate(gene_terms) if terms))
+    return AssociationIndex(graph, gene_ids, symbols, arrays)
+
+
+class _HypergeometricTail(object):
+    '''
+    A callable returning P(X >= k) for X hypergeometric, drawing n from a
+    population containing K successes.  Log factorials of the population are
+    tabulated once and tail probabilities are memoized.
+    '''
+    def __init__(self, population):
+        self.population = population
+        self.log_factorial = array.array(
+            'd', (math.lgamma(i + 1) for i in xrange(population + 1)))
+        self.memo = {}
+
+    def _log_choose(self, n, k):
+        lf = self.log_factorial
+        return lf[n] - lf[k] - lf[n - k]
+
+    def __call__(self, k, K, n):
+        key = (k, K, n)
+        if key in self.memo:
+            return self.memo[key]
+        N = self.population
+        hi = min(K, n)
+        if k <= max(0, n + K - N):
+            p = 1.0
+        elif k > hi:
+            p = 0.0
+        else:
+            # sum the pmf from k up, using the ratio of successive terms.
+            pmf = math.exp(self._log_choose(K, k) +
+                           self._log_choose(N - K, n - k) -
+                           self._log_choose(N, n))
+            p = 0.0
+            for x in xrange(k, hi + 1):
+                p += pmf
+                pmf *= float((K - x) * (n - x)) / ((x + 1) * (N - K - n + x + 1))
+            p = min(p, 1.0)
+        self.memo[key] = p
+        return p
+
+
+def bonferroni(p_values):
+    '''
+    Return a list of Bonferroni adjusted p-values, in the order of p_values.
+    '''
+    m = len(p_values)
+    return [min(1.0, p * m) for p in p_values]
+
+
+def benjamini_hochberg(p_values):
+    '''
+    Return a list of Benjamini-Hochberg adjusted p-values (q-values), in the
+    order of p_values.
+    '''
+    m = len(p_values)
+    order = sorted(xrange(m), key=p_values.__getitem__, reverse=True)
+    q_values = [None] * m
+    q = 1.0
+    for rank, i in zip(xrange(m, 0, -1), order):
+        q = min(q, p_values[i] * m / rank)
+        q_values[i] = q
+    return q_values
+
+
+#####################
+# SEMANTIC SIMILARITY
+
+class SemanticSimilarity(object):
+    '''
+    Information content based semantic similarity of terms and genes.
+
+    The information content of a term t is -log(p(t)), where p(t) is the
+    fraction of the genes annotated to the root of t's ontology which are also
+    annotated to t, counting propagated annotations.  Terms with no annotated
+    genes have information content 0.  The information content of every
+    term is computed once, from the ancestor and parent arrays of the graph,
+    and the similarities of the most recently used pairs of terms are cached.  Ancestors are read
+    from the graph arrays rather than copied, so the similarity of a shared
+    release (see GeneOntology.attach_shared) holds just the information
+    content array and the cache per process.
+
+    Term similarity methods:
+        resnik: the information content of the most informative common
+        ancestor (MICA) of two terms.
+        lin: 2 * resnik / (IC(t1) + IC(t2)).
+        jiang_conrath: 1 / (1 + IC(t1) + IC(t2) - 2 * resnik).
+
+    Gene similarity is the best-match average (BMA) of the term similarities
+    of the terms the genes are directly annotated to.
+
+    Use GeneOntology.similarity() to make one.
+    '''
+    def __init__(self, associations, cache_size=1 << 20):
+        '''
+        associations: an AssociationIndex.
+        cache_size: the number of term pair similarities to cache.  The least
+        recently used are evicted, so a genome-wide pairwise() does not grow
+        the cache without bound.
+        '''
+        self.associations = associations
+        self.cache_size = cache_size
+        self.graph = graph = associations.graph
+        counts = associations.term_counts
+        ptr = graph.parent_ptr
+        self.ic = array.array('d', [0.0]) * len(graph)
+        for t in xrange(len(graph)):
+            if not counts[t]:
+                continue
+            total = max(counts[r] for r in
+                        itertools.chain(graph.ancestor_indices(t), [t])
+                        if ptr[r] == ptr[r + 1])
+            if total:
+                self.ic[t] = -math.log(float(counts[t]) / total)
+        self._cache = collections.OrderedDict() # least recently used first
+
+    def mica_index(self, i, j):
+        '''
+        Return the index of the most informative common ancestor of term
+        indices i and j, or None if they have no common ancestor.
+        '''
+        graph = self.graph
+        inclusive = set(graph.ancestor_indices(i))
+        inclusive.add(i)
+        common = [k for k in itertools.chain(graph.ancestor_indices(j), [j])
+                  if k in inclusive]
+        if not common:
+            return None
+        return max(common, key=self.ic.__getitem__)
+
+    def term_index_similarity(self, i, j, method='resnik'):
+        '''
+        Return the similarity of term indices i and j using method.
+        '''
+        key = (i, j, method) if i <= j else (j, i, method)
+        cache = self._cache
+        sim = cache.pop(key, None)
+        if sim is None:
+            ic = self.ic
+            mica = self.mica_index(i, j)
+            resnik = 0.0 if mica is None else ic[mica]
+            if method == 'resnik':
+                sim = resnik
+            elif method == 'lin':
+                total = ic[i] + ic[j]
+                sim = 2 * resnik / total if total else (1.0 if i == j else 0.0)
+            elif method == 'jiang_conrath':
+                sim = 1.0 / (1.0 + ic[i] + ic[j] - 2 * resnik)
+            else:
+                raise ValueError('Unknown similarity method.', method)
+            if len(cache) >= self.cache_size:
+                cache.popitem(last=False)
+        cache[key] = sim # most recently used.
+        return sim
+
+    def term_similarity(self, acc1, acc2, method='resnik'):
+        '''
+        Return the similarity of terms acc1 and acc2 using method.
+        '''
+        index = self.graph.index
+        return self.term_index_similarity(index[acc1], index[acc2], method)
+
+    def resnik(self, acc1, acc2):
+        return self.term_similarity(acc1, acc2, 'resnik')
+
+    def lin(self, acc1, acc2):
+        return self.term_similarity(acc1, acc2, 'lin')
+
+    def jiang_conrath(self, acc1, acc2):
+        return self.term_similarity(acc1, acc2, 'jiang_conrath')
+
+    def _gene_terms(self, g):
+        assoc = self.associations
+        return assoc.direct_idx[assoc.direct_ptr[g]:assoc.direct_ptr[g + 1]]
+
+    def gene_index_similarity(self, g1, g2, method='resnik'):
+        '''
+        Return the best-match average similarity of gene indices g1 and g2,
+        or 0.0 if either gene has no annotations.
+        '''
+        terms1, terms2 = self._gene_terms(g1), self._gene_terms(g2)
+        if not terms1 or not terms2:
+            return 0.0
+        sims = [[self.term_index_similarity(i, j, method) for j in terms2]
+                for i in terms1]
+        best1 = sum(max(row) for row in sims) / len(terms1)
+        best2 = sum(max(col) for col in zip(*sims)) / len(terms2)
+        return (best1 + best2) / 2
+
+    def gene_similarity(self, gene_id1, gene_id2, method='resnik'):
+        '''
+        Return the best-match average similarity of gene products gene_id1
+        and gene_id2.
+        '''
+        index = self.associations.gene_index
+        return self.gene_index_similarity(index[gene_id1], index[gene_id2],
+                                          method)
+
+    def pairwise(self, gene_ids, method='resnik', processes=None):
+        '''
+        Return the all-pairs gene similarity matrix of gene_ids as a list of
+        lists, where matrix[i][j] is the similarity of gene_ids[i] and
+        gene_ids[j].
+
+        processes: if given, compute the rows of the matrix in this many
+        worker processes.  Workers are forked and inherit this object, so
+        nothing but the rows is pickled.
+        '''
+        index = self.associations.gene_index
+        genes = [index[gene_id] for gene_id in gene_ids]
+        global _PAIRWISE
+        _PAIRWISE = (self, genes, method)
+        try:
+            if processes:
+                pool = multiprocessing.Pool(processes)
+                try:
+                    rows = pool.map(_pairwise_row, xrange(len(genes)))
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                rows = map(_pairwise_row, xrange(len(genes)))
+        finally:
+            _PAIRWISE = None
+        # fill in the lower triangle from the upper.
+        for i, row in enumerate(rows):
+            row[:i] = [rows[j][i] for j in xrange(i)]
+        return rows
+
+
+# (similarity, gene indices, method) shared with forked pairwise() workers.
+_PAIRWISE = None
+
+
+def _pairwise_row(i):
+    '''
+    Return row i of the pairwise similarity matrix, with 0.0 below the
+    diagonal.
+    '''
+    similarity, genes, method = _PAIRWISE
+    g = genes[i]
+    return [0.0] * i + [similarity.gene_index_similarity(g, h, method)
+                        for h in genes[i:]]
+
+
+#################
+# SQLITE DATABASE
+
+SQLITE_BASENAME = 'go.sqlite'
+
+# Indexes created after loading a release into sqlite.  Each table maps to
+# a list of indexed columns.
+SQLITE_INDEXES = {
+    'term': ['acc', 'term_type', 'name'],
+    'term2term': ['term1_id', 'term2_id', 'relationship_type_id'],
+    'graph_path': ['term1_id', 'term2_id', 'relationship_type_id'],
+    'term_synonym': ['term_id'],
+    'term_dbxref': ['term_id', 'dbxref_id'],
+    'association': ['term_id', 'gene_product_id'],
+    'gene_product': ['symbol', 'dbxref_id', 'species_id'],
+    'dbxref': ['xref_key'],
+}
+
+# Map sqlite column affinity to a MySQL type with the same python converter.
+_SQLITE_TYPES = {'INTEGER': 'int', 'REAL': 'double', 'TEXT': 'text'}
+
+
+def sqlite_file(release_dir):
+    '''
+    Return the path of the sqlite database of a release.
+    e.g. '/path/to/root/go_201206-termdb-tables/go.sqlite'
+    '''
+    return os.path.join(release_dir, SQLITE_BASENAME)
+
+
+def release_tables(release_dir):
+    '''
+    Return a sorted list of the names of the tables in release_dir, i.e.
+    those with both a .sql and a .txt file.
+    '''
+    names = set(os.listdir(release_dir))
+    return sorted(name[:-4] for name in names if name.endswith('.txt') and
+                  name[:-4] + '.sql' in names)
+
+
+def load_sqlite(release_dir, path=None, tables=None, batch_size=50000):
+    '''
+    Bulk load the tables of a release into a new sqlite database and return
+    the path to the database.  Each table is loaded in one transaction using
+    executemany on batches of rows.  Indexes (see SQLITE_INDEXES) are created
+    after all the rows are loaded, which is much faster than updating them
+    on every insert.  The database is written to a temporary file and renamed
+    to path when complete, so a partially loaded database is never seen.
+
+    release_dir: The directory the release is installed in, e.g.
+    '/path/to/root/go_201206-termdb-tables'
+    path: where to write the database.  Defaults to sqlite_file(release_dir).
+    tables: the tables to load.  Defaults to release_tables(release_dir).
+    batch_size: the number of rows passed to each executemany call.
+    '''
+    path = path or sqlite_file(release_dir)
+    tables = tables if tables is not None else release_tables(release_dir)
+    tmp = '{}.tmp{}'.format(path, os.getpid())
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    go = GeneOntology(release_dir)
+    conn = sqlite3.connect(tmp)
+    conn.text_factory = str
+    try:
+        # the file is renamed into place only when complete, so durability
+        # during the load is not needed.
+        dbutil.executeSQL(conn, 'PRAGMA synchronous = OFF', [])
+        dbutil.executeSQL(conn, 'PRAGMA journal_mode = OFF', [])
+        for table in tables:
+            schema = go.table_schema(table)
+            columns = ', '.join('{} {}'.format(_sqlite_name(name),
+                                               _sqlite_type(sql_type))
+                                for name, sql_type in schema)
+            dbutil.executeSQL(conn, 'CREATE TABLE {} ({})'.format(
+                _sqlite_name(table), columns), [])
+            sql = 'INSERT INTO {} VALUES ({})'.format(
+                _sqlite_name(table), ', '.join('?' * len(schema)))
+            with dbutil.doTransaction(conn, start=False):
+                for rows in util.groupsOfN(go.table_tuples(table),
+                                           batch_size):
+                    dbutil.executeManySQL(conn, sql, rows)
+        for table in tables:
+            fields = go.table_fields(table)
+            for column in SQLITE_INDEXES.get(table, []):
+                if column in fields:
+                    index = _sqlite_name('{}_{}_idx'.format(table, column))
+                    dbutil.executeSQL(conn, 'CREATE INDEX {} ON {} ({})'.format(
+                        index, _sqlite_name(table), _sqlite_name(column)), [])
+        conn.commit()
+    except:
+        conn.close()
+        os.remove(tmp)
+        raise
+    conn.close()
+    os.rename(tmp, path)
+    return path
+
+
+def _sqlite_type(sql_type):
+    '''
+    Return the sqlite column type for a MySQL column type.
+    '''
+    return {int: 'INTEGER', float: 'REAL', str: 'TEXT'}[
+        sql_type_converter(sql_type)]
+
+
+def _sqlite_name(name):
+    '''
+    Return name quoted as a sqlite identifier, e.g. "term".
+    '''
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+###############
+# RELEASE DIFFS
+
+ReleaseDiff = collections.namedtuple(
+    'ReleaseDiff', ['new', 'removed', 'obsoleted', 'renamed', 'reparented',
+                    'associations'])
+
+_MASK64 = (1 << 64) - 1
+
+
+def diff_releases(old_dir, new_dir):
+    '''
+    Compare two installed releases and return a ReleaseDiff of sorted lists
+    of term accs:
+        new: terms in the new release but not the old.
+        removed: terms in the old release but not the new.
+        obsoleted: terms which became obsolete.
+        renamed: terms whose name changed.
+        reparented: terms whose parents or relations to their parents changed,
+        including terms which lost all their parents or gained their first.
+        associations: terms whose direct associations changed, or None if
+        either release has no association table.  Associations are compared
+        by gene product dbxref (or symbol if there is no dbxref table), since
+        ids are not stable between releases.
+
+    Releases are compared by sorted merges of (acc, digest) lists, where each
+    digest is a hash of the compared fields.  The digest of a term's
+    associations is the sum of the hashes of its association rows, so it
+    does not depend on row order.  The compared tables of both releases are
+    read into memory as columns, along with a digest per term, so memory
+    use grows with the size of the releases.  Table cache files are used
+    when present.
+    '''
+    old, new = GeneOntology(old_dir), GeneOntology(new_dir)
+    diff = dict((field, []) for field in ReleaseDiff._fields)
+    old_terms, new_terms = _term_digests(old), _term_digests(new)
+    for acc, before, after in _merge_sorted(old_terms, new_terms):
+        if before is None:
+            diff['new'].append(acc)
+        elif after is None:
+            diff['removed'].append(acc)
+        else:
+            if after[1] and not before[1]:
+                diff['obsoleted'].append(acc)
+            if after[0] != before[0]:
+                diff['renamed'].append(acc)
+    # every term has a parent digest, so a term missing from one release is
+    # new or removed rather than reparented.
+    added_or_removed = set(diff['new']).union(diff['removed'])
+    for acc, before, after in _merge_sorted(_parent_digests(old),
+                                            _parent_digests(new)):
+        if before != after and acc not in added_or_removed:
+            diff['reparented'].append(acc)
+    if old.has_table('association') and new.has_table('association'):
+        for acc, before, after in _merge_sorted(_association_digests(old),
+                                                _association_digests(new)):
+            if before != after:
+                diff['associations'].append(acc)
+    else:
+        diff['associations'] = None
+    return ReleaseDiff(**diff)
+
+
+def _digest(*fields):
+    '''
+    Return a 64-bit int hash of the str of each field.
+    '''
+    data = hashlib.md5('\t'.join(map(str, fields))).digest()
+    return struct.unpack('<Q', data[:8])[0]
+
+
+def _merge_sorted(old, new):
+    '''
+    Merge two lists of (key, value) pairs sorted by unique key, yielding
+    (key, old_value, new_value) for every key in either list, with None for a
+    missing value.
+    '''
+    i = j = 0
+    while i < len(old) or j < len(new):
+        if j == len(new) or (i < len(old) and old[i][0] < new[j][0]):
+            yield old[i][0], old[i][1], None
+            i += 1
+        elif i == len(old) or new[j][0] < old[i][0]:
+            yield new[j][0], None, new[j][1]
+            j += 1
+        else:
+            yield old[i][0], old[i][1], new[j][1]
+            i += 1
+            j += 1
+
+
+def _term_digests(go):
+    '''
+    Return a sorted list of (acc, (name digest, is_obsolete)) for the terms of
+    a release.
+    '''
+    term = go.table_columns('term')
+    return sorted(itertools.izip(
+        term['acc'], zip(itertools.imap(_digest, term['name']),
+                         term['is_obsolete'])))
+
+
+def _parent_digests(go):
+    '''
+    Return a sorted list of (acc, digest of the term's parents and relations)
+    for every term of a release.  Terms without parents get the digest of no
+    parents.
+    '''
+    term_accs, relation_names = go._term_accs()
+    t2t = go.table_columns('term2term')
+    parents = dict((acc, []) for acc in term_accs.itervalues())
+    for rel, parent, child in itertools.izip(t2t['relationship_type_id'],
+                                             t2t['term1_id'],
+                                             t2t['term2_id']):
+        if child in term_accs and parent in term_accs:
+            parents[term_accs[child]].append(
+                (term_accs[parent], relation_names.get(rel)))
+    return sorted((acc, _digest(*sorted(rels)))
+                  for acc, rels in parents.iteritems())
+
+
+def _association_digests(go):
+    '''
+    Return a sorted list of (acc, sum of association row digests) for the
+    terms of a release with associations.
+    '''
+    term_accs, relation_names = go._term_accs()
+    products = go.table_columns('gene_product')
+    if go.has_table('dbxref'):
+        dbxref = go.table_columns('dbxref')
+        xrefs = dict(itertools.izip(dbxref['id'], itertools.imap(
+            '{}:{}'.format, dbxref['xref_dbname'], dbxref['xref_key'])))
+        keys = [xrefs.get(dbxref_id) for dbxref_id in products['dbxref_id']]
+    else:
+        keys = products['symbol']
+    gene_keys = dict(itertools.izip(products['id'], keys))
+    sums = collections.defaultdict(int)
+    assoc = go.table_columns('association')
+    for term_id, gene_id, is_not in itertools.izip(
+        assoc['term_id'], assoc['gene_product_id'], assoc['is_not']):
+        acc = term_accs.get(term_id)
+        if acc is not None:
+            sums[acc] = (sums[acc] +
+                         _digest(gene_keys.get(gene_id), is_not)) & _MASK64
+    return sorted(sums.iteritems())
+
+
+#################
+# SHARED RELEASES
+
+SHARED_BASENAME = 'go.shared'
+
+# Identifies (and versions the format of) a shared release file.
+_SHARED_MAGIC = 'TFDGO002'
+
+
+def shared_file(release_dir):
+    '''
+    Return the default path of the shared file of a release.
+    e.g. '/path/to/root/go_201206-termdb-tables/go.shared'
+    '''
+    return os.path.join(release_dir, SHARED_BASENAME)
+
+
+def write_shared(path, graph, associations=None):
+    '''
+    Write a TermGraph, and optionally an AssociationIndex built on it, to a
+    file that can be memory-mapped by attach_shared().  Every process mapping
+    the file shares one physical copy of it in the page cache.
+
+    The file is the magic string, the length of a JSON header, the header,
+    and then 8-byte aligned sections of little-endian int64 or float64
+    arrays and of string tables.  A string table is the end offset of each
+    string, negated (as -end - 1) for None, followed by the string data.
+    The header maps each array or string table name to its location.  The file is written to a temporary path and
+    renamed to path when complete.
+    '''
+    arrays = dict(('graph.' + name, getattr(graph, name))
+                  for name in GRAPH_ARRAYS)
+    strings = {'graph.accs': graph.accs}
+    header = {'relations': list(graph.relations), 'arrays': {},
+              'strings': {}, 'associations': associations is not None}
+    if associations is not None:
+        for name in ASSOCIATION_ARRAYS:
+            arrays['associations.' + name] = getattr(associations, name)
+        arrays['associations.gene_ids'] = associations.gene_ids
+        arrays['associations.gene_order'] = sorted(
+            xrange(len(associations.gene_ids)),
+            key=associations.gene_ids.__getitem__)
+        strings['associations.symbols'] = associations.symbols
+
+    # lay out the sections, then write them.
+    sections = []
+    offset = 0
+    for name in sorted(arrays):
+        values = arrays[name]
+        typecode = 'd' if getattr(values, 'typecode', None) == 'd' else 'q'
+        header['arrays'][name] = [offset, typecode, len(values)]
+        sections.append((offset, typecode, values))
+        offset += 8 * len(values)
+    for name in sorted(strings):
+        values = strings[name]
+        ends = _string_ends(values)
+        data = ''.join(value for value in values if value is not None)
+        header['strings'][name] = [offset, len(values)]
+        sections.append((offset, 'q', [0] + ends))
+        offset += 8 * (len(values) + 1)
+        sections.append((offset, 's', data))
+        offset += -(-len(data) // 8) * 8
+    header_json = json.dumps(header)
+    start = -(-(len(_SHARED_MAGIC) + 8 + len(header_json)) // 8) * 8
+
+    tmp = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp, 'wb') as fh:
+        fh.write(_SHARED_MAGIC)
+        fh.write(struct.pack('<q', len(header_json)))
+        fh.write(header_json)
+        for section_offset, typecode, values in sections:
+            fh.seek(start + section_offset)
+            if typecode == 's':
+                fh.write(values)
+            else:
+                for i in xrange(0, len(values), 1 << 16):
+                    chunk = values[i:i + (1 << 16)]
+                    fh.write(struct.pack('<{}{}'.format(len(chunk), typecode),
+                                         *chunk))
+        fh.truncate(start + offset)
+    os.rename(tmp, path)
+    return path
+
+
+def attach_shared(path):
+    '''
+    Memory-map a file written by write_shared() read-only and return a
+    (TermGraph, AssociationIndex) tuple whose arrays and strings are read
+    directly from the mapping.  The AssociationIndex is None if none was
+    written.  Nothing is parsed or copied, so attaching is nearly free, and
+    pages of the file are shared by all processes that attach it.
+    '''
+    with open(path, 'rb') as fh:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    if mm[:len(_SHARED_MAGIC)] != _SHARED_MAGIC:
+        raise Exception('Not a shared release file.', path)
+    size, = struct.unpack_from('<q', mm, len(_SHARED_MAGIC))
+    header_start = len(_SHARED_MAGIC) + 8
+    header = json.loads(mm[header_start:header_start + size])
+    start = -(-(header_start + size) // 8) * 8
+
+    def mapped(name):
+        offset, typecode, length = header['arrays'][name]
+        return MappedArray(mm, start + offset, str(typecode), length)
+
+    def mapped_strings(name):
+        offset, length = header['strings'][name]
+        ends = MappedArray(mm, start + offset, 'q', length + 1)
+        return MappedStrings(mm, start + offset + 8 * (length + 1), ends)
+
+    accs = mapped_strings('graph.accs')
+    graph = TermGraph(accs, tuple(str(r) for r in header['relations']),
+                      dict((name, mapped('graph.' + name))
+                           for name in GRAPH_ARRAYS),
+                      index=SortedIndex(accs))
+    associations = None
+    if header['associations']:
+        gene_ids = mapped('associations.gene_ids')
+        associations = AssociationIndex(
+            graph, gene_ids, mapped_strings('associations.symbols'),
+            dict((name, mapped('associations.' + name))
+                 for name in ASSOCIATION_ARRAYS),
+            gene_index=SortedIndex(gene_ids,
+                                   mapped('associations.gene_order')))
+    return graph, associations
+
+
+def _string_ends(values):
+    '''
+    Return the end offset of each str of values in their concatenation, or
+    -end - 1 for None, which adds nothing to the concatenation.
+    '''
+    total = 0
+    ends = []
+    for value in values:
+        if value is None:
+            ends.append(-total - 1)
+        else:
+            total += len(value)
+            ends.append(total)
+    return ends
+
+
+class MappedArray(object):
+    '''
+    A read-only sequence of little-endian int64 ('q') or float64 ('d') values
+    in a buffer, e.g. an mmap.  Indexing unpacks values in place.  Slices
+    (with step 1) are returned as tuples.
+    '''
+    def __init__(self, buf, offset, typecode, length):
+        self.buf = buf
+        self.offset = offset
+        self.typecode = typecode
+        self.length = length
+        self._item = struct.Struct('<' + typecode)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.length)
+            if step != 1:
+                raise ValueError('MappedArray slices must have step 1.')
+            count = max(0, stop - start)
+            return struct.unpack_from('<{}{}'.format(count, self.typecode),
+                                      self.buf, self.offset + 8 * start)
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError('MappedArray index out of range')
+        return self._item.unpack_from(self.buf, self.offset + 8 * i)[0]
+
+    def __iter__(self):
+        for i in xrange(0, self.length, 1 << 12):
+            for value in self[i:i + (1 << 12)]:
+                yield value
+
+
+class MappedStrings(object):
+    '''
+    A read-only sequence of str (or None) stored as end offsets (a
+    MappedArray) and the concatenated string data in a buffer.  See
+    _string_ends.
+    '''
+    def __init__(self, buf, offset, ends):
+        self.buf = buf
+        self.offset = offset
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.ends) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('MappedStrings index out of range')
+        start, end = self.ends[i:i + 2]
+        if end < 0:
+            return None
+        if start < 0:
+            start = -start - 1
+        return self.buf[self.offset + start:self.offset + end]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+
+class SortedIndex(object):
+    '''
+    A read-only mapping from the values of a sequence to their positions,
+    found by binary search, so no dict has to be built.  keys must be sorted,
+    or order must be the positions of keys in sorted key order.
+    '''
+    def __init__(self, keys, order=None):
+        self.keys = keys
+        self.order = order
+
+    def _find(self, key):
+        keys, order = self.keys, self.order
+        lo, hi = 0, len(keys)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if keys[mid if order is None else order[mid]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(keys):
+            i = lo if order is None else order[lo]
+            if keys[i] == key:
+                return i
+        return None
+
+    def __getitem__(self, key):
+        i = self._find(key)
+        if i is None:
+            raise KeyError(key)
+        return i
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def get(self, key, default=None):
+        i = self._find(key)
+        return default if i is None else i
+
+    def __len__(self):
+        return len(self.keys)
+
+
+##############
+# TERM SEARCH
+
+SEARCH_INDEX_BASENAME = 'search.index'
+
+SearchResult = collections.namedtuple('SearchResult',
+                                      ['acc', 'name', 'match', 'text'])
+
+# How a term matched a query, best first.  A term's rank is the index of its
+# best match.
+SEARCH_MATCHES = ('exact', 'exact_synonym', 'prefix', 'synonym_prefix',
+                  'token')
+
+_TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+
+def search_index_file(release_dir):
+    '''
+    Return the path of the persisted search index of a release.
+    e.g. '/path/to/root/go_201206-termdb-tables/search.index'
+    '''
+    return os.path.join(release_dir, SEARCH_INDEX_BASENAME)
+
+
+def _normalize(text):
+    return ' '.join(text.lower().split())
+
+
+class TermSearchIndex(object):
+    '''
+    A search index over the accs, names and synonyms of terms, for keyword
+    queries and type-ahead.  It holds:
+
+        A sorted list of the normalized (lowercased, whitespace collapsed)
+        names, synonyms and accs, for finding exact and prefix matches by
+        binary search.
+
+        An inverted index from each token (run of letters and digits) to the
+        terms whose name or synonyms contain it, for finding terms matching
+        every query token.  The last query token matches as a prefix, since
+        it may be partly typed.
+
+    Results are ranked by match (see SEARCH_MATCHES), then non-obsolete
+    before obsolete, then shorter names first.
+
+    Use GeneOntology.search_index() to make or load one.
+    '''
+    def __init__(self, accs, names, obsolete, synonyms):
+        '''
+        accs, names, obsolete: sequences of the acc, name and is_obsolete
+        value of each term, by term index.
+        synonyms: an iterable of (term index, synonym) pairs.
+        '''
+        self.accs = list(accs)
+        self.names = list(names)
+        self.obsolete = array.array('b', obsolete)
+        entries = set()
+        postings = collections.defaultdict(set)
+        for t, (acc, name) in enumerate(zip(self.accs, self.names)):
+            entries.add((_normalize(acc), t, 0))
+            entries.add((_normalize(name), t, 0))
+            for token in _TOKEN_RE.findall(name.lower()):
+                postings[token].add(t)
+        for t, synonym in synonyms:
+            entries.add((_normalize(synonym), t, 1))
+            for token in _TOKEN_RE.findall(synonym.lower()):
+                postings[token].add(t)
+        entries = sorted(entries)
+        self.texts = [text for text, t, kind in entries]
+        self.text_terms = array.array('l', (t for text, t, kind in entries))
+        self.text_kinds = array.array('b', (kind for text, t, kind in entries))
+        self.tokens = sorted(postings)
+        self.postings = [array.array('l', sorted(postings[token]))
+                         for token in self.tokens]
+
+    def _prefixed(self, items, prefix, limit):
+        '''
+        Return the range of indices of the sorted list items which start with
+        prefix, scanning at most limit items.
+        '''
+        start = bisect.bisect_left(items, prefix)
+        end = start
+        while (end < len(items) and end - start < limit and
+               items[end].startswith(prefix)):
+            end += 1
+        return xrange(start, end)
+
+    def search(self, query, limit=10, scan=10000):
+        '''
+        Return a list of up to limit SearchResult tuples for the terms best
+        matching query.  text is the name, synonym or acc that matched, or the
+        name for token matches.
+
+        scan: the maximum number of prefix entries or tokens examined, which
+        bounds the cost of one or two letter queries.
+        '''
+        query = _normalize(query)
+        if not query:
+            return []
+        best = {}
+        for i in self._prefixed(self.texts, query, scan):
+            text = self.texts[i]
+            rank = (0 if text == query else 2) + self.text_kinds[i]
+            t = self.text_terms[i]
+            if t not in best or rank < best[t][0]:
+                best[t] = (rank, text)
+        tokens = _TOKEN_RE.findall(query)
+        if tokens:
+            matches = None
+            for token in tokens[:-1]:
+                i = bisect.bisect_left(self.tokens, token)
+                found = (set(self.postings[i]) if i < len(self.tokens) and
+                         self.tokens[i] == token else set())
+                matches = found if matches is None else matches & found
+            last = set()
+            for i in self._prefixed(self.tokens, tokens[-1], scan):
+                last.update(self.postings[i])
+            matches = last if matches is None else matches & last
+            for t in matches:
+                if t not in best:
+                    best[t] = (SEARCH_MATCHES.index('token'), self.names[t])
+        ranked = sorted(best, key=lambda t: (best[t][0], self.obsolete[t],
+                                             len(self.names[t]),
+                                             self.accs[t]))
+        return [SearchResult(self.accs[t], self.names[t],
+                             SEARCH_MATCHES[best[t][0]], best[t][1])
+                for t in ranked[:limit]]
+
+
+##########
+# GO SLIMS
+
+def map_to_slim(graph, slim_accs, annotations, processes=None,
+                chunk_size=100000):
+    '''
+    Map (gene, acc) annotations to the terms of a GO slim and return a dict
+    mapping each gene to a dict of the number of its annotations mapped to
+    each slim term.  An annotation maps to every slim term that is its term
+    or an ancestor of its term.  Annotations to terms not in graph are
+    skipped.
+
+    Each term's slim terms are found once, by intersecting the term's
+    ancestors with the slim, and cached for the call, so each annotation
+    costs a dict lookup.  Only the slim terms of each term are cached, not
+    its ancestors, and nothing is cached on graph.
+
+    graph: a TermGraph.
+    slim_accs: the accs of the slim terms.
+    annotations: an iterable of (gene, acc) pairs, e.g. from read_gaf().  It
+    is read in chunks, so it can be larger than memory.
+    processes: if given, map chunks in this many forked worker processes.
+    chunk_size: the number of annotations per chunk.
+    '''
+    slim = frozenset(graph.index[acc] for acc in slim_accs)
+    global _SLIM
+    _SLIM = (graph, slim, {})
+    counts = {}
+    try:
+        chunks = util.groupsOfN(annotations, chunk_size)
+        if processes:
+            pool = multiprocessing.Pool(processes)
+            try:
+                # a few chunks per worker at a time, so the annotations are
+                # not all read into memory at once.
+                for batch in util.groupsOfN(chunks, processes * 2):
+                    for partial in pool.map(_slim_chunk, batch):
+                        _merge_slim_counts(counts, partial)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for chunk in chunks:
+                _merge_slim_counts(counts, _slim_chunk(chunk))
+    finally:
+        _SLIM = None
+    accs = graph.accs
+    return dict((gene, dict((accs[t], n) for t, n in slim_counts.iteritems()))
+                for gene, slim_counts in counts.iteritems())
+
+
+# (graph, slim term indices, acc -> slim term indices cache) shared with
+# forked map_to_slim() workers.
+_SLIM = None
+
+
+def _slim_chunk(annotations):
+    '''
+    Return a dict mapping gene to a dict of slim term index counts for a
+    chunk of annotations.
+    '''
+    graph, slim, cache = _SLIM
+    index = graph.index
+    counts = {}
+    for gene, acc in annotations:
+        slims = cache.get(acc)
+        if slims is None:
+            t = index.get(acc)
+            if t is None:
+                slims = ()
+            else:
+                inclusive = list(graph.ancestor_indices(t))
+                inclusive.append(t)
+                slims = tuple(sorted(slim.intersection(inclusive)))
+            cache[acc] = slims
+        if slims:
+            gene_counts = counts.get(gene)
+            if gene_counts is None:
+                gene_counts = counts[gene] = {}
+            for s in slims:
+                gene_counts[s] = gene_counts.get(s, 0) + 1
+    return counts
+
+
+def _merge_slim_counts(counts, partial):
+    for gene, partial_counts in partial.iteritems():
+        gene_counts = counts.get(gene)
+        if gene_counts is None:
+            counts[gene] = partial_counts
+        else:
+            for s, n in partial_counts.iteritems():
+                gene_counts[s] = gene_counts.get(s, 0) + n
+
+
+def read_gaf(path):
+    '''
+    Iterate over a GO annotation file (GAF), plain or gzipped, yielding a
+    (gene, acc) tuple for each annotation, where gene is 'DB:DB_Object_ID',
+    e.g. ('UniProtKB:P12345', 'GO:0006412').  Comment lines and NOT
+    annotations are skipped.
+    '''
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path) as fh:
+        for line in fh:
+            if line.startswith('!'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 5 or 'NOT' in fields[3].split('|'):
+                continue
+            yield fields[0] + ':' + fields[1], fields[4]
+
+
+########################
+# GENE ONTOLOGY DATABASE
+
+class GeneOntology(object):
+    '''
+    An abstraction layer around a filesystem installation of a Gene
+    Ontology release.  This object provides access to the tables in 
+    Gene Ontology, e.g. term, term2term, graph_path, term_synonym, and in
+    assocdb releases gene_product, association, and dbxref.
+
+    The fields of each table are read from the CREATE TABLE statement in the
+    table .sql file.  For example, from the term.sql file we can see that
+    the fields of the term table are:
+        `id` int(11) NOT NULL AUTO_INCREMENT,
+        `name` varchar(255) NOT NULL DEFAULT '',
+        `term_type` varchar(55) NOT NULL,
+        `acc` varchar(255) NOT NULL,
+        `is_obsolete` int(11) NOT NULL DEFAULT '0',
+        `is_root` int(11) NOT NULL DEFAULT '0',
+        `is_relation` int(11) NOT NULL DEFAULT '0',
+    '''
+    def __init__(self, release_dir, db_path=None):
+        '''
+        release_dir:  The directory the release is installed in, e.g.
+        '/path/to/root/go_201206-termdb-tables'
+        db_path: the path to a sqlite database of the release made with
+        load_sqlite().  If given, tables are read from the database instead of
+        the table files and query() can be used.
+        '''
+        self.release_dir = release_dir
+        self.db_path = db_path
+        self._conn = None
+        self._schemas = {}
+        self._graphs = {}
+        self._associations = {}
+        self._similarities = {}
+        self._term_accs_cache = None
+        self._shared = None
+        self._search_index = None
+
+    def _term_table_file(self):
+        '''
+        Return the path to the term.txt file of the release.
+        e.g. '/path/to/root/go_201206-termdb-tables/term.txt'
+        '''
+        return self._table_file('term')
+
+    def _table_file(self, table, ext='.txt'):
+        '''
+        Return the path to a table file of the release.
+        e.g. '/path/to/root/go_201206-termdb-tables/term2term.txt'
+        '''
+        return os.path.join(self.release_dir, table + ext)
+
+    def _db(self):
+        '''
+        Return an open connection to the sqlite database of the release.
+        '''
+        if self._conn is None:
+            if not os.path.exists(self.db_path):
+                raise Exception('sqlite database not found.', self.db_path)
+            self._conn = sqlite3.connect(self.db_path)
+            self._conn.text_factory = str
+        return self._conn
+
+    def query(self, sql, args=None, asdict=False):
+        '''
+        Run a select statement against the sqlite database of the release and
+        return the rows.  See tfd.dbutil.selectSQL.  Parameters use the sqlite
+        qmark style, e.g.
+
+            go.query('SELECT t.name FROM term t JOIN term2term r '
+                     'ON t.id = r.term2_id WHERE r.term1_id = ?', [3])
+        '''
+        return dbutil.selectSQL(self._db(), sql, args or [], asdict)
+
+    def has_table(self, table):
+        '''
+        Return True if the release contains table.
+        '''
+        if self.db_path:
+            return bool(self.query("SELECT 1 FROM sqlite_master WHERE "
+                                   "type = 'table' AND name = ?", [table]))
+        else:
+            return os.path.exists(self._table_file(table))
+
+    def table_schema(self, table):
+        '''
+        Return a tuple of (field_name, sql_type) pairs for table, parsed from
+        the table .sql file of the release, or from the sqlite database.
+        '''
+        if table not in self._schemas:
+            path = self._table_file(table, '.sql')
+            if self.db_path:
+                info = self.query('PRAGMA table_info({})'.format(
+                    _sqlite_name(table)))
+                if not info:
+                    raise Exception('Table not found.', table, self.db_path)
+                self._schemas[table] = tuple(
+                    (row[1], _SQLITE_TYPES[row[2]]) for row in info)
+            elif table == 'term' and not os.path.exists(path):
+                self._schemas[table] = TERM_SCHEMA
+            else:
+                with open(path) as fh:
+                    self._schemas[table] = parse_table_schema(fh.read())
+        return self._schemas[table]
+
+    def table_fields(self, table):
+        '''
+        Return a tuple containing all the field names of table.
+        '''
+        return tuple(name for name, sql_type in self.table_schema(table))
+
+    def _table_chunks(self, table, chunk_rows=50000):
+        if self.db_path:
+            return self._db_table_chunks(table, chunk_rows)
+        converters = [sql_type_converter(sql_type) for name, sql_type in
+                      self.table_schema(table)]
+        return read_table_chunks(self._table_file(table), converters)
+
+    def _db_table_chunks(self, table, chunk_rows):
+        '''
+        Yield the rows of table in the sqlite database as lists of columns,
+        like read_table_chunks().
+        '''
+        self.table_schema(table) # raise if table is missing.
+        with dbutil.doCursor(self._db()) as cursor:
+            cursor.execute('SELECT * FROM {} ORDER BY rowid'.format(
+                _sqlite_name(table)))
+            while True:
+                rows = cursor.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                yield zip(*rows)
+
+    def table_tuples(self, table):
+        '''
+        Iterate over the rows of table, yielding a tuple of the row values
+        converted to int, float or str as appropriate.  NULL values are None.
+        '''
+        for columns in self._table_chunks(table):
+            for row in zip(*columns):
+                yield row
+
+    def table_records(self, table):
+        '''
+        Iterate over the rows of table, yielding a namedtuple of the row
+        values, whose attributes are the field names of the table.
+        '''
+        record = collections.namedtuple(table, self.table_fields(table))
+        for columns in self._table_chunks(table):
+            for row in itertools.imap(record._make, zip(*columns)):
+                yield row
+
+    def table_dicts(self, table):
+        '''
+        Iterate over the rows of table, yielding a dict mapping each field name
+        to the field value for the row.
+        '''
+        field_names = self.table_fields(table)
+        for row in self.table_tuples(table):
+            yield dict(zip(field_names, row))
+
+    def table_columns(self, table):
+        '''
+        Read all of table and return an OrderedDict mapping each field name to
+        a column of values in table order.  int and float columns are
+        array.array objects ('l' and 'd' typecodes), unless they contain NULL
+        values, in which case they are lists.  Other columns are lists of str.
+        The columns are loaded from the table cache file if it is at least as
+        new as the table file.
+        '''
+        cache = table_cache_file(self.release_dir, table)
+        if not self.db_path and _is_fresh(cache, self._table_file(table)):
+            return util.loadObject(cache)
+        schema = self.table_schema(table)
+        columns = collections.OrderedDict()
+        for name, sql_type in schema:
+            conv = sql_type_converter(sql_type)
+            typecode = {int: 'l', float: 'd'}.get(conv)
+            columns[name] = array.array(typecode) if typecode else []
+        for chunk in self._table_chunks(table):
+            for (name, sql_type), col in zip(schema, chunk):
+                column = columns[name]
+                if isinstance(column, array.array) and None in col:
+                    column = columns[name] = column.tolist()
+                column.extend(col)
+        return columns
+
+    def term_table_fields(self):
+        '''
+        Return a tuple containing all the field names.
+        '''
+        return self.table_fields('term')
+
+    def term_table_tuples(self):
+        '''
+        Iterate over the rows of the term table, yielding a tuple of the
+        row values converted to int or str as appropriate.
+        '''
+        return self.table_tuples('term')
+
+    def term_table_dicts(self):
+        '''
+        Iterate over the rows of the term table, yielding a dict mapping 
+        each field name to the field value for the row, converted to int or
+        str as appropriate.
+        '''
+        return self.table_dicts('term')
+
+    def graph(self, relations=None, source=None, bitsets=False):
+        '''
+        Return a TermGraph of the non-relation terms of the release, built
+        once and cached.
+
+        relations: a sequence of relation names, e.g. ('is_a',).  Only edges
+        with these relations are in the graph.  If None, all edges are used.
+        source: 'graph_path' to use the closure shipped in the graph_path
+        table or 'term2term' to compute the closure from the edges.  Defaults
+        to 'graph_path' when relations is None and the table is present,
+        since graph_path paths can combine any relations.  'graph_path' can
+        not be combined with relations.
+        bitsets: if True, precompute the ancestor bitset of every term.  For
+        an attached shared release, the bitsets are held by this process.
+        '''
+        if relations is not None and source == 'graph_path':
+            raise ValueError('graph_path paths can not be filtered by '
+                             'relation.  Use source="term2term".', relations)
+        if self._shared and relations is None and source is None:
+            graph = self._shared[0]
+            if bitsets:
+                # cached in this process, not in the shared file.
+                graph.compute_bitsets()
+            return graph
+        if source is None:
+            source = ('graph_path' if relations is None and
+                      self.has_table('graph_path') else 'term2term')
+        key = (None if relations is None else frozenset(relations), source)
+        if key not in self._graphs:
+            self._graphs[key] = self._build_graph(relations, source, bitsets)
+        graph = self._graphs[key]
+        if bitsets:
+            graph.compute_bitsets()
+        return graph
+
+    def _term_accs(self):
+        '''
+        Return a dict mapping term id to acc for the terms which are not
+        relations and a dict mapping term id to relation name for the terms
+        which are.
+        '''
+        if self._term_accs_cache is None:
+            term = self.table_columns('term')
+            ids = {}
+            relation_names = {}
+            for term_id, acc, is_relation in zip(term['id'], term['acc'],
+                                                 term['is_relation']):
+                if is_relation:
+                    relation_names[term_id] = acc
+                else:
+                    ids[term_id] = acc
+            self._term_accs_cache = (ids, relation_names)
+        return self._term_accs_cache
+
+    def _build_graph(self, relations, source, bitsets):
+        ids, relation_names = self._term_accs()
+        accs = sorted(ids.values())
+        index = {acc: i for i, acc in enumerate(accs)}
+        term_index = {term_id: index[acc] for term_id, acc in ids.items()}
+        rel_names = sorted(relation_names.values())
+        rel_index = {term_id: rel_names.index(name) for term_id, name in
+                     relation_names.items()}
+        keep = None if relations is None else set(relations)
+
+        t2t = self.table_columns('term2term')
+        edges = [(term_index[child], term_index[parent], rel_index[rel])
+                 for rel, parent, child in
+                 zip(t2t['relationship_type_id'], t2t['term1_id'],
+                     t2t['term2_id'])
+                 if (child in term_index and parent in term_index and
+                     (keep is None or relation_names.get(rel) in keep))]
+
+        closure = None
+        if source == 'graph_path':
+            gp = self.table_columns('graph_path')
+            closure = ((term_index[d], term_index[a]) for a, d in
+                       itertools.izip(gp['term1_id'], gp['term2_id'])
+                       if a in term_index and d in term_index)
+        return build_term_graph(accs, rel_names, edges, closure, bitsets)
+
+    def export_shared(self, path=None):
+        '''
+        Write self.graph(), and self.associations() if the release has an
+        association table, to a shared file (see write_shared) that worker
+        processes can attach with attach_shared().  Return the path.
+
+        path: defaults to shared_file(self.release_dir).
+        '''
+        associations = (self.associations() if self.has_table('association')
+                        else None)
+        return write_shared(path or shared_file(self.release_dir),
+                            self.graph(), associations)
+
+    def attach_shared(self, path=None):
+        '''
+        Memory-map a shared file written by export_shared() and use its
+        graph and associations for graph(), associations(), similarity(),
+        etc. when relations is None, instead of building them from the
+        tables.  The file is read-only and shared by every process attached
+        to it.
+
+        path: defaults to shared_file(self.release_dir).
+        '''
+        self._shared = attach_shared(path or shared_file(self.release_dir))
+        return self
+
+    def search_index(self):
+        '''
+        Return a TermSearchIndex of the terms and term_synonym table of the
+        release.  The index is persisted to search_index_file(release_dir)
+        and loaded from there while it is newer than the term and
+        term_synonym tables.  If the release dir is not writable, the index
+        is just not persisted.
+        '''
+        if self._search_index is None:
+            path = search_index_file(self.release_dir)
+            sources = [self._table_file(table) for table in
+                       ('term', 'term_synonym')]
+            if not self.db_path and all(_is_fresh(path, source)
+                                        for source in sources):
+                self._search_index = util.loadObject(path)
+            else:
+                self._search_index = self._build_search_index()
+                if not self.db_path:
+                    try:
+                        tmp = '{}.tmp{}'.format(path, os.getpid())
+                        util.dumpObject(self._search_index, tmp)
+                        os.rename(tmp, path)
+                    except (IOError, OSError):
+                        logging.warning('Could not save search index %s',
+                                        path)
+        return self._search_index
+
+    def _build_search_index(self):
+        term = self.table_columns('term')
+        keep = [i for i, is_relation in enumerate(term['is_relation'])
+                if not is_relation]
+        index = dict((term['id'][i], t) for t, i in enumerate(keep))
+        synonyms = []
+        if self.has_table('term_synonym'):
+            syn = self.table_columns('term_synonym')
+            synonyms = [(index[term_id], synonym) for term_id, synonym in
+                        itertools.izip(syn['term_id'], syn['term_synonym'])
+                        if term_id in index and synonym]
+        return TermSearchIndex([term['acc'][i] for i in keep],
+                               [term['name'][i] for i in keep],
+                               [term['is_obsolete'][i] for i in keep],
+                               synonyms)
+
+    def search(self, query, limit=10):
+        '''
+        Return a list of up to limit SearchResult tuples for the terms best
+        matching query.  See TermSearchIndex.search.
+        '''
+        return self.search_index().search(query, limit)
+
+    def map_to_slim(self, slim_accs, annotations, processes=None,
+                    relations=None):
+        '''
+        Map (gene, acc) annotations to the terms of a GO slim through
+        self.graph(relations).  See map_to_slim.
+        '''
+        return map_to_slim(self.graph(relations), slim_accs, annotations,
+                           processes)
+
+    def ancestors(self, acc, relations=None):
+        '''
+        Return a list of the accs of the ancestors of acc, following only
+        edges of the given relations, or all edges if relations is None.
+        '''
+        return self.graph(relations).ancestors(acc)
+
+    def descendants(self, acc, relations=None):
+        '''
+        Return a list of the accs of the descendants of acc, following only
+        edges of the given relations, or all edges if relations is None.
+        '''
+        return self.graph(relations).descendants(acc)
+
+    def lowest_common_ancestors(self, acc1, acc2, relations=None):
+        '''
+        Return a list of the accs of the lowest common ancestors of acc1 and
+        acc2.
+        '''
+        return self.graph(relations).lowest_common_ancestors(acc1, acc2)
+
+    def associations(self, relations=None):
+        '''
+        Return an AssociationIndex of the gene_product and association tables
+        of an assocdb release, built once and cached.  NOT annotations
+        (association.is_not) are excluded.  Annotations are propagated through
+        self.graph(relations).
+        '''
+        if self._shared and self._shared[1] and relations is None:
+            return self._shared[1]
+        key = None if relations is None else frozenset(relations)
+        if key not in self._associations:
+            graph = self.graph(relations)
+            term_accs, relation_names = self._term_accs()
+            term_index = {term_id: graph.index[acc] for term_id, acc in
+                          term_accs.iteritems()}
+            products = self.table_columns('gene_product')
+            gene_ids = products['id']
+            gene_index = {gene_id: i for i, gene_id in enumerate(gene_ids)}
+            direct = [[] for gene_id in gene_ids]
+            assoc = self.table_columns('association')
+            for term_id, gene_id, is_not in itertools.izip(
+                assoc['term_id'], assoc['gene_product_id'], assoc['is_not']):
+                if not is_not and term_id in term_index:
+                    direct[gene_index[gene_id]].append(term_index[term_id])
+            self._associations[key] = build_association_index(
+                graph, gene_ids, products['symbol'], direct)
+        return self._associations[key]
+
+    def enrichment(self, gene_lists, background=None, min_count=2,
+                   correction='fdr_bh', relations=None):
+        '''
+        Test each list of gene_product ids in gene_lists for enriched terms.
+        See AssociationIndex.enrichment.
+        '''
+        return self.associations(relations).enrichment(
+            gene_lists, background, min_count, correction)
+
+    def similarity(self, relations=None):
+        '''
+        Return a SemanticSimilarity of the associations of the release, built
+        once and cached, so information content is computed only once.
         '''
-        field_names = self.term_table_fields()
-        num = len(field_names)
-        for fields in self.term_table_tuples():
-            yield {field_names[i]: fields[i] for i in range(num)}
+        key = None if relations is None else frozenset(relations)
+        if key not in self._similarities:
+            self._similarities[key] = SemanticSimilarity(
+                self.associations(relations))
+        return self._similarities[key]
 
 
 ############